@@ -1,7 +1,19 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import networkx as nx
-from shapely.geometry import Point, LineString
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from shapely.geometry import LineString
+from input_cache import read_cached
+
+# 建物の最寄りノードまでの距離の上限（m）。超える建物は snap_far=True とする（None の場合は判定しない）
+MAX_SNAP_DISTANCE = None
+
+# 経路探索のバックエンド（"networkx": NetworkX のグラフ、"csgraph": scipy の CSR 隣接行列。大規模ネットワークでは "csgraph"）
+ROUTING_BACKEND = "networkx"
+
 
 # find_nearest_node 関数の修正（孤立ノード処理を削除）
 def find_nearest_node(point, nodes):
@@ -15,178 +27,412 @@ def find_nearest_node(point, nodes):
     Returns:
         int: 最も近いノードのID
     """
-    nodes["distance"] = nodes.geometry.apply(lambda x: point.distance(x))
-    nearest_node = nodes.loc[nodes["distance"].idxmin()]
-    return nearest_node["node_id"]
+    distances = nodes.geometry.distance(point)
+    return nodes.loc[distances.idxmin(), "node_id"]
+
+
+class NodeSnapper:
+    """
+    ノード座標の KD 木を一度だけ作成し、複数のポイントの最寄りノードを一括で検索します。
+    等距離（最短距離との差が相対誤差 TIE_TOLERANCE 以内）のノードが複数ある場合は node_id が最小のノードを返すため、
+    ノードの並び順によらず同じノードになります。
+    """
 
-# ファイルパスの指定
-node_path = r"C:\szok\szoksrg_simulation\szoksrg_nodes.shp"
-edge_path = r"C:\szok\szoksrg_simulation\szoksrg_edges.shp"
-building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
-shelter_path = r"C:\szok\import\szoksrg_shelters.shp"
-output_route_path = r"C:\szok\szoksrg_simulation\szoksrg_routes.shp"
+    # 等距離とみなす最短距離との相対誤差
+    TIE_TOLERANCE = 1e-12
+
+    def __init__(self, nodes):
+        """
+        Parameters:
+            nodes (GeoDataFrame): ノードデータ（node_id 列を含む）
+        """
+        self.node_ids = nodes["node_id"].to_numpy()
+        self.id_rank = pd.factorize(pd.Series(self.node_ids), sort=True)[0]
+        self.tree = cKDTree(np.column_stack([nodes.geometry.x, nodes.geometry.y]))
+
+    def snap(self, points):
+        """
+        Parameters:
+            points (GeoSeries): 検索対象のポイント
+
+        Returns:
+            tuple: (最寄りノードIDの配列, 最寄りノードまでの距離の配列)
+        """
+        xy = np.column_stack([points.x, points.y])
+        k = min(2, len(self.node_ids))
+        distances, idx = self.tree.query(xy, k=k)
+        distances, idx = distances.reshape(len(xy), k), idx.reshape(len(xy), k)
+        nearest = idx[:, 0].copy()
+
+        # 2番目に近いノードも最短距離の (1 + TIE_TOLERANCE) 倍以内のポイントのみ、その範囲のノードをすべて取得し、
+        # node_id が最小のノードを採用
+        radius = distances[:, 0] * (1 + self.TIE_TOLERANCE)
+        tied = np.flatnonzero(distances[:, -1] <= radius) if k > 1 else np.array([], dtype=np.int64)
+        neighbors = self.tree.query_ball_point(xy[tied], radius[tied])
+        counts = np.fromiter((len(n) for n in neighbors), dtype=np.int64, count=len(neighbors))
+        owner = np.concatenate([np.repeat(tied, counts), tied])
+        candidate = np.concatenate([
+            np.fromiter((i for n in neighbors for i in n), dtype=np.int64, count=counts.sum()), nearest[tied]
+        ])
+        order = np.lexsort((self.id_rank[candidate], owner))
+        owner, candidate = owner[order], candidate[order]
+        first = np.ones(len(owner), dtype=bool)
+        first[1:] = owner[1:] != owner[:-1]
+        nearest[owner[first]] = candidate[first]
+        return self.node_ids[nearest], distances[:, 0]
 
 # 移動速度の設定（km/h）
 CAR_SPEED_30KM = 30.0  # 幅員2.5m以上
 CAR_SPEED_15KM = 15.0  # 幅員1.5m以上2.5m未満
 WALK_SPEED_4_5KM = 4.5  # 幅員0.5m以上1.5m未満
 
-# データの読み込み
-nodes = gpd.read_file(node_path, encoding="utf-8")
-edges = gpd.read_file(edge_path, encoding="utf-8")
-buildings = gpd.read_file(building_path, encoding="utf-8")
-shelters = gpd.read_file(shelter_path, encoding="utf-8")
-
-# NetworkXグラフの作成
-G = nx.Graph()  # 無向グラフ
-
-# ノードを追加
-for _, node in nodes.iterrows():
-    G.add_node(node["node_id"], pos=(node.geometry.x, node.geometry.y))
-
-# エッジを追加し、条件に基づく速度を指定
-for _, edge in edges.iterrows():
-    start_node = edge["start_node"]
-    end_node = edge["end_node"]
-    road_width = edge["道路幅"]
-    max_width_reduction = edge["max_width"]
-    car_access = edge['car_access']
-
-    # 幅員条件に基づいて速度を設定
-    if road_width - max_width_reduction >= 2.5:
-        speed = CAR_SPEED_30KM if car_access == 1 else WALK_SPEED_4_5KM
-    elif 1.5 <= road_width - max_width_reduction < 2.5:
-        speed = CAR_SPEED_15KM if car_access == 1 else WALK_SPEED_4_5KM
-    elif 0.5 <= road_width - max_width_reduction < 1.5:
-        speed = WALK_SPEED_4_5KM
-    else:
-        continue  # 道幅が0.5m未満の場合はエッジを追加しない
-    # エッジ幅とcar_accessの判定のデバッグ出力
-    # print(f"Edge {start_node}-{end_node}: road_width={road_width}, max_width_reduction={max_width_reduction}, car_access={car_access}, speed={speed}")
+
+def tie_broken_tree(node_ids, a, b, weights, dist, sources):
+    """
+    最寄り避難所までの移動時間から、避難所方向の最短経路木を作成します。
+    移動時間の等しい経路が複数ある場合は、最短経路上の辺で避難所から1段少ないノードのうち node_id が最小のノードを
+    次のノードとするため、経路探索のバックエンドによらず同じ経路になります。
+
+    Parameters:
+        node_ids (numpy.ndarray): 行位置ごとのノードID
+        a (numpy.ndarray): エッジの一端のノードの行位置
+        b (numpy.ndarray): エッジの他端のノードの行位置
+        weights (numpy.ndarray): エッジの移動時間
+        dist (numpy.ndarray): ノードごとの最寄り避難所までの移動時間（到達できないノードは inf）
+        sources (numpy.ndarray): 避難所ノードの行位置
+
+    Returns:
+        numpy.ndarray: ノードごとの避難所方向の次のノードの行位置（避難所ノード・到達できないノードは -1）
+    """
+    n = len(node_ids)
+    next_node = np.full(n, -1)
+    if len(sources) == 0:
+        return next_node
+
+    # 最短経路上の辺（u が v より避難所に近い）。無向のため両方向を調べる
+    u, v = np.concatenate([a, b]), np.concatenate([b, a])
+    w = np.concatenate([weights, weights])
+    tight = (u != v) & np.isfinite(dist[v]) & (dist[u] + w == dist[v])
+    u, v = u[tight], v[tight]
+
+    # 避難所から最短経路上の辺をたどる段数（移動時間 0 の辺で次のノードが循環しないよう、1段少ないノードのみを候補とする）
+    graph = csr_matrix((np.ones(len(u)), (u, v)), shape=(n, n))
+    hops = dijkstra(graph, directed=True, indices=sources, unweighted=True, min_only=True)
+    candidate = hops[u] + 1 == hops[v]
+    u, v = u[candidate], v[candidate]
+
+    # 候補のうち node_id が最小のノード
+    id_rank = pd.factorize(pd.Series(node_ids), sort=True)[0]
+    order = np.lexsort((id_rank[u], v))
+    u, v = u[order], v[order]
+    first = np.r_[True, v[1:] != v[:-1]] if len(v) else np.zeros(0, dtype=bool)
+    next_node[v[first]] = u[first]
+    next_node[sources] = -1
+    return next_node
+
+
+def shelter_tree(G, shelter_nodes):
+    """
+    全避難所ノードを始点とする多始点ダイクストラ法（重み: 移動時間）で、最寄り避難所への最短経路木を求めます。
+    グラフは無向のため、各ノードから最寄り避難所への最短経路は、この木を避難所方向へたどった経路になります。
+    移動時間の等しい経路は tie_broken_tree で選びます（CSGraphRouter と同じ経路）。
+
+    Parameters:
+        G (networkx.Graph): 道路ネットワーク
+        shelter_nodes (list): 避難所の最寄りノードID
+
+    Returns:
+        dict: ノードID → 最寄り避難所方向の次のノードID（避難所ノードは None。到達できないノードは含まない）
+    """
+    # 仮想始点を全避難所ノードに移動時間 0 で接続し、単一始点のダイクストラ法として解く
+    source = object()
+    G.add_edges_from(((source, node) for node in dict.fromkeys(shelter_nodes)), time=0.0)
+    try:
+        distances = nx.single_source_dijkstra_path_length(G, source, weight="time")
+    finally:
+        G.remove_node(source)
+
+    # 行位置の配列に変換して最短経路木を作成
+    node_index = pd.Index(list(G.nodes))
+    node_ids = node_index.to_numpy()
+    del distances[source]
+    dist = pd.Series(distances, dtype=float).reindex(node_index).fillna(np.inf).to_numpy()
+    graph_edges = list(G.edges(data="time"))
+    a = node_index.get_indexer([edge[0] for edge in graph_edges])
+    b = node_index.get_indexer([edge[1] for edge in graph_edges])
+    weights = np.array([edge[2] for edge in graph_edges], dtype=float)
+    sources = np.unique(node_index.get_indexer(list(dict.fromkeys(shelter_nodes))))
+    next_node = tie_broken_tree(node_ids, a, b, weights, dist, sources)
+
+    reachable = np.flatnonzero(np.isfinite(dist))
+    return {
+        node_ids[i]: (node_ids[next_node[i]] if next_node[i] >= 0 else None)
+        for i in reachable
+    }
+
+
+def edge_travel_times(edges):
+    """
+    幅員条件に基づいてエッジごとの移動速度と移動時間を求めます。
+
+    Parameters:
+        edges (GeoDataFrame): エッジデータ（道路幅, max_width, car_access, length 列）
+
+    Returns:
+        DataFrame: 通行可能なエッジ（有効幅員0.5m以上）のみの start_node, end_node, length, time, edge_id, speed 列（元の順序）
+    """
+    # 幅員・幅員減少は欠損値を NaN として扱う（シェープファイル経由で読み込んだ場合と同じ）
+    width = pd.to_numeric(edges["道路幅"], errors="coerce") - pd.to_numeric(edges["max_width"], errors="coerce")
+    width = width.to_numpy(dtype=float)
+    car_access = (edges["car_access"] == 1).to_numpy()
+
+    # 幅員条件に基づいて速度を設定（道幅が0.5m未満の場合はエッジを追加しない）
+    speed = np.select(
+        [width >= 2.5, (1.5 <= width) & (width < 2.5), (0.5 <= width) & (width < 1.5)],
+        [np.where(car_access, CAR_SPEED_30KM, WALK_SPEED_4_5KM),
+         np.where(car_access, CAR_SPEED_15KM, WALK_SPEED_4_5KM),
+         WALK_SPEED_4_5KM],
+        default=np.nan,
+    )
+    usable = ~np.isnan(speed)
 
     # 移動時間（分単位）= 距離 / 速度 * 60
-    time = (edge["length"] / 1000) / speed * 60  # 距離はkm単位、速度はkm/h単位
-
-    # エッジをグラフに追加
-    G.add_edge(start_node, end_node, length=edge["length"], time=time, edge_id=edge["edge_id"])
-
-# 各建物から最も近い避難所までのルートを計算
-routes = []
-route_id = 1  # ルートIDカウンター
-
-for building in buildings.itertuples():
-    start_point = building.geometry.centroid
-    building_id = building.id
-    akiya_flag = building.akiya
-    path = None # 未定義変数のエラー回避のためのpath初期化
-
-    # 空き家の場合はルート検索をスキップ
-    if akiya_flag:
-        routes.append({
-            "r_id": route_id,
-            "b_id": building_id,
-            "akiya": akiya_flag,
-            "r_found": False,  # ルートなし
-            "n_node": None,
-            "p_nodes": None,
-            "e_30km": None,
-            "e_15km": None,
-            "e_4_5km": None,
-            "walk_f": False,
-            "t_time": None,
-            "t_dist": None,
-            "geometry": None
-        })
-        route_id += 1
-        continue
+    length = edges["length"].to_numpy(dtype=float)[usable]
+    return pd.DataFrame({
+        "start_node": edges["start_node"].to_numpy()[usable],
+        "end_node": edges["end_node"].to_numpy()[usable],
+        "length": length,
+        "time": (length / 1000) / speed[usable] * 60,  # 距離はkm単位、速度はkm/h単位
+        "edge_id": edges["edge_id"].to_numpy()[usable],
+        "speed": speed[usable],  # 速度（km/h）
+    })
+
+
+class NetworkXRouter:
+    """NetworkX の無向グラフによる経路探索"""
+
+    def __init__(self, nodes, edges):
+        """
+        Parameters:
+            nodes (GeoDataFrame): ノードデータ
+            edges (GeoDataFrame): エッジデータ
+        """
+        self.G = nx.Graph()  # 無向グラフ
+        self.G.add_nodes_from(
+            (node_id, {"pos": (x, y)})
+            for node_id, x, y in zip(nodes["node_id"], nodes.geometry.x, nodes.geometry.y)
+        )
+        # 同じノード間に複数のエッジがある場合は後のエッジで上書き
+        travel = edge_travel_times(edges)
+        self.G.add_edges_from(
+            (u, v, {"length": length, "time": time, "edge_id": edge_id, "speed": speed})
+            for u, v, length, time, edge_id, speed in travel.itertuples(index=False)
+        )
+        self.next_node = {}
+        self.dijkstra_runs = 0  # 最短経路探索の実行回数
+
+    def build_shelter_tree(self, shelter_nodes):
+        self.next_node = shelter_tree(self.G, shelter_nodes)
+        self.dijkstra_runs += 1
+
+    def path_to_shelter(self, start_node):
+        """最寄り避難所までのノード列（到達できない場合は None）"""
+        if start_node not in self.next_node:
+            return None
+        path = [start_node]
+        while self.next_node[path[-1]] is not None:
+            path.append(self.next_node[path[-1]])
+        return path
+
+    def has_node(self, node):
+        return node in self.G.nodes
+
+    def position(self, node):
+        return self.G.nodes[node]["pos"]
+
+    def positions(self, path):
+        """ノード列の座標の配列（ノード数 x 2）"""
+        return np.array([self.G.nodes[node]["pos"] for node in path], dtype=float)
+
+    def edge(self, u, v):
+        return self.G[u][v]
+
+
+class CSGraphRouter:
+    """scipy.sparse の CSR 隣接行列と csgraph.dijkstra による経路探索（大規模ネットワーク用）"""
+
+    def __init__(self, nodes, edges):
+        """
+        Parameters:
+            nodes (GeoDataFrame): ノードデータ
+            edges (GeoDataFrame): エッジデータ
+        """
+        travel = edge_travel_times(edges)
+        self.node_index = pd.Index(nodes["node_id"]).append(
+            pd.Index(np.concatenate([travel["start_node"], travel["end_node"]]))
+        ).drop_duplicates()
+        self.node_ids = self.node_index.to_numpy()
+        self.xy = np.full((len(self.node_index), 2), np.nan)
+        self.xy[:len(nodes)] = np.column_stack([nodes.geometry.x, nodes.geometry.y])
 
-    # 建物の出発ノード
-    start_node = find_nearest_node(start_point, nodes)
+        # 同じノード間の複数のエッジは後のエッジを採用し（NetworkX と同じ）、自己ループは除外
+        u = self.node_index.get_indexer(travel["start_node"])
+        v = self.node_index.get_indexer(travel["end_node"])
+        pairs = pd.DataFrame({"a": np.minimum(u, v), "b": np.maximum(u, v)})
+        keep = ~pairs.duplicated(keep="last").to_numpy() & (u != v)
+        travel, a, b = travel[keep], pairs["a"].to_numpy()[keep], pairs["b"].to_numpy()[keep]
 
-    # 各避難所へのルートと最短距離を求める
-    nearest_shelter_node = None
-    min_travel_time = float("inf")
-    best_path = None
-    route_found = False
+        # 移動時間 0 のエッジも辺として扱うため、明示的な 0 を残したまま CSR 行列を作成
+        n = len(self.node_index)
+        self.graph = csr_matrix((travel["time"].to_numpy(), (a, b)), shape=(n, n))
+        self.edge_a, self.edge_b, self.edge_time = a, b, travel["time"].to_numpy(dtype=float)
+        self.edges = {}
+        for ai, bi, length, time, edge_id, speed in zip(
+            a, b, travel["length"], travel["time"], travel["edge_id"], travel["speed"]
+        ):
+            data = {"length": length, "time": time, "edge_id": edge_id, "speed": speed}
+            self.edges[(ai, bi)] = data
+            self.edges[(bi, ai)] = data
+        self.predecessors = np.full(n, -1)
+        self.is_source = np.zeros(n, dtype=bool)
+        self.dijkstra_runs = 0  # 最短経路探索の実行回数
+
+    def build_shelter_tree(self, shelter_nodes):
+        sources = np.unique(self.node_index.get_indexer(list(shelter_nodes)))
+        sources = sources[sources >= 0]
+        if len(sources) == 0:
+            return
+        dist = dijkstra(self.graph, directed=False, indices=sources, min_only=True)
+        self.predecessors = tie_broken_tree(
+            self.node_ids, self.edge_a, self.edge_b, self.edge_time, dist, sources
+        )
+        self.is_source = np.zeros(len(self.node_index), dtype=bool)
+        self.is_source[sources] = True
+        self.dijkstra_runs += 1
+
+    def path_to_shelter(self, start_node):
+        """最寄り避難所までのノード列（到達できない場合は None）"""
+        i = self.node_index.get_indexer([start_node])[0]
+        if i < 0 or not (self.is_source[i] or self.predecessors[i] >= 0):
+            return None
+        path = [i]
+        while not self.is_source[path[-1]]:
+            path.append(self.predecessors[path[-1]])
+        return self.node_ids[path].tolist()
+
+    def has_node(self, node):
+        return node in self.node_index
+
+    def position(self, node):
+        return tuple(self.xy[self.node_index.get_loc(node)])
+
+    def positions(self, path):
+        """ノード列の座標の配列（ノード数 x 2）"""
+        return self.xy[self.node_index.get_indexer(path)]
+
+    def edge(self, u, v):
+        return self.edges[(self.node_index.get_loc(u), self.node_index.get_loc(v))]
+
+
+# 経路探索のバックエンド
+ROUTERS = {"networkx": NetworkXRouter, "csgraph": CSGraphRouter}
+
+
+def summarize_path(router, path):
+    """
+    避難所までのノード列から、同じ出発ノードの建物に共通するルート情報を求めます。
+
+    Parameters:
+        router (NetworkXRouter / CSGraphRouter): 最短経路木を作成済みの経路探索
+        path (list): 出発ノードから避難所までのノード列（2ノード以上）
+
+    Returns:
+        dict: p_nodes, e_30km, e_15km, e_4_5km, walk_f, t_time, t_dist 列の値と、ノード座標の配列（coords）
+    """
+    # 通過エッジIDを速度ごとに分類
+    edges_30km, edges_15km, edges_4_5km = [], [], []
+    total_time = 0
+    total_length = 0
     is_walking = False  # 徒歩切り替えフラグ
 
-    for shelter in shelters.itertuples():
-        shelter_node = find_nearest_node(shelter.geometry, nodes)
+    for u, v in zip(path[:-1], path[1:]):
+        edge_data = router.edge(u, v)
+        total_time += edge_data["time"]
+        total_length += edge_data["length"]
+        speed = edge_data["speed"]  # 幅員条件で決めた速度（長さ 0 のエッジでも分類できるよう移動時間から逆算しない）
 
-        # 最短経路探索
-        try:
-            path = nx.shortest_path(G, source=start_node, target=shelter_node, weight="time")
-            path_edges = [(path[i], path[i + 1]) for i in range(len(path) - 1)]
-            travel_time = sum(G[u][v]["time"] for u, v in path_edges)
-            route_found = True
+        # 一度徒歩に切り替わったらその後も徒歩速度に固定
+        if is_walking or speed == WALK_SPEED_4_5KM:
+            is_walking = True
+            edges_4_5km.append(edge_data["edge_id"])
+        elif speed == CAR_SPEED_30KM:
+            edges_30km.append(edge_data["edge_id"])
+        elif speed == CAR_SPEED_15KM:
+            edges_15km.append(edge_data["edge_id"])
 
-            # 現時点で最短の経路を保存
-            if travel_time < min_travel_time:
-                min_travel_time = travel_time
-                nearest_shelter_node = shelter_node
-                best_path = path
+    return {
+        "p_nodes": ";".join(map(str, path)),  # 通過ノード
+        "e_30km": ";".join(map(str, edges_30km)),  # 30kmエッジ
+        "e_15km": ";".join(map(str, edges_15km)),  # 15kmエッジ
+        "e_4_5km": ";".join(map(str, edges_4_5km)),  # 4.5kmエッジ
+        "walk_f": is_walking,  # 徒歩フラグ
+        "t_time": total_time,  # 総時間（分）
+        "t_dist": total_length,  # 総距離（m）
+        "coords": router.positions(path),  # 通過ノードの座標
+    }
 
-        except nx.NetworkXNoPath:
-            continue
 
-    # ルートデータを保存
-    if best_path and len(best_path) > 1:  # ルートが2ノード以上の場合のみ保存
-        travel_edges = [(best_path[i], best_path[i + 1]) for i in range(len(best_path) - 1)]
-
-        # 通過エッジIDを速度ごとに分類
-        edges_30km, edges_15km, edges_4_5km = [], [], []
-        total_length = 0
-
-        for u, v in travel_edges:
-            edge_data = G[u][v]
-            total_length += edge_data["length"]
-            speed = (edge_data["length"] / 1000) / (edge_data["time"] / 60)  # km/h で計算
-
-            # 一度徒歩に切り替わったらその後も徒歩速度に固定
-            if is_walking or speed == WALK_SPEED_4_5KM:
-                is_walking = True
-                edges_4_5km.append(edge_data["edge_id"])
-                # print(f"Switching to walking at edge {u}-{v}")
-            elif speed == CAR_SPEED_30KM:
-                edges_30km.append(edge_data["edge_id"])
-            elif speed == CAR_SPEED_15KM:
-                edges_15km.append(edge_data["edge_id"])
-
-        # 建物中心から最寄りノードまでのラインを追加
-        initial_line = LineString([
-            Point(start_point.x, start_point.y),
-            Point(*G.nodes[best_path[0]]["pos"])
-        ])
-        route_line = LineString([Point(*G.nodes[n]["pos"]) for n in best_path])
-        complete_route = LineString(list(initial_line.coords) + list(route_line.coords)[1:])
-
-        routes.append({
-            "r_id": route_id,  # route_id
-            "b_id": building_id,  # building_id
-            "akiya": akiya_flag,  # 空き家フラグ
-            "r_found": route_found,  # ルートがあるか
-            "n_node": start_node,  # 最寄りノード
-            "p_nodes": ";".join(map(str, best_path)),  # 通過ノード
-            "e_30km": ";".join(map(str, edges_30km)),  # 30kmエッジ
-            "e_15km": ";".join(map(str, edges_15km)),  # 15kmエッジ
-            "e_4_5km": ";".join(map(str, edges_4_5km)),  # 4.5kmエッジ
-            "walk_f": is_walking,  # 徒歩フラグ
-            "t_time": min_travel_time,  # 総時間（分）
-            "t_dist": total_length,  # 総距離（m）
-            "geometry": complete_route,
-        })
-    else:
-        if start_node in G.nodes:
-            line_to_node = LineString([
-                Point(start_point.x, start_point.y),
-                Point(*G.nodes[start_node]["pos"])
-            ])
+def compute_routes(nodes, edges, buildings, shelters, max_snap_distance=MAX_SNAP_DISTANCE, backend=ROUTING_BACKEND):
+    """
+    道路ネットワーク上で各建物から最も近い避難所までの最短ルート（移動時間）を計算します。
+
+    Parameters:
+        nodes (GeoDataFrame): ノードデータ（node_edge3 の結果）
+        edges (GeoDataFrame): エッジデータ（node_edge3 の結果）
+        buildings (GeoDataFrame): 倒壊結果を反映した建物データ
+        shelters (GeoDataFrame): 避難所データ
+        max_snap_distance (float): 建物の最寄りノードまでの距離の上限（m）。超える建物は snap_far=True
+        backend (str): 経路探索のバックエンド（"networkx" / "csgraph"）
+
+    Returns:
+        GeoDataFrame: 建物ごとのルート
+    """
+    if backend not in ROUTERS:
+        raise ValueError(f"未対応の経路探索バックエンドです: {backend}（{', '.join(ROUTERS)} から選択）")
+    router = ROUTERS[backend](nodes, edges)
+
+    # 建物の重心と避難所の最寄りノードを一括で検索
+    snapper = NodeSnapper(nodes)
+    building_points = buildings.geometry.centroid
+    building_xy = np.column_stack([building_points.x, building_points.y])
+    building_nodes, snap_distances = snapper.snap(building_points)
+    shelter_nodes, _ = snapper.snap(shelters.geometry)
+
+    # 最寄りノードが遠い（孤立したノードに接続された可能性がある）建物
+    snap_far = np.zeros(len(buildings), dtype=bool) if max_snap_distance is None else snap_distances > max_snap_distance
+
+    # 全避難所からの最短経路木を一度だけ作成
+    router.build_shelter_tree(shelter_nodes.tolist())
+
+    # 各建物から最も近い避難所までのルートを計算
+    # 同じ出発ノードの建物はルート情報を共有し、建物ごとには建物中心から出発ノードまでの区間のみを追加
+    routes = []
+    route_id = 1  # ルートIDカウンター
+    shared_routes = {}  # 出発ノードごとのルート情報（ルートが2ノード未満の場合は None）
+
+    for i, building in enumerate(buildings.itertuples()):
+        start_xy = building_xy[i]
+        building_id = building.id
+        akiya_flag = building.akiya
+
+        # 空き家の場合はルート検索をスキップ
+        if akiya_flag:
             routes.append({
                 "r_id": route_id,
                 "b_id": building_id,
                 "akiya": akiya_flag,
-                "r_found": False,
-                "n_node": start_node,
+                "r_found": False,  # ルートなし
+                "n_node": None,
                 "p_nodes": None,
                 "e_30km": None,
                 "e_15km": None,
@@ -194,10 +440,112 @@ for building in buildings.itertuples():
                 "walk_f": False,
                 "t_time": None,
                 "t_dist": None,
-                "geometry": line_to_node,
+                "snap_dist": None,
+                "snap_far": False,
+                "geometry": None
             })
-    route_id += 1
+            route_id += 1
+            continue
+
+        # 建物の出発ノード
+        start_node = building_nodes[i].item()
+
+        # 最短経路木を避難所方向へたどって最寄り避難所までのルートを求める（出発ノードごとに一度だけ）
+        if start_node not in shared_routes:
+            best_path = router.path_to_shelter(start_node)
+            shared_routes[start_node] = summarize_path(router, best_path) if best_path and len(best_path) > 1 else None
+        shared = shared_routes[start_node]
+
+        # ルートデータを保存
+        if shared is not None:  # ルートが2ノード以上の場合のみ保存
+            # 建物中心から最寄りノードまでの区間を先頭に追加
+            complete_route = LineString(np.vstack([start_xy, shared["coords"]]))
+
+            routes.append({
+                "r_id": route_id,  # route_id
+                "b_id": building_id,  # building_id
+                "akiya": akiya_flag,  # 空き家フラグ
+                "r_found": True,  # ルートがあるか
+                "n_node": start_node,  # 最寄りノード
+                "p_nodes": shared["p_nodes"],  # 通過ノード
+                "e_30km": shared["e_30km"],  # 30kmエッジ
+                "e_15km": shared["e_15km"],  # 15kmエッジ
+                "e_4_5km": shared["e_4_5km"],  # 4.5kmエッジ
+                "walk_f": shared["walk_f"],  # 徒歩フラグ
+                "t_time": shared["t_time"],  # 総時間（分）
+                "t_dist": shared["t_dist"],  # 総距離（m）
+                "snap_dist": snap_distances[i],  # 最寄りノードまでの距離（m）
+                "snap_far": bool(snap_far[i]),  # 最寄りノードが上限より遠いか
+                "geometry": complete_route,
+            })
+        else:
+            if router.has_node(start_node):
+                line_to_node = LineString([start_xy, router.position(start_node)])
+                routes.append({
+                    "r_id": route_id,
+                    "b_id": building_id,
+                    "akiya": akiya_flag,
+                    "r_found": False,
+                    "n_node": start_node,
+                    "p_nodes": None,
+                    "e_30km": None,
+                    "e_15km": None,
+                    "e_4_5km": None,
+                    "walk_f": False,
+                    "t_time": None,
+                    "t_dist": None,
+                    "snap_dist": snap_distances[i],
+                    "snap_far": bool(snap_far[i]),
+                    "geometry": line_to_node,
+                })
+        route_id += 1
+
+    routes_gdf = gpd.GeoDataFrame(routes, crs="EPSG:6676")
+    routes_gdf.attrs["dijkstra_runs"] = router.dijkstra_runs  # 計測用
+    routes_gdf.attrs["start_nodes"] = len(shared_routes)  # ルート情報を作成した出発ノード数（計測用）
+
+    return routes_gdf
+
+
+def count_edge_usage(routes, edges):
+    """
+    ルートが通過したエッジを、エッジの路線IDごとに数えます（1つのルートが同じ路線を複数回通過しても1回）。
+
+    Parameters:
+        routes (GeoDataFrame): compute_routes の結果
+        edges (GeoDataFrame): ルート計算に用いたエッジデータ（edge_id, route_id 列）
+
+    Returns:
+        Series: 路線IDごとの通過ルート数
+    """
+    edge_columns = [col for col in ["e_30km", "e_15km", "e_4_5km"] if col in routes.columns]
+    if routes.empty or not edge_columns:
+        return pd.Series(dtype="int64", name="usage")
+
+    # 通過エッジID（セミコロン区切り）をルートごとに展開し、エッジの路線IDに変換
+    passed = pd.concat([routes[col] for col in edge_columns]).dropna().astype(str).str.split(";").explode()
+    passed = pd.to_numeric(passed[passed != ""], errors="coerce").dropna().astype("int64")
+    edge_routes = edges.drop_duplicates("edge_id").set_index("edge_id")["route_id"]
+    used = pd.DataFrame({"route": passed.index, "route_id": passed.map(edge_routes).to_numpy()}).dropna()
+
+    usage = used.drop_duplicates().groupby("route_id").size()
+    return usage.rename("usage")
+
+
+if __name__ == "__main__":
+    # ファイルパスの指定
+    node_path = r"C:\szok\szoksrg_simulation\szoksrg_nodes.shp"
+    edge_path = r"C:\szok\szoksrg_simulation\szoksrg_edges.shp"
+    building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+    shelter_path = r"C:\szok\import\szoksrg_shelters.shp"
+    output_route_path = r"C:\szok\szoksrg_simulation\szoksrg_routes.shp"
+
+    # データの読み込み
+    nodes = gpd.read_file(node_path, encoding="utf-8")
+    edges = gpd.read_file(edge_path, encoding="utf-8")
+    buildings = gpd.read_file(building_path, encoding="utf-8")
+    shelters = read_cached(shelter_path)
 
-routes_gdf = gpd.GeoDataFrame(routes, crs="EPSG:6676")
-routes_gdf.to_file(output_route_path, encoding="utf-8")
-print("建物から避難所までの最短ルートが計算され、ルートが保存されました。")
+    routes_gdf = compute_routes(nodes, edges, buildings, shelters)
+    routes_gdf.to_file(output_route_path, encoding="utf-8")
+    print("建物から避難所までの最短ルートが計算され、ルートが保存されました。")
@@ -1,60 +1,137 @@
 # 複数建物の全壊による道路ポリゴンの残存面積と車で走行、徒歩で走行に必要な面積を比較し閉塞判定を行う。
+import os
 import geopandas as gpd
-from shapely.geometry import LineString, MultiLineString
-
-# ファイルパスの指定
-road_polygon_path = r"C:\szok\szoksrg_simulation\szoksrg_road_kosa_with_reductions.geojson"
-road_line_path = r"C:\szok\import\szoksrg_road.shp"
-building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+import numpy as np
+import pandas as pd
+import shapely
+from cross_analysis7 import load_impact_table, query_candidate_pairs, select_impacts
+from input_cache import hashed_path, read_cached, source_hash
 
 # 車と徒歩の通行に必要な面積（m²）
 CAR_PASSAGE_THRESHOLD = 1.5  # 車が通るために必要な幅（m）
 PEDESTRIAN_PASSAGE_THRESHOLD = 0.5  # 人が通るために必要な幅（m）
 
-# データの読み込み
-road_polygons = gpd.read_file(road_polygon_path, encoding="utf-8")
-road_lines = gpd.read_file(road_line_path, encoding="utf-8")
-buildings = gpd.read_file(building_path, encoding="utf-8")
-
-# 道路ポリゴンに新しい属性列を追加
-road_polygons["rem_area"] = 0.0  # 残存面積
-road_polygons["line_len"] = 0.0     # ラインの総長さ
-road_polygons["car_access"] = True     # 車の通行可否
-road_polygons["ped_access"] = True  # 人の通行可否
-
-# 各道路ポリゴンについて処理
-for idx, road_polygon in road_polygons.iterrows():
-    total_intersection_area = 0.0
-
-    # 倒壊建物との交差を確認
-    for _, building in buildings.iterrows():
-        if road_polygon.geometry.intersects(building.geometry):
-            intersection = road_polygon.geometry.intersection(building.geometry)
-            intersection_area = intersection.area
-            total_intersection_area += intersection_area
-
-    # 残存面積を計算
-    remaining_area = road_polygon.geometry.area - total_intersection_area
-    road_polygons.at[idx, "rem_area"] = remaining_area
-
-    # 道路ラインとの交差を計算
-    intersecting_lines = road_lines[road_lines.intersects(road_polygon.geometry)]
-    total_line_length = 0.0
-    for _, line in intersecting_lines.iterrows():
-        intersection = road_polygon.geometry.intersection(line.geometry)
-        if not intersection.is_empty and isinstance(intersection, (LineString, MultiLineString)):
-            total_line_length += intersection.length
-    road_polygons.at[idx, "line_len"] = total_line_length
-
-    # 通行可否を判定
-    car_threshold_area = CAR_PASSAGE_THRESHOLD * total_line_length
-    pedestrian_threshold_area = PEDESTRIAN_PASSAGE_THRESHOLD * total_line_length
-
-    road_polygons.at[idx, "car_access"] = remaining_area >= car_threshold_area
-    road_polygons.at[idx, "ped_access"] = remaining_area >= pedestrian_threshold_area
-
-# 結果を保存
-output_path = r"C:\szok\szoksrg_simulation\szoksrg_road_plateau_area_analysis.geojson"
-road_polygons.to_file(output_path, driver="GeoJSON", encoding="utf-8")
-
-print(f"処理が完了しました。結果は以下に保存されています: {output_path}")
+
+def compute_static_quantities(road_polygons, road_lines):
+    """
+    反復によらない道路ポリゴンごとの量（面積、ポリゴン内の道路中心線の長さ、車・徒歩の通行に必要な面積）を計算します。
+
+    Parameters:
+        road_polygons (GeoDataFrame): 道路ポリゴン
+        road_lines (GeoDataFrame): 道路中心線
+
+    Returns:
+        DataFrame: poly_area, line_len, car_area, ped_area 列（道路ポリゴン順）
+    """
+    polygon_geoms = road_polygons.geometry.to_numpy()
+
+    # 道路ラインとの交差（LineString / MultiLineString の部分のみ）の長さを道路ポリゴンごとに合計
+    polygon_idx, line_idx = query_candidate_pairs(road_polygons, road_lines)
+    intersections = shapely.intersection(polygon_geoms[polygon_idx], road_lines.geometry.to_numpy()[line_idx])
+    is_line = np.isin(shapely.get_type_id(intersections), (1, 5)) & ~shapely.is_empty(intersections)
+    line_len = np.bincount(
+        polygon_idx, weights=np.where(is_line, shapely.length(intersections), 0.0), minlength=len(road_polygons)
+    )
+
+    return pd.DataFrame({
+        "poly_area": shapely.area(polygon_geoms),                  # 道路ポリゴンの面積
+        "line_len": line_len,                                      # ラインの総長さ
+        "car_area": CAR_PASSAGE_THRESHOLD * line_len,              # 車の通行に必要な面積
+        "ped_area": PEDESTRIAN_PASSAGE_THRESHOLD * line_len,       # 人の通行に必要な面積
+    })
+
+
+def cached_static_quantities(road_polygons, road_lines, source_paths, cache_dir):
+    """
+    compute_static_quantities の結果を、入力ファイルの内容のハッシュをキーとしたキャッシュファイルから読み込みます。
+    入力ファイルが変更された場合（ハッシュが一致しない場合）は再計算してキャッシュを作成します。
+
+    Parameters:
+        road_polygons (GeoDataFrame): 道路ポリゴン
+        road_lines (GeoDataFrame): 道路中心線
+        source_paths (list): 道路ポリゴン・道路中心線のファイルのパス
+        cache_dir (str): キャッシュファイルのフォルダ
+
+    Returns:
+        DataFrame: poly_area, line_len, car_area, ped_area 列（道路ポリゴン順）
+    """
+    key = source_hash(source_paths)[:16]
+    cache_path = os.path.join(cache_dir, f"road_polygon_static_{key}.csv")
+    if os.path.exists(cache_path):
+        static = pd.read_csv(cache_path, encoding="utf-8", float_precision="round_trip")
+        if len(static) == len(road_polygons):
+            return static
+
+    static = compute_static_quantities(road_polygons, road_lines)
+    os.makedirs(cache_dir, exist_ok=True)
+    static.to_csv(cache_path, index=False, encoding="utf-8")
+    return static
+
+
+def analyze_remaining_area(road_polygons, road_lines, buildings, impact_table=None, static=None):
+    """
+    道路ポリゴンごとに倒壊建物を除いた残存面積を求め、車・徒歩の通行可否を判定します。
+
+    Parameters:
+        road_polygons (GeoDataFrame): 幅員減少を計算済みの道路ポリゴン（cross_analysis7 の結果）
+        road_lines (GeoDataFrame): 道路中心線
+        buildings (GeoDataFrame): 倒壊結果を反映した建物データ
+        impact_table (DataFrame): 事前計算した影響表（None の場合は建物との交差をその場で計算）
+        static (DataFrame): compute_static_quantities の結果（None の場合はその場で計算）
+
+    Returns:
+        GeoDataFrame: rem_area, line_len, car_access, ped_access 列を追加した道路ポリゴン
+    """
+    road_polygons = road_polygons.copy()
+    if static is None:
+        static = compute_static_quantities(road_polygons, road_lines)
+
+    # 道路ポリゴンごとの倒壊建物との交差面積
+    if impact_table is not None:
+        # 事前計算した影響表から、今回の倒壊結果に対応する行を抽出して集計
+        impacts = select_impacts(impact_table, buildings["倒壊結果"].to_numpy())
+        road_idx, areas = impacts["road_idx"].to_numpy(), impacts["area"].to_numpy()
+    else:
+        road_idx, building_idx = query_candidate_pairs(road_polygons, buildings)
+        areas = shapely.area(shapely.intersection(
+            road_polygons.geometry.to_numpy()[road_idx], buildings.geometry.to_numpy()[building_idx]
+        ))
+    building_overlap_areas = np.bincount(road_idx, weights=areas, minlength=len(road_polygons))
+
+    # 残存面積を計算し、通行可否を判定
+    remaining_area = static["poly_area"].to_numpy() - building_overlap_areas
+    road_polygons["rem_area"] = remaining_area  # 残存面積
+    road_polygons["line_len"] = static["line_len"].to_numpy()  # ラインの総長さ
+    road_polygons["car_access"] = remaining_area >= static["car_area"].to_numpy()  # 車の通行可否
+    road_polygons["ped_access"] = remaining_area >= static["ped_area"].to_numpy()  # 人の通行可否
+
+    return road_polygons
+
+
+if __name__ == "__main__":
+    # ファイルパスの指定
+    road_polygon_path = r"C:\szok\szoksrg_simulation\szoksrg_road_kosa_with_reductions.geojson"
+    source_road_polygon_path = r"C:\szok\import\szoksrg_road_plateau_id.geojson"  # 幅員減少計算前の道路ポリゴン（キャッシュのキー）
+    road_line_path = r"C:\szok\import\szoksrg_road.shp"
+    building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+    source_building_path = r"C:\szok\import\szoksrg_plateau_zenkairitsu.geojson"  # 倒壊判定前の建物（影響表のキー）
+    impact_table_path = r"C:\szok\szoksrg_simulation\szoksrg_road_building_impacts.csv"  # impact_table.py で事前作成
+    static_cache_dir = r"C:\szok\szoksrg_simulation\cache"
+    output_path = r"C:\szok\szoksrg_simulation\szoksrg_road_plateau_area_analysis.geojson"
+
+    # データの読み込み
+    road_polygons = gpd.read_file(road_polygon_path, encoding="utf-8")
+    road_lines = read_cached(road_line_path)
+    buildings = gpd.read_file(building_path, encoding="utf-8")
+    impact_table_path = hashed_path(impact_table_path, [source_building_path, source_road_polygon_path])
+    impact_table = load_impact_table(impact_table_path) if os.path.exists(impact_table_path) else None
+    static = cached_static_quantities(
+        road_polygons, road_lines, [source_road_polygon_path, road_line_path], static_cache_dir
+    )
+
+    road_polygons = analyze_remaining_area(road_polygons, road_lines, buildings, impact_table, static)
+
+    # 結果を保存
+    road_polygons.to_file(output_path, driver="GeoJSON", encoding="utf-8")
+
+    print(f"処理が完了しました。結果は以下に保存されています: {output_path}")
@@ -1,199 +1,640 @@
+import cProfile
 import os
-import shutil
+import platform
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import time
-
-# 各スクリプトのパス
-scripts = [
-    r"C:\\szok\\sim01\\build_destroy.py",
-    r"C:\\szok\\sim01\\wait.py",
-    r"C:\\szok\\sim01\\cross_analysis7.py",
-    r"C:\\szok\\sim01\\wait.py",
-    r"C:\\szok\\sim01\\area_analysis.py",
-    r"C:\\szok\\sim01\\wait.py",
-    r"C:\\szok\\sim01\\closedpoint2.py",
-    r"C:\\szok\\sim01\\wait.py",
-    r"C:\\szok\\sim01\\node_edge3.py",
-    r"C:\\szok\\sim01\\wait.py",
-    r"C:\\szok\\sim01\\NetworkX7.py",
-    r"C:\\szok\\sim01\\wait.py"
-]
-
-# 初期化
-iteration_counter = 0  # 初期値を0に設定
-
-# 繰り返し回数
+
+# スクリプトのフォルダ（各段階の関数を import する）
+script_dir = r"C:\\szok\\sim01"
+sys.path.insert(0, script_dir)
+import build_destroy
+import cross_analysis7
+import area_analysis
+import closedpoint2
+import node_edge3
+import NetworkX7
+import iteration_record
+from input_cache import read_cached, source_hash
+from streaming_stats import ConvergenceMonitor, SimulationSummary
+from result_store import ResultStore
+import checkpoint
+import run_profile
+import tiling
+
+# 入力データのパス
+building_input_path = r"C:\\szok\\import\\szoksrg_plateau_zenkairitsu.geojson"   # 全壊率・倒壊影響範囲付きの建物
+road_polygon_path = r"C:\\szok\\import\\szoksrg_road_plateau_id.geojson"         # 道路ポリゴン
+road_line_path = r"C:\\szok\\import\\szoksrg_road.shp"                           # 道路中心線
+shelter_path = r"C:\\szok\\import\\szoksrg_shelters.shp"                         # 避難所
+
+# 道路×建物の影響表（ファイル名に建物・道路ポリゴンの入力ファイルの内容のハッシュを付けて保存し、入力データが変わると再作成）
+impact_table_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_road_building_impacts.csv"
+
+# 入力データを変換した GeoParquet の保存先（パス・更新日時・サイズが同じ入力は2回目以降ここから読み込む）
+input_cache_dir = r"C:\\szok\\szoksrg_simulation\\cache\\inputs"
+
+# 道路ポリゴンごとの静的な量（面積・中心線長さ・通行に必要な面積）のキャッシュ（入力ファイルの内容が変わると再作成）
+static_cache_dir = r"C:\\szok\\szoksrg_simulation\\cache"
+
+# 乱数シード
+seed = build_destroy.SEED
+
+# 倒壊判定の乱数の生成方法（"plain" / "lhs" / "antithetic"）と共通乱数法の使用有無
+sampling_method = build_destroy.SAMPLING_METHOD
+common_random_numbers = build_destroy.COMMON_RANDOM_NUMBERS
+
+# 倒壊判定の分散低減率を推定する試行回数（0 の場合は推定しない。試行ごとに倒壊判定行列を作成するため大規模データでは時間を要する）
+# ※ "antithetic" の閉塞確率・ルート発見率の分散低減率は、実行した反復の結果から試行なしで推定して最後に報告
+variance_reduction_replicates = 0
+
+# 道路中心線から一度だけ作成したノード・エッジ（固定ID）に反復ごとの変更のみを反映するか
+# （False の場合は反復ごとに全ての始点・終点をクラスタリングしてノード・エッジを作り直す）
+use_base_topology = True
+
+# 反復ごとに build_nodes_edges で作り直したノード・エッジと一致するかを確認するか（検証用。一致しない場合は反復を失敗とする）
+verify_base_topology = False
+
+# 経路探索のバックエンド（"networkx" / "csgraph"。大規模ネットワークでは "csgraph"）
+# 移動時間の等しい経路は node_id の小さいノードを通る経路を選ぶため、どちらのバックエンドでも結果は同じ
+routing_backend = NetworkX7.ROUTING_BACKEND
+
+# 繰り返し回数（収束判定による早期終了を行う場合は最大反復回数）
 iterations = 100
 
+# 収束判定による早期終了（False の場合は iterations 回すべて実行し、最後に信頼区間の半幅のみ報告）
+# ※ "lhs" は iterations 回で層化しているため、途中で終了すると層化の効果は一部失われる
+adaptive_stopping = False
+min_iterations = 10            # 最小反復回数
+convergence_tolerance = 0.05   # 閉塞確率（is_closed）・ルート発見率（r_found）の信頼区間半幅の許容値
+t_time_tolerance = 0.5         # 平均移動時間（t_time, 分）の信頼区間半幅の許容値
+confidence_level = 0.95        # 信頼水準
+
+# 並列実行するプロセス数（1 の場合は逐次実行。例: os.cpu_count()）
+# 各反復の倒壊判定は事前に一括作成した行列の列（反復番号で決まる）を使うため、プロセス数によらず結果は同じ
+n_workers = 1
+
+# タイル分割モード（一辺 tile_size m の格子状のタイルごとに幅員減少・残存面積・道路中心線の分割を行い、元の順に結合する）
+# None の場合は調査範囲全体を一度に処理する。各タイルには周囲（tokaihani の最大値 + 道路幅の最大値）の建物も含めるため、結果は同じ
+tile_size = None
+tile_workers = 1  # タイルを並列実行するプロセス数（n_workers と同時に 2 以上にはできない）
+
 # 各フォルダのパス
-temp_dir = r"C:\\szok\\simu01\\temp"
 simulation_dir = r"C:\\szok\\simu01\\01_szok_simulation"
 csv_output_dir = r"C:\\szok\\simu01\\01_szok_実行結果CSV"
 
-os.makedirs(temp_dir, exist_ok=True)
-os.makedirs(csv_output_dir, exist_ok=True)
+# 各反復の結果を縦持ちで追記する SQLite ファイル（実行開始時に作り直し、CSVは最後に一括で作成）
+result_store_path = r"C:\\szok\\simu01\\01_szok_実行結果CSV\\szok_results.sqlite"
+
+# チェックポイント（完了した反復番号・実行の設定・結果ストアの行数。反復ごとに保存）の保存先
+# 集計の途中状態は szok_checkpoint_aggregates.pkl、その後の反復の集計値の更新分は szok_checkpoint.pkl.updates に保存
+checkpoint_path = r"C:\\szok\\simu01\\01_szok_実行結果CSV\\szok_checkpoint.pkl"
+
+# 集計の途中状態を保存する反復の間隔（建物数に比例して大きくなるため、反復ごとには保存しない）
+# 間の反復は集計値の更新分を保存して再開時に再適用するため、完了した反復は中断しても失われない
+checkpoint_interval = 10
+
+# 中断した実行をチェックポイントから再開するか（コマンドラインで --resume を指定した場合も再開）
+# 完了済みの反復は実行せず、同じ乱数列で続きの反復を実行するため、最終的な出力は中断しなかった場合と同じ
+resume = False
+
+# 実行マニフェスト（各段階・各反復の実行時間・段階の前後のメモリ使用量とプロセスのピークメモリ・件数、
+# 失敗した段階のトレースバック、乱数・入力データのハッシュ）
+# の保存先（段階ごとの表は同じ名前の .parquet に保存）
+manifest_path = r"C:\\szok\\simu01\\01_szok_実行結果CSV\\szok_manifest.json"
 
-# 出力ファイルのパス
+# cProfile で計測する反復番号（None の場合は計測しない。結果はマニフェストと同じフォルダに .prof で保存）
+profile_iteration = None
+
+# 全反復の集計結果（道路ポリゴン・建物・道路中心線ごと）を書き出す GeoPackage と、建物ごとに推定する分位点
+summary_output_path = r"C:\\szok\\simu01\\01_szok_実行結果CSV\\szok_summary.gpkg"
+summary_quantiles = (0.5, 0.9)
+
+# 反復ごとの状態（倒壊建物・閉塞道路・通行可否のビット列、幅員減少量、建物ごとのルート結果）を
+# simulation_dir に npz で保存するか（各段階の成果物は reconstruct_iteration.py で指定した反復のみ再構築）
+write_iteration_records = True
+
+# 各段階の成果物と、再構築時のファイル名
 output_files = {
-    "szok_plateau_destruction.geojson": r"C:\\szok\\simu01\\01_szok_simulation\\szok_plateau_destruction.geojson",
-    "szok_road_kosa_with_reductions.geojson": r"C:\\szok\\simu01\\01_szok_simulation\\szok_road_kosa_with_reductions.geojson",
-    "szok_road_plateau_area_analysis.geojson": r"C:\\szok\\simu01\\01_szok_simulation\\szok_road_plateau_area_analysis.geojson",
-    "szok_road_split_with_all_attributes.geojson": r"C:\\szok\\simu01\\01_szok_simulation\\szok_road_split_with_all_attributes.geojson",
-    "szok_nodes.shp": r"C:\\szok\\simu01\\01_szok_simulation\\szok_nodes.shp",
-    "szok_edges.shp": r"C:\\szok\\simu01\\01_szok_simulation\\szok_edges.shp",
-    "szok_routes.shp": r"C:\\szok\\simu01\\01_szok_simulation\\szok_routes.shp",
+    "destruction": "szok_plateau_destruction.geojson",
+    "reductions": "szok_road_kosa_with_reductions.geojson",
+    "area_analysis": "szok_road_plateau_area_analysis.geojson",
+    "split_roads": "szok_road_split_with_all_attributes.geojson",
+    "nodes": "szok_nodes.shp",
+    "edges": "szok_edges.shp",
+    "routes": "szok_routes.shp",
 }
 
-# CSV 出力設定
+# CSV 出力設定（CSV名: [成果物, [キー列, 値列]]）
 csv_outputs = {
-    "01_倒壊結果.csv": ["karo_plateau_destruction.geojson", ["id", "倒壊結果"]],
-    "02_閉塞状況(max_width).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "max_width"]],
-    "03_閉塞状況(w_build_id).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "w_build_id"]],
-    "04_閉塞状況(is_closed).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "is_closed"]],
-    "05_閉塞状況(c_build_id).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "c_build_id"]],
-    "06_閉塞状況(car_access).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "car_access"]],
-    "07_閉塞状況(ped_access).csv": ["karo_road_plateau_area_analysis.geojson", ["路線ID", "ped_access"]],
-    "08_避難路検索結果(r_found).csv": ["karo_routes.shp", ["b_id", "r_found"]],
-    "09_避難路検索結果(p_nodes).csv": ["karo_routes.shp", ["b_id", "p_nodes"]],
-    "10_避難路検索結果(walk_f).csv": ["karo_routes.shp", ["b_id", "walk_f"]],
-    "11_避難路検索結果(t_time).csv": ["karo_routes.shp", ["b_id", "t_time"]],
-    "12_避難路検索結果(t_dist).csv": ["karo_routes.shp", ["b_id", "t_dist"]]
+    "01_倒壊結果.csv": ["destruction", ["id", "倒壊結果"]],
+    "02_閉塞状況(max_width).csv": ["area_analysis", ["路線ID", "max_width"]],
+    "03_閉塞状況(w_build_id).csv": ["area_analysis", ["路線ID", "w_build_id"]],
+    "04_閉塞状況(is_closed).csv": ["area_analysis", ["路線ID", "is_closed"]],
+    "05_閉塞状況(c_build_id).csv": ["area_analysis", ["路線ID", "c_build_id"]],
+    "06_閉塞状況(car_access).csv": ["area_analysis", ["路線ID", "car_access"]],
+    "07_閉塞状況(ped_access).csv": ["area_analysis", ["路線ID", "ped_access"]],
+    "08_避難路検索結果(r_found).csv": ["routes", ["b_id", "r_found"]],
+    "09_避難路検索結果(p_nodes).csv": ["routes", ["b_id", "p_nodes"]],
+    "10_避難路検索結果(walk_f).csv": ["routes", ["b_id", "walk_f"]],
+    "11_避難路検索結果(t_time).csv": ["routes", ["b_id", "t_time"]],
+    "12_避難路検索結果(t_dist).csv": ["routes", ["b_id", "t_dist"]]
 }
 
-def copy_files_to_temp():
-    """kから始まる成果物ファイルをTempにコピー"""
-    for file_key, path in output_files.items():
-        if not path or not os.path.exists(path):
-            continue
+# 収束判定・集計に用いる列（成果物: 列）
+summary_columns = {
+    "area_analysis": ["is_closed", "car_access", "ped_access", "max_width"],
+    "routes": ["b_id", "r_found", "t_time", "t_dist"],
+}
 
-        filename = os.path.basename(path)
-        # "k"で始まるかチェック
-        if filename.lower().startswith("k"):
-            # 拡張子を取得
-            _, ext = os.path.splitext(filename)
-            ext = ext.lower()
 
-            try:
-                if ext == ".shp":
-                    # シェープファイルのコピー (.shp, .shx, .dbf, .prj, .cpg)
-                    base = path[:-4]  # ".shp" を除いた部分
-                    for add_ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
-                        shp_part = base + add_ext
-                        if os.path.exists(shp_part):
-                            shutil.copy(shp_part, temp_dir)
-                elif ext == ".geojson":
-                    # GeoJSONは単一ファイルをコピー
-                    shutil.copy(path, temp_dir)
+def load_inputs():
+    """静的な入力データを一度だけ読み込み、影響表を準備"""
+    inputs = {
+        "buildings": build_destroy.load_buildings(building_input_path, input_cache_dir),
+        "road_polygons": read_cached(road_polygon_path, input_cache_dir),
+        "road_lines": read_cached(road_line_path, input_cache_dir),
+        "shelters": read_cached(shelter_path, input_cache_dir),
+    }
+
+    inputs["static_areas"] = area_analysis.cached_static_quantities(
+        inputs["road_polygons"], inputs["road_lines"], [road_polygon_path, road_line_path], static_cache_dir
+    )
+
+    if use_base_topology:
+        inputs["topology"] = node_edge3.BaseTopology(inputs["road_lines"])
+
+    inputs["impact_table"], inputs["impact_table_path"] = cross_analysis7.cached_impact_table(
+        inputs["road_polygons"], inputs["buildings"], impact_table_path, [building_input_path, road_polygon_path]
+    )
+
+    if tile_size is not None:
+        inputs["tiles"] = tiling.TiledAnalysis(
+            inputs["road_polygons"], inputs["road_lines"], inputs["buildings"], inputs["static_areas"],
+            inputs["impact_table"], tile_size, n_workers=tile_workers,
+        )
+
+    return inputs
+
+
+def run_iteration(inputs, collapse_matrix, collapse_polygons, realization, recorder=None):
+    """1反復分の各段階をメモリ上で順に実行し、各段階の成果物を返す（recorder に段階ごとの実行時間・件数を記録）"""
+    if recorder is None:
+        recorder = run_profile.StageRecorder()
+    results = {}
+    tiles = inputs.get("tiles")
+    with recorder.stage("destruction") as counters:
+        results["destruction"] = build_destroy.realize_destruction(
+            inputs["buildings"], collapse_matrix, collapse_polygons, realization
+        )
+        counters["collapsed_buildings"] = int(results["destruction"]["倒壊結果"].sum())
+    with recorder.stage("reductions") as counters:
+        if tiles is not None:
+            # タイル分割モードでは残存面積もタイルごとに同時に計算
+            results["reductions"], tiled_areas = tiles.analyze(results["destruction"])
+        else:
+            results["reductions"] = cross_analysis7.analyze_width_reductions(
+                inputs["road_polygons"], results["destruction"], inputs["impact_table"]
+            )
+        counters["candidate_pairs"] = results["reductions"].attrs.get("candidate_pairs", 0)
+        counters["closed_roads"] = int(results["reductions"]["is_closed"].sum())
+    with recorder.stage("area_analysis") as counters:
+        if tiles is not None:
+            results["area_analysis"] = tiled_areas
+        else:
+            results["area_analysis"] = area_analysis.analyze_remaining_area(
+                results["reductions"], inputs["road_lines"], results["destruction"], inputs["impact_table"],
+                inputs["static_areas"],
+            )
+        counters["car_blocked_roads"] = int((~results["area_analysis"]["car_access"]).sum())
+        counters["ped_blocked_roads"] = int((~results["area_analysis"]["ped_access"]).sum())
+    with recorder.stage("split_roads") as counters:
+        if tiles is not None:
+            results["split_roads"] = tiles.split(results["area_analysis"], results["destruction"])
+        else:
+            results["split_roads"] = closedpoint2.split_centerlines(
+                inputs["road_lines"], results["area_analysis"], results["destruction"]
+            )
+        counters["segments"] = len(results["split_roads"])
+    with recorder.stage("topology") as counters:
+        if use_base_topology:
+            results["nodes"], results["edges"] = inputs["topology"].apply(results["split_roads"])
+            if verify_base_topology and not node_edge3.same_topology(
+                results["nodes"], results["edges"], *node_edge3.build_nodes_edges(results["split_roads"])
+            ):
+                raise ValueError("元のノード・エッジに変更を反映した結果が、作り直した場合と一致しません")
+        else:
+            results["nodes"], results["edges"] = node_edge3.build_nodes_edges(results["split_roads"])
+        counters["nodes"] = len(results["nodes"])
+        counters["edges"] = len(results["edges"])
+    with recorder.stage("routes") as counters:
+        results["routes"] = NetworkX7.compute_routes(
+            results["nodes"], results["edges"], results["destruction"], inputs["shelters"], backend=routing_backend
+        )
+        counters["dijkstra_runs"] = results["routes"].attrs.get("dijkstra_runs", 0)
+        counters["route_start_nodes"] = results["routes"].attrs.get("start_nodes", 0)
+        counters["routes_found"] = int(results["routes"]["r_found"].sum()) if len(results["routes"]) else 0
+    return results
+
+
+def varying_entities(inputs):
+    """
+    反復によって結果が変わりうる道路ポリゴン・建物を求めます（結果が変わらないものは収束判定の対象外）。
+      道路ポリゴン: 影響表に全壊率が 0 より大きく 1 未満の建物があるもの（それ以外は倒壊結果が反復によらない）
+      建物: 空き家以外（空き家はルート検索をしないため、どの反復でもルートがない）
+
+    Parameters:
+        inputs (dict): load_inputs の結果
+
+    Returns:
+        tuple: (道路ポリゴンの行位置の配列, 建物IDの配列)
+    """
+    buildings = inputs["buildings"]
+    zenkai = buildings["zenkai"].to_numpy(dtype=float)
+    uncertain = (zenkai > 0) & (zenkai < 1)
+    impact_table = inputs["impact_table"]
+    roads = np.unique(impact_table["road_idx"].to_numpy()[uncertain[impact_table["building_idx"].to_numpy()]])
+    return roads, buildings.loc[~buildings["akiya"].astype(bool), "id"].to_numpy()
+
+
+def collect_outputs(results):
+    """CSV出力と収束判定に必要な列のみを各段階の成果物から取り出す（プロセス間の受け渡し量を抑える）"""
+    columns = {}
+    for result_key, cols in list(csv_outputs.values()) + list(summary_columns.items()):
+        for col in cols:
+            if col not in columns.setdefault(result_key, []):
+                columns[result_key].append(col)
+    outputs = {key: pd.DataFrame(results[key]).reindex(columns=cols) for key, cols in columns.items()}
+    outputs["edge_usage"] = NetworkX7.count_edge_usage(results["routes"], results["edges"])
+    return outputs
+
+
+def process_iteration(inputs, collapse_matrix, collapse_polygons, iteration):
+    """
+    1反復を実行し、反復ごとの状態の保存（有効な場合）を行って集計用の列と段階ごとの記録（"profile"）を返す。
+    失敗した場合は、失敗した段階とトレースバックを含む記録を例外の profile 属性に付けて送出する。
+    """
+    recorder = run_profile.StageRecorder(iteration)
+    profiler = cProfile.Profile() if iteration == profile_iteration else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        results = run_iteration(inputs, collapse_matrix, collapse_polygons, iteration - 1, recorder)
+        if write_iteration_records:
+            with recorder.stage("write_record"):
+                write_iteration_record(results, inputs, iteration)
+        with recorder.stage("collect_outputs"):
+            outputs = collect_outputs(results)
+    except Exception as e:
+        e.profile = recorder.as_dict()
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_path = os.path.join(os.path.dirname(manifest_path), f"{str(iteration).zfill(4)}_szok_profile.prof")
+            profiler.dump_stats(profile_path)
+            print(f"Profile written: {profile_path}")
+    outputs["profile"] = recorder.as_dict()
+    return outputs
+
+
+# 並列実行時に各プロセスが保持する静的データ（プロセス起動時に一度だけ受け取る）
+_worker_state = {}
+
 
+def _init_worker(inputs, collapse_matrix, collapse_polygons):
+    _worker_state["inputs"] = inputs
+    _worker_state["collapse_matrix"] = collapse_matrix
+    _worker_state["collapse_polygons"] = collapse_polygons
+
+
+def _run_in_worker(iteration):
+    return process_iteration(
+        _worker_state["inputs"], _worker_state["collapse_matrix"], _worker_state["collapse_polygons"], iteration
+    )
+
+
+def iterate_outputs(inputs, collapse_matrix, collapse_polygons, start=1):
+    """
+    start 番目以降の各反復を実行し、反復番号の順に (反復番号, 集計用の列, 例外) を返すジェネレータ。
+    n_workers > 1 の場合はプロセスプールで先行して実行し、完了順によらず反復番号の順に返す。
+    途中で終了（早期終了）した場合、未着手の反復は取り消す。
+    """
+    if n_workers <= 1:
+        for iteration in range(start, iterations + 1):
+            try:
+                yield iteration, process_iteration(inputs, collapse_matrix, collapse_polygons, iteration), None
             except Exception as e:
-                print(f"Error copying {path}: {e}")
-
-def rename_files_in_temp(iteration):
-    """Tempフォルダ内の"k"から始まるファイルをリネーム"""
-    failed_renames = []  # リネームに失敗したファイルを記録するリスト
-    for file_name in os.listdir(temp_dir):
-        if file_name.lower().startswith("k"):  # 大文字・小文字を無視
-            original_path = os.path.join(temp_dir, file_name)
-            base, ext = os.path.splitext(file_name)
-            renamed = f"{str(iteration).zfill(4)}_{file_name}"
-            renamed_path = os.path.join(temp_dir, renamed)
+                yield iteration, None, e
+        return
+
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_worker, initargs=(inputs, collapse_matrix, collapse_polygons)
+    )
+    pending = {}
+    next_iteration = start
+    try:
+        for iteration in range(start, iterations + 1):
+            # 結果を溜め込みすぎないよう、先行して投入する反復数はプロセス数の2倍まで
+            while next_iteration <= iterations and len(pending) < 2 * n_workers:
+                pending[next_iteration] = executor.submit(_run_in_worker, next_iteration)
+                next_iteration += 1
+
+            future = pending.pop(iteration)
             try:
-                shutil.move(original_path, renamed_path)
-                # print(f"Renamed: {file_name} -> {renamed}")
+                outputs = future.result()
             except Exception as e:
-                print(f"Error renaming {file_name}: {e}")
-                failed_renames.append(file_name)
-    
-    # 失敗したファイルをログに出力
-    if failed_renames:
-        print(f"Failed to rename the following files: {failed_renames}")
+                yield iteration, None, e
+                continue
+            yield iteration, outputs, None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
 
-def move_files_to_simulation():
-    """Tempフォルダ内のファイルをSimulationフォルダに移動"""
-    for file_name in os.listdir(temp_dir):
-        try:
-            shutil.move(os.path.join(temp_dir, file_name), simulation_dir)
-        except Exception as e:
-            print(f"Error moving {file_name}: {e}")
+def write_iteration_record(results, inputs, iteration):
+    """反復ごとの状態を反復番号付きのファイル名でSimulationフォルダに保存（保存に失敗した反復は失敗として扱う）"""
+    record = iteration_record.build_record(
+        results, inputs["buildings"], inputs["road_polygons"], iteration,
+        settings={"use_base_topology": use_base_topology, "routing_backend": routing_backend},
+    )
+    iteration_record.save_record(iteration_record.record_path(simulation_dir, iteration), record)
 
-# 修正されたCSV出力関数
-def extract_to_csv(temp_path, columns, output_csv, iteration):
-    """Temp内のファイルを使ってCSVを作成・更新"""
-    try:
-        # まず拡張子判定
-        _, ext = os.path.splitext(temp_path)
-        ext = ext.lower()
-        
-        if ext not in [".geojson", ".shp"]:
-            raise ValueError(f"Unsupported file format for {temp_path}. Only .geojson or .shp is supported.")
-        # GeoDataFrame 読み込み
-        gdf = gpd.read_file(temp_path, encoding="utf-8")
-
-        # 路線IDが含まれる場合のみnotna()を適用
-        if "路線ID" in columns:
-            gdf = gdf[gdf["路線ID"].notna()]
-
-        # 必要な列を選択
-        selected = gdf[columns]
-
-        # 初回のCSV作成
-        if iteration == 1 or not os.path.exists(output_csv):
-            selected.columns = [columns[0]] + [str(iteration) if col != columns[0] else col for col in columns[1:]]
-            selected.to_csv(output_csv, index=False, encoding="utf-8")
-            # print(f"CSV file created: {output_csv}")
-        else:
-            # 既存のCSVファイルに新しい列を追加
-            existing = pd.read_csv(output_csv, encoding="utf-8")
-            new_data = selected.rename(columns={columns[1]: str(iteration)})
-            merged = pd.merge(existing, new_data, on=columns[0], how="left")
-            merged.to_csv(output_csv, index=False, encoding="utf-8")
-            print(f"CSV file updated: {output_csv}")
-
-    except ValueError as ve:
-        print(f"ValueError: {ve}")
-    except FileNotFoundError:
-        print(f"Temp file not found: {temp_path}")
-    except KeyError as e:
-        print(f"KeyError during CSV extraction: {e}")
-    except Exception as e:
-        print(f"Error extracting to CSV for {temp_path}: {e}")
 
-# メイン処理
-while iteration_counter < iterations:
-    iteration_counter += 1  # カウンターをインクリメント
-    print(f"=== Iteration {iteration_counter} started ===")
+def store_results(store, results, iteration):
+    """各反復の成果物から、CSV出力対象の列を結果ストアに追記"""
+    frames = []
+    for result_key, (key_column, value_column) in csv_outputs.values():
+        frames.append((results[result_key], key_column, value_column))
+    store.append(iteration, frames)
+
 
-    # 各スクリプトを順次実行
-    for script in scripts:
+def write_csv_outputs(store):
+    """結果ストアから項目ごとの横持ちCSV（行: エンティティ、列: 反復番号）を作成"""
+    for csv_name, (_, (key_column, value_column)) in csv_outputs.items():
+        output_csv = os.path.join(csv_output_dir, csv_name)
         try:
-            print(f"Executing: {script}")
-            exec(open(script, encoding="utf-8").read())
+            store.write_csv(value_column, key_column, output_csv)
+            print(f"CSV file created: {output_csv}")
         except Exception as e:
-            print(f"Error occurred while executing {script}: {e}")
+            print(f"Error writing CSV {output_csv}: {e}")
+
+
+def write_summary(summary, inputs):
+    """全反復の集計結果を道路ポリゴン・建物・道路中心線のジオメトリと結合して GeoPackage に書き出す"""
+    road_polygons = inputs["road_polygons"][["路線ID", "geometry"]].reset_index(drop=True)
+    roads = road_polygons.join(summary.road_summary().reset_index(drop=True))
+
+    buildings = inputs["buildings"][["id", "geometry"]]
+    buildings = buildings.join(summary.building_summary(), on="id")
+
+    road_lines = inputs["road_lines"][["路線ID", "geometry"]]
+    road_lines = road_lines.join(summary.line_summary(), on="路線ID")
+
+    if os.path.exists(summary_output_path):
+        os.remove(summary_output_path)
+    for layer, gdf in (("roads", roads), ("buildings", buildings), ("road_lines", road_lines)):
+        gdf.to_file(summary_output_path, layer=layer, driver="GPKG", encoding="utf-8")
+    print(f"Summary written: {summary_output_path}")
+
+
+def statistics_update(results):
+    """1反復の結果から集計値の更新に使う列を取り出す（チェックポイントに反復ごとに保存し、再開時に再適用する）"""
+    area_result, route_result = results["area_analysis"], results["routes"]
+    return {
+        "roads": area_result[["is_closed", "car_access", "ped_access", "max_width"]],
+        "buildings": route_result[["b_id", "r_found", "t_time", "t_dist"]],
+        "edge_usage": results["edge_usage"],
+    }
+
+
+def update_statistics(monitor, summary, update, iteration):
+    """1反復分の集計値の更新分を収束判定と集計値に追加"""
+    roads, buildings = update["roads"], update["buildings"]
+    summary.update(roads.index, roads, buildings["b_id"], buildings, update["edge_usage"])
+    monitor.update(roads.index, roads["is_closed"],
+                   buildings["b_id"], buildings["r_found"], buildings["t_time"], iteration)
+
+
+def save_checkpoint(state, store):
+    """完了・失敗した反復番号と結果ストアの行数をチェックポイントに保存（反復ごとに保存）"""
+    state["result_rows"] = store.row_count()
+    checkpoint.save_checkpoint(checkpoint_path, state)
+
+
+def save_aggregates(state, monitor, summary):
+    """集計の途中状態を保存し、保存した反復までの集計値の更新分を削除（保存した反復番号を返す）"""
+    iteration = max(state["completed"] + state["failed"], default=0)
+    checkpoint.save_aggregates(checkpoint_path, {"iteration": iteration, "monitor": monitor, "summary": summary})
+    return iteration
+
+
+def main():
+    if tile_size is not None and n_workers > 1 and tile_workers > 1:
+        raise ValueError("n_workers と tile_workers を同時に 2 以上にすることはできません")
+    os.makedirs(csv_output_dir, exist_ok=True)
+    started = datetime.now().isoformat(timespec="seconds")
+    setup = run_profile.StageRecorder()
+
+    # 静的な入力データの読み込み（反復ごとには読み込まない）
+    with setup.stage("load_inputs") as counters:
+        inputs = load_inputs()
+        counters["buildings"] = len(inputs["buildings"])
+        counters["road_polygons"] = len(inputs["road_polygons"])
+        counters["road_lines"] = len(inputs["road_lines"])
+        counters["impact_pairs"] = len(inputs["impact_table"])
+        counters["tiles"] = len(inputs["tiles"].tiles) if "tiles" in inputs else 0
+    base_buildings = inputs["buildings"]
+
+    # 全反復分の倒壊判定を一括で行い、倒壊範囲バッファは一度でも倒壊する建物についてのみ一度だけ作成
+    # （第 n 反復は build_destroy.py の REALIZATION = n - 1 で単体再現できる）
+    with setup.stage("sample_collapse") as counters:
+        collapse_keys = base_buildings["id"] if common_random_numbers else None
+        collapse_matrix = build_destroy.sample_collapse(
+            base_buildings["zenkai"], iterations, seed, sampling_method, collapse_keys
+        )
+        collapse_polygons = build_destroy.buffer_collapse_polygons(base_buildings, collapse_matrix)
+        counters["ever_collapsed_buildings"] = int(collapse_matrix.any(axis=1).sum())
+    print(f"Collapse outcomes sampled for {iterations} iterations "
+          f"(seed={seed}, method={sampling_method}, common_random_numbers={common_random_numbers}).")
+
+    # plain（独立な一様乱数）に対する倒壊判定の分散低減率を報告（指定した場合のみ）
+    if variance_reduction_replicates > 0 and sampling_method != "plain":
+        with setup.stage("variance_reduction"):
+            reduction = build_destroy.variance_reduction(
+                base_buildings["zenkai"], iterations, sampling_method, seed, collapse_keys,
+                replicates=variance_reduction_replicates,
+            )
+        print(f"Collapse sampling variance reduction vs plain sampling (inputs only): "
+              f"collapsed building count x{reduction['collapsed_count']:.2f}, "
+              f"per-building collapse frequency x{reduction['building_frequency']:.2f}")
+
+    # 再開時に中断前と同じ実行かを確認するための設定、倒壊判定行列と入力データの内容のハッシュ
+    run_config = {
+        "iterations": iterations, "seed": seed, "sampling_method": sampling_method,
+        "common_random_numbers": common_random_numbers, "use_base_topology": use_base_topology,
+        "routing_backend": routing_backend, "adaptive_stopping": adaptive_stopping,
+        "collapse_digest": checkpoint.collapse_digest(collapse_matrix),
+        "input_hashes": {
+            path: source_hash([path])
+            for path in (building_input_path, road_polygon_path, road_line_path, shelter_path)
+        },
+    }
+    state = checkpoint.load_checkpoint(checkpoint_path) if resume else None
+    if resume and state is None:
+        print(f"No checkpoint found at {checkpoint_path}; starting from iteration 1.")
+
+    if state is not None:
+        # チェックポイント後に追記された結果を取り消す
+        if state["config"] != run_config:
+            raise ValueError("チェックポイントの設定（反復回数・乱数・倒壊判定・入力データ）が現在の設定と一致しません")
+        store = ResultStore(result_store_path, overwrite=False)
+        store.truncate(state["result_rows"])
+        aggregates = checkpoint.load_checkpoint(checkpoint.aggregates_path(checkpoint_path))
+        print(f"Resuming after iteration {state['completed'][-1] if state['completed'] else 0} "
+              f"({len(state['completed'])} completed, {len(state['failed'])} failed).")
+    else:
+        # 前回の実行のチェックポイントを削除し、結果ストア（反復ごとに1回追記）を作り直す
+        checkpoint.remove_checkpoint(checkpoint_path)
+        store = ResultStore(result_store_path)
+        state = {"config": run_config, "completed": [], "failed": [], "result_rows": 0, "converged": False}
+        aggregates = None
+    state.setdefault("profiles", [])
+
+    if aggregates is not None:
+        # 集計の途中状態を復元
+        monitor, summary = aggregates["monitor"], aggregates["summary"]
+    else:
+        # 閉塞確率・ルート発見率・平均移動時間の収束判定（道路ポリゴンは行位置、建物は建物IDで識別）
+        # 反復によって結果が変わらない道路ポリゴン・建物は対象外（観測のばらつきがなくても信頼区間の半幅が縮まないため）
+        with setup.stage("varying_entities") as counters:
+            monitored_roads, monitored_buildings = varying_entities(inputs)
+            counters["monitored_roads"] = len(monitored_roads)
+            counters["monitored_buildings"] = len(monitored_buildings)
+        monitor = ConvergenceMonitor(
+            monitored_roads, monitored_buildings,
+            tolerance=convergence_tolerance, time_tolerance=t_time_tolerance,
+            confidence=confidence_level, min_iterations=min_iterations, paired=sampling_method == "antithetic",
+        )
+
+        # 道路ポリゴン・建物・道路中心線ごとの集計値（各反復の結果は保持せずに逐次更新）
+        summary = SimulationSummary(
+            range(len(inputs["road_polygons"])), base_buildings["id"], inputs["road_lines"]["路線ID"].astype(str),
+            quantiles=summary_quantiles,
+        )
+        aggregates = {"iteration": 0}
+
+    # 集計の途中状態を保存した後に完了した反復の集計値の更新分を再適用
+    for iteration in state["completed"]:
+        if iteration > aggregates["iteration"]:
+            update_statistics(monitor, summary, checkpoint.load_update(checkpoint_path, iteration), iteration)
+
+    # 実行マニフェストの実行情報（入力データは内容のハッシュで識別）
+    run_info = {
+        "started": started,
+        "resumed": resume and bool(state["completed"] or state["failed"]),
+        "config": {
+            **{key: value for key, value in run_config.items() if key != "input_hashes"},
+            "n_workers": n_workers, "write_iteration_records": write_iteration_records,
+            "tile_size": tile_size, "tile_workers": tile_workers,
+        },
+        "input_hashes": {
+            **run_config["input_hashes"],
+            inputs["impact_table_path"]: source_hash([inputs["impact_table_path"]]),
+        },
+        "python": sys.version,
+        "platform": platform.platform(),
+        "setup": setup.as_dict(),
+    }
+
+    # メイン処理（各段階をメモリ上で実行。並列実行時も集計は反復番号の順に行う）
+    start = max(state["completed"] + state["failed"], default=0) + 1
+    if state["converged"]:
+        start = iterations + 1
+    print(f"Running iterations {start}-{iterations} with {max(n_workers, 1)} worker process(es).")
+    outputs_by_iteration = iterate_outputs(inputs, collapse_matrix, collapse_polygons, start)
+    saved_iteration = aggregates["iteration"]
+    for iteration_counter, results, error in outputs_by_iteration:
+        if error is not None:
+            # 失敗した段階とトレースバックをマニフェストに記録
+            print(f"Error occurred in iteration {iteration_counter}: {error}")
+            profile = getattr(error, "profile", None) or {"iteration": iteration_counter, "stages": []}
+            profile["error"] = "".join(traceback.format_exception(error))
+            state["profiles"].append(profile)
+            state["failed"].append(iteration_counter)
+            save_checkpoint(state, store)
+            if iteration_counter % checkpoint_interval == 0:
+                saved_iteration = save_aggregates(state, monitor, summary)
+            continue
+
+        # 結果ストアに追記
+        profile = results.pop("profile")
+        recorder = run_profile.StageRecorder(iteration_counter)
+        with recorder.stage("store_results"):
+            store_results(store, results, iteration_counter)
+
+        print(f"=== Iteration {iteration_counter} completed ===")
+
+        # 閉塞確率・ルート発見率・平均移動時間の推定値を更新し、信頼区間の半幅を報告
+        with recorder.stage("update_statistics"):
+            update = statistics_update(results)
+            update_statistics(monitor, summary, update, iteration_counter)
+        half_widths = monitor.worst_half_widths()
+        print(f"Worst {confidence_level:.0%} CI half-width: is_closed={half_widths['is_closed']:.4f}, "
+              f"r_found={half_widths['r_found']:.4f}, t_time={half_widths['t_time']:.3f} min")
+
+        profile["stages"] += recorder.stages
+        state["profiles"].append(profile)
+        state["completed"].append(iteration_counter)
+        state["converged"] = adaptive_stopping and monitor.converged(iteration_counter)
+
+        # 集計値の更新分と完了した反復番号を保存し、一定の反復ごとに集計の途中状態を保存
+        checkpoint.save_update(checkpoint_path, iteration_counter, update)
+        save_checkpoint(state, store)
+        if iteration_counter % checkpoint_interval == 0:
+            saved_iteration = save_aggregates(state, monitor, summary)
+
+        if state["converged"]:
+            print(f"=== Converged after {iteration_counter} iterations ===")
+            outputs_by_iteration.close()
+            break
+
+    # 最後に集計の途中状態を保存した後の反復があれば保存
+    if max(state["completed"] + state["failed"], default=0) > saved_iteration:
+        save_aggregates(state, monitor, summary)
+
+    # 対称変量法の、閉塞確率・ルート発見率の推定値の二項分散 p(1-p)/n に対する分散低減率を報告
+    if monitor.pairs is not None:
+        run_info["variance_reduction"] = monitor.variance_reduction()
+        print(f"Variance reduction vs plain sampling: is_closed x{run_info['variance_reduction']['is_closed']:.2f}, "
+              f"r_found x{run_info['variance_reduction']['r_found']:.2f}")
 
-    # Tempフォルダをクリア
-    #for file in os.listdir(temp_dir):
-    #    try:
-    #        os.remove(os.path.join(temp_dir, file))
-    #    except Exception as e:
-    #        print(f"Error clearing Temp folder: {e}")
+    # 項目ごとの横持ちCSVを作成
+    finish = run_profile.StageRecorder()
+    with finish.stage("write_csv"):
+        write_csv_outputs(store)
+        store.close()
 
-    # 成果物をTempフォルダにコピー
-    copy_files_to_temp()
+    # 集計結果の GeoPackage を作成
+    with finish.stage("write_summary"):
+        write_summary(summary, inputs)
 
-    # CSVファイルを作成・更新
-    print(f"Extracting data to CSV for iteration {iteration_counter}...")
-    for csv_name, (file_key, cols) in csv_outputs.items():
-        temp_file_path = os.path.join(temp_dir, os.path.basename(output_files[file_key]))
-        if os.path.exists(temp_file_path):
-            extract_to_csv(temp_file_path, cols, os.path.join(csv_output_dir, csv_name), iteration_counter)
+    if "tiles" in inputs:
+        inputs["tiles"].close()
 
-    # Tempフォルダ内でファイルをリネーム
-    rename_files_in_temp(iteration_counter)
+    # 実行マニフェストを作成
+    run_info.update(
+        finished=datetime.now().isoformat(timespec="seconds"),
+        completed=len(state["completed"]), failed=state["failed"], converged=state["converged"],
+        finish=finish.as_dict(),
+    )
+    run_profile.write_manifest(manifest_path, run_info, state["profiles"])
+    print(f"Run manifest written: {manifest_path}")
 
-    # TempフォルダからSimulationフォルダに移動
-    move_files_to_simulation()
 
-    print(f"=== Iteration {iteration_counter} completed ===")
+if __name__ == "__main__":
+    if "--resume" in sys.argv[1:]:
+        resume = True
+    main()
@@ -0,0 +1,319 @@
+# 合成した街区データ（建物数 1千〜100万棟、EPSG:6676）で各段階と1反復全体の実行時間を計測し、
+# 規模ごとのスループット（建物数/秒）をコミットごとに記録して、別のコミットの計測結果と比較する。
+import math
+import os
+import subprocess
+from datetime import datetime
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import batch_simulation8 as batch
+import build_destroy
+import cross_analysis7
+import area_analysis
+import node_edge3
+import rosenID_posting_width
+import run_profile
+
+# 計測する規模（建物数）
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# 1反復の計測回数（段階ごとの中央値を記録）と、合成データの乱数シード
+REPEATS = 3
+SEED = 1
+
+# 計測結果の保存先（実行ごとに追記）と、スループット曲線の図（matplotlib がある場合のみ作成）
+RESULTS_PATH = r"C:\szok\benchmark\benchmark_results.csv"
+PLOT_PATH = r"C:\szok\benchmark\benchmark_throughput.png"
+
+# 比較対象のコミット（None の場合は計測結果に記録されている直前の別のコミット）
+BASELINE_COMMIT = None
+
+# 段階ごとに計測する最大の建物数（例: {"rosenID_posting_width": 20_000}。指定のない段階はすべての規模で計測）
+STAGE_MAX_BUILDINGS = {}
+
+# 合成データの形状
+BLOCK_SIZE = 60.0               # 道路中心線の間隔（m）
+STREET_HALF_WIDTH = (1.0, 4.0)  # 道路の半幅の範囲（m）
+SLOTS_PER_SIDE = 6              # 街区の1辺に並ぶ建物の区画数
+OCCUPANCY = 0.8                 # 区画に建物がある割合
+BUILDING_DEPTH = (6.0, 10.0)    # 建物の奥行きの範囲（m）
+SETBACK = (0.5, 3.0)            # 道路からの後退距離の範囲（m）
+BUILDINGS_PER_SHELTER = 2000    # 避難所1か所あたりの建物数
+ORIGIN = (-30000.0, -120000.0)  # 合成データの原点（EPSG:6676）
+
+# 段階名と対応するスクリプト（1反復の段階名は batch_simulation8.run_iteration の記録名）
+STAGE_MODULES = {
+    "rosenID_posting_width": "rosenID_posting_width",
+    "impact_table": "cross_analysis7",
+    "static_quantities": "area_analysis",
+    "base_topology": "node_edge3",
+    "collapse_sampling": "build_destroy",
+    "destruction": "build_destroy",
+    "reductions": "cross_analysis7",
+    "area_analysis": "area_analysis",
+    "split_roads": "closedpoint2",
+    "topology": "node_edge3",
+    "routes": "NetworkX7",
+    "full_iteration": "batch_simulation8",
+}
+
+
+def _ids(prefix, n, width=7):
+    return (prefix + pd.Series(np.arange(1, n + 1)).astype(str).str.zfill(width)).to_numpy(dtype=object)
+
+
+def generate_city(n_buildings, seed=SEED):
+    """
+    格子状の道路網と、街区の外周に沿って並ぶ建物からなる合成データを作成します。
+    道路ポリゴンは道路区間ごと（路線ID・道路幅あり）と交差点ごと（路線ID なし）に作成します。
+
+    Parameters:
+        n_buildings (int): 建物数
+        seed (int): 乱数シード
+
+    Returns:
+        dict: road_lines, road_polygons, buildings, shelters（いずれも EPSG:6676 の GeoDataFrame）
+    """
+    rng = np.random.default_rng(seed)
+    n_blocks = math.ceil(math.sqrt(n_buildings / (4 * SLOTS_PER_SIDE * OCCUPANCY)))
+    ox, oy, s = ORIGIN[0], ORIGIN[1], BLOCK_SIZE
+    half_h = rng.uniform(*STREET_HALF_WIDTH, n_blocks + 1)  # 東西方向の道路（行ごと）の半幅
+    half_v = rng.uniform(*STREET_HALF_WIDTH, n_blocks + 1)  # 南北方向の道路（列ごと）の半幅
+
+    # 東西方向の道路区間（列 i から i + 1、行 j）と南北方向の道路区間（列 i、行 j から j + 1）
+    hi, hj = [a.ravel() for a in np.meshgrid(np.arange(n_blocks), np.arange(n_blocks + 1))]
+    vi, vj = [a.ravel() for a in np.meshgrid(np.arange(n_blocks + 1), np.arange(n_blocks))]
+    starts = np.concatenate([np.column_stack([hi * s, hj * s]), np.column_stack([vi * s, vj * s])])
+    ends = np.concatenate([np.column_stack([(hi + 1) * s, hj * s]), np.column_stack([vi * s, (vj + 1) * s])])
+    widths = np.concatenate([2 * half_h[hj], 2 * half_v[vi]])
+    segment_polygons = np.concatenate([
+        shapely.box(ox + hi * s + half_v[hi], oy + hj * s - half_h[hj],
+                    ox + (hi + 1) * s - half_v[hi + 1], oy + hj * s + half_h[hj]),
+        shapely.box(ox + vi * s - half_v[vi], oy + vj * s + half_h[vj],
+                    ox + vi * s + half_v[vi], oy + (vj + 1) * s - half_h[vj + 1]),
+    ])
+    route_ids = _ids("R", len(starts))
+    road_lines = gpd.GeoDataFrame(
+        {"路線ID": route_ids, "道路幅": widths},
+        geometry=shapely.linestrings(np.stack([starts + ORIGIN, ends + ORIGIN], axis=1)), crs=6676,
+    )
+
+    ni, nj = [a.ravel() for a in np.meshgrid(np.arange(n_blocks + 1), np.arange(n_blocks + 1))]
+    intersection_polygons = shapely.box(ox + ni * s - half_v[ni], oy + nj * s - half_h[nj],
+                                        ox + ni * s + half_v[ni], oy + nj * s + half_h[nj])
+    road_polygons = gpd.GeoDataFrame(
+        {
+            "路線ID": np.concatenate([route_ids, np.full(len(intersection_polygons), None, dtype=object)]),
+            "道路幅": np.concatenate([widths, np.full(len(intersection_polygons), np.nan)]),
+        },
+        geometry=np.concatenate([segment_polygons, intersection_polygons]), crs=6676,
+    )
+
+    # 街区（列 bi、行 bj）の内側の範囲と、外周の4辺に並ぶ区画（辺 0: 南, 1: 北, 2: 西, 3: 東）
+    bi, bj, side, slot = [a.ravel() for a in np.meshgrid(
+        np.arange(n_blocks), np.arange(n_blocks), np.arange(4), np.arange(SLOTS_PER_SIDE), indexing="ij"
+    )]
+    x0, x1 = ox + bi * s + half_v[bi], ox + (bi + 1) * s - half_v[bi + 1]
+    y0, y1 = oy + bj * s + half_h[bj], oy + (bj + 1) * s - half_h[bj + 1]
+    depth = rng.uniform(*BUILDING_DEPTH, len(bi))
+    setback = rng.uniform(*SETBACK, len(bi))
+    along_x = side < 2
+    # 東西の辺の区画は南北の辺の建物と重ならないよう、奥行きと後退距離の最大値だけ内側に並べる
+    margin = BUILDING_DEPTH[1] + SETBACK[1]
+    lo = np.where(along_x, x0, y0 + margin)
+    slot_len = (np.where(along_x, x1, y1 - margin) - lo) / SLOTS_PER_SIDE
+    center = lo + (slot + 0.5) * slot_len
+    frontage = slot_len * rng.uniform(0.6, 0.9, len(bi))
+    inner = np.select(
+        [side == 0, side == 1, side == 2],
+        [y0 + setback, y1 - setback - depth, x0 + setback],
+        x1 - setback - depth,
+    )
+    geoms = np.where(
+        along_x,
+        shapely.box(center - frontage / 2, inner, center + frontage / 2, inner + depth),
+        shapely.box(inner, center - frontage / 2, inner + depth, center + frontage / 2),
+    )
+    chosen = np.sort(rng.choice(len(geoms), size=min(n_buildings, len(geoms)), replace=False))
+    buildings = gpd.GeoDataFrame(
+        {
+            "id": _ids("B", len(chosen)),
+            "zenkai": rng.beta(0.7, 3.0, len(chosen)),                              # 全壊率
+            "tokaihani": depth[chosen] * rng.uniform(0.3, 0.8, len(chosen)),        # 倒壊影響範囲（m）
+            "akiya": (rng.random(len(chosen)) < 0.1).astype("int32"),               # 空き家フラグ
+        },
+        geometry=geoms[chosen], crs=6676,
+    )
+
+    # 避難所（道路網の範囲内に一様に配置）
+    n_shelters = max(3, len(chosen) // BUILDINGS_PER_SHELTER)
+    shelter_xy = rng.uniform(0, n_blocks * s, (n_shelters, 2)) + ORIGIN
+    shelters = gpd.GeoDataFrame(
+        {"name": _ids("S", n_shelters, 4)}, geometry=shapely.points(shelter_xy), crs=6676
+    )
+    return {"road_lines": road_lines, "road_polygons": road_polygons, "buildings": buildings, "shelters": shelters}
+
+
+def current_commit():
+    """計測したコードのコミット（未コミットの変更がある場合は -dirty 付き）"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark_size(n_buildings, repeats=REPEATS, seed=SEED):
+    """
+    1つの規模について、準備処理の各段階を1回、1反復の各段階と1反復全体を repeats 回計測します。
+
+    Parameters:
+        n_buildings (int): 建物数
+        repeats (int): 1反復の計測回数
+        seed (int): 乱数シード
+
+    Returns:
+        DataFrame: 段階ごとの計測結果（stage, seconds, peak_rss_mb と規模の列）
+    """
+    city = generate_city(n_buildings, seed)
+    road_lines, road_polygons, buildings = city["road_lines"], city["road_polygons"], city["buildings"]
+
+    # 準備処理（入力データごとに1回）
+    setup = run_profile.StageRecorder()
+    if n_buildings <= STAGE_MAX_BUILDINGS.get("rosenID_posting_width", n_buildings):
+        with setup.stage("rosenID_posting_width"):
+            rosenID_posting_width.assign_route_ids(road_lines[["路線ID", "geometry"]], road_polygons[["geometry"]])
+    inputs = {"buildings": buildings, "road_polygons": road_polygons, "road_lines": road_lines,
+              "shelters": city["shelters"]}
+    with setup.stage("impact_table"):
+        inputs["impact_table"] = cross_analysis7.build_impact_table(road_polygons, buildings)
+    with setup.stage("static_quantities"):
+        inputs["static_areas"] = area_analysis.compute_static_quantities(road_polygons, road_lines)
+    if batch.use_base_topology:
+        with setup.stage("base_topology"):
+            inputs["topology"] = node_edge3.BaseTopology(road_lines)
+    with setup.stage("collapse_sampling"):
+        collapse_matrix = build_destroy.sample_collapse(buildings["zenkai"], repeats, seed)
+        collapse_polygons = build_destroy.buffer_collapse_polygons(buildings, collapse_matrix)
+
+    # 1反復（batch_simulation8 と同じ処理）を repeats 回実行
+    records = [setup.as_dict()]
+    for realization in range(repeats):
+        recorder = run_profile.StageRecorder(realization + 1)
+        with recorder.stage("full_iteration"):
+            batch.run_iteration(inputs, collapse_matrix, collapse_polygons, realization, recorder)
+        records.append(recorder.as_dict())
+
+    table = run_profile.stage_table(records)
+    result = table.groupby("stage", sort=False).agg(
+        seconds=("wall_s", "median"), peak_rss_mb=("peak_rss_mb", "max"), runs=("wall_s", "size")
+    ).reset_index()
+    result.insert(0, "n_buildings", len(buildings))
+    result["n_road_polygons"] = len(road_polygons)
+    result["n_road_lines"] = len(road_lines)
+    result["module"] = result["stage"].map(STAGE_MODULES)
+    result["buildings_per_s"] = len(buildings) / result["seconds"]
+    return result
+
+
+def run_benchmark(sizes=SIZES, repeats=REPEATS, seed=SEED, results_path=RESULTS_PATH):
+    """
+    各規模を計測し、コミット・日時・設定とともに計測結果のファイルに追記します。
+
+    Returns:
+        DataFrame: 今回の計測結果
+    """
+    commit = current_commit()
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    results = []
+    for n_buildings in sizes:
+        print(f"Benchmarking {n_buildings:,} buildings ...")
+        result = benchmark_size(n_buildings, repeats, seed)
+        result.insert(0, "commit", commit)
+        result.insert(1, "timestamp", timestamp)
+        result["routing_backend"] = batch.routing_backend
+        result["use_base_topology"] = batch.use_base_topology
+        results.append(result)
+        print(result[["stage", "seconds", "buildings_per_s"]].to_string(index=False))
+
+    results = pd.concat(results, ignore_index=True)
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    results.to_csv(results_path, mode="a", header=not os.path.exists(results_path), index=False, encoding="utf-8")
+    return results
+
+
+def throughput_curves(results):
+    """段階ごと（行）・規模ごと（列）のスループット（建物数/秒）の表"""
+    return results.pivot_table(index="stage", columns="n_buildings", values="buildings_per_s", sort=False)
+
+
+def compare_commits(all_results, commit, baseline=None):
+    """
+    2つのコミットの計測結果を段階・規模ごとに比較します（同じ条件の計測が複数ある場合は最新の結果）。
+
+    Parameters:
+        all_results (DataFrame): 計測結果のファイルの内容
+        commit (str): 比較するコミット
+        baseline (str): 比較対象のコミット（None の場合は commit より前に計測した直近の別のコミット）
+
+    Returns:
+        DataFrame: 段階・規模ごとの実行時間と比（commit / baseline。1 未満は高速化）と比較対象のコミット。
+            比較対象がない場合は None
+    """
+    if baseline is None:
+        measured = all_results.groupby("commit")["timestamp"].max()
+        earlier = measured.drop(commit, errors="ignore")
+        earlier = earlier[earlier <= measured.get(commit, earlier.max())]
+        if earlier.empty:
+            return None
+        baseline = earlier.idxmax()
+
+    def latest(c):
+        rows = all_results[all_results["commit"] == c].sort_values("timestamp")
+        return rows.drop_duplicates(["stage", "n_buildings"], keep="last").set_index(["stage", "n_buildings"])
+
+    joined = latest(baseline)[["seconds"]].join(latest(commit)[["seconds"]], how="inner", lsuffix="_base")
+    joined["ratio"] = joined["seconds"] / joined["seconds_base"]
+    joined["baseline"] = baseline
+    return joined.reset_index()
+
+
+def plot_throughput(results, output_path=PLOT_PATH):
+    """規模とスループットの関係を両対数の図に保存（matplotlib がない場合は作成しない）"""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed; skipping the throughput plot.")
+        return
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for stage, rows in results.groupby("stage", sort=False):
+        ax.plot(rows["n_buildings"], rows["buildings_per_s"], marker="o", label=stage)
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("buildings")
+    ax.set_ylabel("buildings / s")
+    ax.legend(fontsize="small")
+    fig.savefig(output_path, dpi=120, bbox_inches="tight")
+    plt.close(fig)
+    print(f"Throughput plot written: {output_path}")
+
+
+if __name__ == "__main__":
+    results = run_benchmark()
+
+    print("\nThroughput (buildings / s):")
+    print(throughput_curves(results).to_string(float_format=lambda v: f"{v:,.0f}"))
+    plot_throughput(results)
+
+    comparison = compare_commits(pd.read_csv(RESULTS_PATH, encoding="utf-8"), results["commit"].iloc[0],
+                                 BASELINE_COMMIT)
+    if comparison is not None:
+        print(f"\nTime ratio vs {comparison['baseline'].iloc[0]} (< 1 is faster):")
+        print(comparison.pivot_table(index="stage", columns="n_buildings", values="ratio", sort=False)
+              .to_string(float_format=lambda v: f"{v:.2f}"))
@@ -1,36 +1,241 @@
 # 全壊率に基づき建物の全壊シミュレーションを行う。建物高さ、階層から、周囲への影響範囲を指定して建物にバッファを発生させる。
 import geopandas as gpd
-import random
+import numpy as np
+import pandas as pd
+import shapely
+from input_cache import INPUT_CACHE_DIR, read_cached
 
-# ファイルパス
-input_path = r"C:\szok\import\szoksrg_plateau_zenkairitsu.geojson"
-output_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+# 乱数シード（同じシードであれば任意の反復の倒壊結果を完全に再現できる）
+SEED = 20240401
 
-# データの読み込み
-buildings = gpd.read_file(input_path)
+# 単体実行時に書き出す反復番号（0始まり）。batch_simulation8.py の第 n 反復は REALIZATION = n - 1 で再現できる
+REALIZATION = 0
+# 反復回数（"lhs" は反復回数によって乱数が変わるため、batch_simulation8.py の iterations と揃える）
+N_REALIZATIONS = 100
 
-# 無効なジオメトリを除外
-buildings = buildings[~buildings.is_empty & buildings.is_valid]
+# 倒壊判定の乱数の生成方法
+#   "plain"      : 独立な一様乱数
+#   "lhs"        : ラテン超方格法（建物ごとに反復方向へ層化した一様乱数）
+#   "antithetic" : 対称変量法（反復 2m と 2m+1 で u と 1-u を使用）
+SAMPLING_METHOD = "plain"
+SAMPLING_METHODS = ("plain", "lhs", "antithetic")
 
-# 倒壊結果列を初期化
-buildings["倒壊結果"] = 0  # 0: 倒壊しない, 1: 倒壊
+# 共通乱数法（True の場合、乱数を建物IDから決めるため、全壊率の異なるシナリオ間で同じ建物には同じ乱数を使う）
+COMMON_RANDOM_NUMBERS = False
 
-# モンテカルロシミュレーション
-for idx, row in buildings.iterrows():
-    zenkai1 = row["zenkai"]  # 全壊率
-    tokaihani = row["tokaihani"]  # 倒壊影響範囲
+# 倒壊範囲バッファの円弧分割数（shapely の geometry.buffer の既定値と同じ）
+BUFFER_QUAD_SEGS = 16
 
-    # 倒壊判定 (ランダムに全壊率を適用)
-    if random.random() <= zenkai1:
-        buildings.at[idx, "倒壊結果"] = 1
-        try:
-            # 倒壊範囲バッファを作成
-            buildings.at[idx, "geometry"] = row["geometry"].buffer(tokaihani)
-        except Exception as e:
-            print(f"バッファ作成エラー (建物ID: {row['id']}): {e}")
 
-# 出力ファイルに保存
-buildings.to_file(output_path, driver="GeoJSON", encoding="utf-8")
+def load_buildings(path, cache_dir=INPUT_CACHE_DIR):
+    """
+    建物データを読み込み、無効なジオメトリを除外します。
 
-print(f"倒壊建物ポリゴンが作成され、元データの属性情報とともに保存されました: {output_path}")
+    Parameters:
+        path (str): 全壊率・倒壊影響範囲を持つ建物データのパス
+        cache_dir (str): 入力キャッシュ（GeoParquet）の保存先（None の場合は使わない）
 
+    Returns:
+        GeoDataFrame: 有効なジオメトリのみの建物データ
+    """
+    buildings = read_cached(path, cache_dir)
+    return buildings[~buildings.is_empty & buildings.is_valid]
+
+
+def _splitmix64(x):
+    """uint64 配列に SplitMix64 の混合関数を適用します（桁あふれは 2^64 で折り返す）。"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _keyed_uniforms(keys, n_realizations, seed, stream):
+    """
+    建物IDと反復番号から決まる一様乱数（共通乱数法用）を作成します。
+    同じ建物IDには、建物の並び順や他の建物の有無によらず同じ乱数列が割り当てられます。
+
+    Parameters:
+        keys (array-like): 建物ID
+        n_realizations (int): 反復回数
+        seed (int): 乱数シード
+        stream (int): 乱数列の番号（用途ごとに独立した乱数列を得るため）
+
+    Returns:
+        numpy.ndarray: 建物数×反復回数の一様乱数行列（[0, 1)）
+    """
+    key_hash = pd.util.hash_array(np.asarray(keys).astype(str).astype(object))
+    seed_hash = _splitmix64(np.array([seed * 4 + stream], dtype=np.uint64))
+    counters = np.arange(n_realizations, dtype=np.uint64) * np.uint64(0xD1B54A32D192ED03)
+    bits = _splitmix64(_splitmix64(key_hash ^ seed_hash)[:, None] + counters[None, :])
+    return (bits >> np.uint64(11)) * 2.0 ** -53
+
+
+def draw_uniforms(n_buildings, n_realizations, seed=SEED, method=SAMPLING_METHOD, keys=None):
+    """
+    倒壊判定に用いる一様乱数を、指定した分散低減法で一括作成します。
+
+    Parameters:
+        n_buildings (int): 建物数
+        n_realizations (int): 反復回数
+        seed (int): 乱数シード
+        method (str): "plain" / "lhs" / "antithetic"
+        keys (array-like): 建物ID（指定した場合は共通乱数法。None の場合は建物の並び順で乱数を割り当てる）
+
+    Returns:
+        numpy.ndarray: 建物数×反復回数の一様乱数行列
+    """
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"未対応の乱数生成方法です: {method}（{', '.join(SAMPLING_METHODS)} から選択）")
+
+    # 基本の一様乱数（反復 k の乱数は乱数列の k 番目の建物数分の区間から取るため、反復回数によらず同じ）
+    if keys is None:
+        rng = np.random.default_rng(seed)
+        uniforms = rng.random((n_realizations, n_buildings)).T
+    else:
+        uniforms = _keyed_uniforms(keys, n_realizations, seed, stream=0)
+
+    if method == "antithetic":
+        # 反復 2m+1 は反復 2m の対称変量（反復回数が奇数の場合、最後の反復は独立）
+        half = n_realizations // 2
+        uniforms[:, 1:2 * half:2] = 1.0 - uniforms[:, 0:2 * half:2]
+    elif method == "lhs":
+        # 建物ごとに [0, 1) を反復回数で等分し、各区間から1つずつ無作為な順序で取る
+        if keys is None:
+            order_keys = rng.random((n_buildings, n_realizations))
+        else:
+            order_keys = _keyed_uniforms(keys, n_realizations, seed, stream=1)
+        strata = np.argsort(order_keys, axis=1)
+        uniforms = (strata + uniforms) / n_realizations
+
+    return uniforms
+
+
+def sample_collapse(zenkai, n_realizations, seed=SEED, method=SAMPLING_METHOD, keys=None):
+    """
+    全壊率に基づき、N 回分の倒壊判定を一括で行います。
+
+    Parameters:
+        zenkai (array-like): 建物ごとの全壊率
+        n_realizations (int): 反復回数
+        seed (int): 乱数シード
+        method (str): 乱数の生成方法（"plain" / "lhs" / "antithetic"）
+        keys (array-like): 共通乱数法で用いる建物ID（None の場合は使用しない）
+
+    Returns:
+        numpy.ndarray: 建物数×反復回数の真偽値行列（True: 倒壊）
+    """
+    zenkai = np.asarray(zenkai, dtype=float)
+    uniforms = draw_uniforms(len(zenkai), n_realizations, seed, method, keys)
+    return uniforms <= zenkai[:, None]
+
+
+def variance_reduction(zenkai, n_realizations, method=SAMPLING_METHOD, seed=SEED, keys=None, replicates=30):
+    """
+    指定した乱数生成方法の、独立な一様乱数（plain）に対する倒壊判定の分散低減率を推定します。
+    同じ反復回数の試行全体を replicates 回繰り返し、倒壊建物数の平均と建物ごとの倒壊頻度について、
+    推定値の分散を plain の理論分散（Σp(1-p)/N, p(1-p)/N）と比較します。
+    ※ 倒壊判定そのものの分散低減率であり、道路の閉塞確率やルート発見率の分散低減率はこれより大幅に小さくなりうる。
+      また倒壊判定行列を replicates 回作成するため、建物数が多い場合は時間とメモリを要する
+
+    Parameters:
+        zenkai (array-like): 建物ごとの全壊率
+        n_realizations (int): 反復回数
+        method (str): 乱数の生成方法
+        seed (int): 乱数シード（各試行はこのシードから連番のシードを使用）
+        keys (array-like): 共通乱数法で用いる建物ID
+        replicates (int): 分散推定のための試行回数
+
+    Returns:
+        dict: collapsed_count（倒壊建物数の平均）、building_frequency（建物ごとの倒壊頻度）の分散低減率
+              （plain の分散 / 指定方法の分散。1 より大きいほど少ない反復回数で同じ信頼区間幅に到達する）
+    """
+    zenkai = np.clip(np.nan_to_num(np.asarray(zenkai, dtype=float)), 0.0, 1.0)
+    plain_count_var = np.sum(zenkai * (1 - zenkai)) / n_realizations
+    plain_frequency_var = np.mean(zenkai * (1 - zenkai)) / n_realizations
+
+    frequencies = np.array([
+        sample_collapse(zenkai, n_realizations, seed + r, method, keys).mean(axis=1)
+        for r in range(1, replicates + 1)
+    ])
+    count_var = np.var(frequencies.sum(axis=1), ddof=1)
+    frequency_var = np.mean(np.var(frequencies, axis=0, ddof=1))
+
+    def ratio(plain_var, method_var):
+        return float(plain_var / method_var) if method_var > 0 else float("inf")
+
+    return {
+        "collapsed_count": ratio(plain_count_var, count_var),
+        "building_frequency": ratio(plain_frequency_var, frequency_var),
+    }
+
+
+def buffer_collapse_polygons(buildings, collapse_matrix):
+    """
+    いずれかの反復で倒壊する建物についてのみ、倒壊範囲バッファを一括で作成します。
+
+    Parameters:
+        buildings (GeoDataFrame): 建物データ（tokaihani 列を含む）
+        collapse_matrix (numpy.ndarray): sample_collapse で作成した倒壊判定行列
+
+    Returns:
+        numpy.ndarray: 建物ごとの倒壊範囲ポリゴン（一度も倒壊しない建物、作成に失敗した建物は None）
+    """
+    ever_collapsed = collapse_matrix.any(axis=1)
+    polygons = np.full(len(buildings), None, dtype=object)
+    polygons[ever_collapsed] = shapely.buffer(
+        buildings.geometry.to_numpy()[ever_collapsed],
+        buildings["tokaihani"].to_numpy(dtype=float)[ever_collapsed],
+        quad_segs=BUFFER_QUAD_SEGS,
+    )
+
+    # 倒壊影響範囲が不正な建物はバッファを作成できないため、建物形状のまま扱う
+    failed = ever_collapsed & shapely.is_missing(polygons)
+    for building_id in buildings.loc[failed, "id"]:
+        print(f"バッファ作成エラー (建物ID: {building_id}): 倒壊影響範囲が不正です")
+
+    return polygons
+
+
+def realize_destruction(buildings, collapse_matrix, collapse_polygons, realization):
+    """
+    指定した反復の倒壊結果を建物データに反映します。
+
+    Parameters:
+        buildings (GeoDataFrame): 建物データ
+        collapse_matrix (numpy.ndarray): sample_collapse で作成した倒壊判定行列
+        collapse_polygons (numpy.ndarray): buffer_collapse_polygons で作成した倒壊範囲ポリゴン
+        realization (int): 反復番号（0始まり）
+
+    Returns:
+        GeoDataFrame: 倒壊結果列（0: 倒壊しない, 1: 倒壊）を持ち、倒壊建物は倒壊範囲ポリゴンに置き換えた建物データ
+    """
+    collapsed = collapse_matrix[:, realization]
+    destroyed = buildings.copy()
+    destroyed["倒壊結果"] = collapsed.astype(int)
+
+    replace = collapsed & ~shapely.is_missing(collapse_polygons)
+    geoms = destroyed.geometry.to_numpy().copy()
+    geoms[replace] = collapse_polygons[replace]
+    destroyed[destroyed.geometry.name] = gpd.GeoSeries(geoms, index=destroyed.index, crs=destroyed.crs)
+    return destroyed
+
+
+if __name__ == "__main__":
+    # ファイルパス
+    input_path = r"C:\szok\import\szoksrg_plateau_zenkairitsu.geojson"
+    output_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+
+    # データの読み込み（無効なジオメトリを除外）
+    buildings = load_buildings(input_path)
+
+    # モンテカルロシミュレーション（指定した反復の倒壊判定を再現）
+    keys = buildings["id"] if COMMON_RANDOM_NUMBERS else None
+    collapse_matrix = sample_collapse(buildings["zenkai"], N_REALIZATIONS, SEED, SAMPLING_METHOD, keys)
+    collapse_polygons = buffer_collapse_polygons(buildings, collapse_matrix[:, [REALIZATION]])
+    buildings = realize_destruction(buildings, collapse_matrix, collapse_polygons, REALIZATION)
+
+    # 出力ファイルに保存
+    buildings.to_file(output_path, driver="GeoJSON", encoding="utf-8")
+
+    print(f"倒壊建物ポリゴンが作成され、元データの属性情報とともに保存されました: {output_path}")
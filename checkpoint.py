@@ -0,0 +1,155 @@
+# バッチ実行のチェックポイントを保存し、中断した実行を同じ乱数列のまま続きから再開できるようにする。
+# 完了・失敗した反復番号と結果ストアの行数は反復ごとに、集計の途中状態（大きい）は一定の反復ごとに保存する。
+# 集計の途中状態を保存するまでの各反復の集計値の更新分も反復ごとに保存し、再開時に再適用する。
+import glob
+import hashlib
+import os
+import pickle
+import numpy as np
+
+
+def collapse_digest(collapse_matrix):
+    """
+    倒壊判定行列のハッシュを計算します（再開時に乱数列が中断前と同じかを確認するため）。
+
+    Parameters:
+        collapse_matrix (numpy.ndarray): 倒壊判定行列（建物 x 反復）
+
+    Returns:
+        str: SHA-256 ハッシュ（16進数）
+    """
+    digest = hashlib.sha256()
+    digest.update(np.asarray(collapse_matrix.shape, dtype=np.int64).tobytes())
+    digest.update(np.packbits(np.ascontiguousarray(collapse_matrix, dtype=bool)).tobytes())
+    return digest.hexdigest()
+
+
+def save_checkpoint(path, state):
+    """
+    チェックポイントを保存します。一時ファイルに書き出してから置き換えるため、
+    保存中に中断しても直前のチェックポイントが残ります。
+
+    Parameters:
+        path (str): チェックポイントのパス
+        state (dict): 保存する状態
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    チェックポイントを読み込みます。
+
+    Parameters:
+        path (str): チェックポイントのパス
+
+    Returns:
+        dict: 保存した状態（ファイルがない場合は None）
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def aggregates_path(path):
+    """
+    集計の途中状態の保存先を返します。
+
+    Parameters:
+        path (str): チェックポイントのパス
+
+    Returns:
+        str: 集計の途中状態のパス
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}_aggregates{ext}"
+
+
+def update_path(path, iteration):
+    """
+    反復ごとの集計値の更新分の保存先を返します。
+
+    Parameters:
+        path (str): チェックポイントのパス
+        iteration (int): 反復番号
+
+    Returns:
+        str: 更新分のパス
+    """
+    return os.path.join(f"{path}.updates", f"{iteration:06d}.pkl")
+
+
+def saved_updates(path):
+    """
+    集計値の更新分を保存している反復番号を返します。
+
+    Parameters:
+        path (str): チェックポイントのパス
+
+    Returns:
+        list: 反復番号
+    """
+    return sorted(int(os.path.basename(p)[:-4]) for p in glob.glob(os.path.join(f"{path}.updates", "*.pkl")))
+
+
+def save_update(path, iteration, update):
+    """
+    1反復分の集計値の更新分を保存します。
+
+    Parameters:
+        path (str): チェックポイントのパス
+        iteration (int): 反復番号
+        update (dict): 集計値の更新分
+    """
+    save_checkpoint(update_path(path, iteration), update)
+
+
+def load_update(path, iteration):
+    """
+    1反復分の集計値の更新分を読み込みます。
+
+    Parameters:
+        path (str): チェックポイントのパス
+        iteration (int): 反復番号
+
+    Returns:
+        dict: 集計値の更新分
+    """
+    update = load_checkpoint(update_path(path, iteration))
+    if update is None:
+        raise FileNotFoundError(f"反復 {iteration} の集計値の更新分がありません: {update_path(path, iteration)}")
+    return update
+
+
+def save_aggregates(path, aggregates):
+    """
+    集計の途中状態を保存し、保存した反復までの集計値の更新分を削除します。
+
+    Parameters:
+        path (str): チェックポイントのパス
+        aggregates (dict): 集計の途中状態（iteration に最後に集計した反復番号）
+    """
+    save_checkpoint(aggregates_path(path), aggregates)
+    for iteration in saved_updates(path):
+        if iteration <= aggregates["iteration"]:
+            os.remove(update_path(path, iteration))
+
+
+def remove_checkpoint(path):
+    """
+    チェックポイント・集計の途中状態・集計値の更新分を削除します（新しく実行を始める場合）。
+
+    Parameters:
+        path (str): チェックポイントのパス
+    """
+    stale_paths = [path, aggregates_path(path)] + [update_path(path, i) for i in saved_updates(path)]
+    for stale in stale_paths:
+        if os.path.exists(stale):
+            os.remove(stale)
@@ -1,129 +1,177 @@
 # 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import LineString, MultiLineString
 from shapely.ops import substring
+from input_cache import read_cached
+
+# 閉塞原因建物ID（c_build_id）の区切り文字（cross_analysis7 の出力と同じ）
+CLOSURE_ID_SEPARATOR = ";"
+
+
+def split_centerlines(roads, closed_roads, buildings, closure_ids=None):
+    """
+    閉塞原因の倒壊建物で道路中心線を分割し、徒歩通行不可の道路ポリゴンに接する区間は両端を短縮します。
+
+    Parameters:
+        roads (GeoDataFrame): 道路中心線
+        closed_roads (GeoDataFrame): 閉塞判定済みの道路ポリゴン（area_analysis の結果）
+        buildings (GeoDataFrame): 倒壊結果を反映した建物データ
+        closure_ids (array-like): 閉塞原因建物のID（None の場合は closed_roads の c_build_id から抽出。タイル分割時に調査範囲全体の値を渡す）
+
+    Returns:
+        GeoDataFrame: 分割後の道路中心線（閉塞判定の属性付き）
+    """
+    # is_closedが1のエッジのみを選択
+    closed_edges = closed_roads[closed_roads["is_closed"] == 1]
+
+    # ped_accessが0の道路ポリゴンを選択
+    no_pedestrian_access_roads = closed_roads[closed_roads["ped_access"] == 0]
+
+    # c_build_idを使って削除対象の建物ポリゴンを抽出（複数の場合はセミコロン区切り）
+    if closure_ids is None:
+        closure_ids = closed_edges["c_build_id"].str.split(CLOSURE_ID_SEPARATOR).explode()
+    target_buildings = buildings[buildings["id"].isin(closure_ids)]
+    target_geoms = target_buildings.geometry.to_numpy()
+
+    # 閉塞道路の情報を路線IDで一度だけ結合（同じ路線IDが複数ある場合は先頭の行）
+    closed_info_by_id = closed_roads[closed_roads["路線ID"].notna()].drop_duplicates("路線ID").set_index("路線ID")
+
+    # 道路中心線と交差する削除対象建物の組を空間インデックスで一括取得
+    road_idx, building_idx = target_buildings.sindex.query(roads.geometry, predicate="intersects")
+    order = np.lexsort((building_idx, road_idx))
+    road_idx, building_idx = road_idx[order], building_idx[order]
+    road_starts = np.searchsorted(road_idx, np.arange(len(roads) + 1))
+
+    # 各道路中心線の分割処理（倒壊建物との交差部分を、交差する建物の和集合との差分で一度に削除）
+    road_attributes = []
+    road_pieces = []
+    for pos, road in enumerate(roads.itertuples()):
+        road_geom = road.geometry
+        road_id = road.路線ID  # 道路のID
+        attributes = road._asdict()  # 元の属性情報を辞書として取得
+
+        # 閉塞道路の情報を転記
+        if road_id in closed_info_by_id.index:
+            closed_info = closed_info_by_id.loc[road_id]
+            for field in ["int_area", "int_length", "max_width", "w_build_id", 
+                          "is_closed", "c_build_id", "rem_area", "line_len", 
+                          "car_access", "ped_access"]:
+                attributes[field] = closed_info.get(field, None) if pd.notna(closed_info.get(field)) else None
+        else:
+            # 属性情報の初期化
+            attributes.update({
+                "int_area": 0,
+                "int_length": 0,
+                "max_width": 0,
+                "w_build_id": None,
+                "is_closed": False,
+                "c_build_id": None,
+                "rem_area": road_geom.area,
+                "line_len": 0,
+                "car_access": 1,
+                "ped_access": 1,
+            })
+
+        split_geoms = [road_geom]
+        hits = building_idx[road_starts[pos]:road_starts[pos + 1]]
+        if len(hits):
+            split_result = road_geom.difference(shapely.union_all(target_geoms[hits]))
+            if isinstance(split_result, LineString):
+                split_geoms = [split_result]
+            elif isinstance(split_result, MultiLineString):
+                split_geoms = list(split_result.geoms)
+            else:
+                split_geoms = []
+
+        road_attributes.append(attributes)
+        road_pieces.append(split_geoms)
+
+    # ped_access=0 の道路ポリゴンと交差する区間を空間インデックスで一括判定
+    pieces = [geom for split_geoms in road_pieces for geom in split_geoms]
+    piece_idx, _ = no_pedestrian_access_roads.sindex.query(
+        np.array(pieces, dtype=object), predicate="intersects"
+    ) if pieces else (np.array([], dtype=np.intp), None)
+    touches_no_pedestrian = np.zeros(len(pieces), dtype=bool)
+    touches_no_pedestrian[piece_idx] = True
 
-# ファイルパスの指定
-road_path = r"C:\szok\import\szoksrg_road.shp"
-closed_road_path = r"C:\szok\szoksrg_simulation\szoksrg_road_plateau_area_analysis.geojson"
-building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
-output_path = r"C:\szok\szoksrg_simulation\szoksrg_road_split_with_all_attributes.geojson"
-
-# 道路ポリゴンと建物レイヤーの読み込み
-roads = gpd.read_file(road_path, encoding="utf-8")
-closed_roads = gpd.read_file(closed_road_path, encoding="utf-8")
-buildings = gpd.read_file(building_path, encoding="utf-8")
-
-# is_closedが1のエッジのみを選択
-closed_edges = closed_roads[closed_roads["is_closed"] == 1]
-
-# ped_accessが0の道路ポリゴンを選択
-no_pedestrian_access_roads = closed_roads[closed_roads["ped_access"] == 0]
-
-# c_build_idを使って削除対象の建物ポリゴンを抽出
-target_buildings = buildings[buildings["id"].isin(closed_edges["c_build_id"].str.split(",").explode())]
-
-# 分割後のエッジを格納するリスト
-new_edges = []
-
-# 各道路中心線の分割処理
-for road in roads.itertuples():
-    road_geom = road.geometry
-    road_id = road.路線ID  # 道路のID
-    attributes = road._asdict()  # 元の属性情報を辞書として取得
-
-    # 閉塞道路の情報を転記
-    closed_info = closed_roads[closed_roads["路線ID"] == road_id]
-    if not closed_info.empty:
-        closed_info = closed_info.iloc[0]
-        for field in ["int_area", "int_length", "max_width", "w_build_id", 
-                      "is_closed", "c_build_id", "rem_area", "line_len", 
-                      "car_access", "ped_access"]:
-            attributes[field] = closed_info.get(field, None) if pd.notna(closed_info.get(field)) else None
-    else:
-        # 属性情報の初期化
-        attributes.update({
-            "int_area": 0,
-            "int_length": 0,
-            "max_width": 0,
-            "w_build_id": None,
-            "is_closed": False,
-            "c_build_id": None,
-            "rem_area": road_geom.area,
-            "line_len": 0,
-            "car_access": 1,
-            "ped_access": 1,
-        })
-
-    split_geoms = [road_geom]
-
-    # 倒壊建物との交差部分を削除
-    for building in target_buildings.geometry:
-        temp_split_geoms = []
+    # 分割後のエッジを格納するリスト
+    new_edges = []
+    piece_counter = 0
+
+    for attributes, split_geoms in zip(road_attributes, road_pieces):
+        road_id = attributes["路線ID"]
+
+        # 該当するped_access=0のポリゴンと交差する場合、両端から1.2m短くする
+        temp_geoms = []
         for geom in split_geoms:
-            if geom.intersects(building):
-                split_result = geom.difference(building)
-                if isinstance(split_result, LineString):
-                    temp_split_geoms.append(split_result)
-                elif isinstance(split_result, MultiLineString):
-                    temp_split_geoms.extend(split_result.geoms)
+            if touches_no_pedestrian[piece_counter]:
+                try:
+                    road_length = geom.length
+                    if road_length > 2.4:  # 両端1.2mずつ短縮可能か確認
+                        trimmed_geom = substring(geom, start_dist=1.2, end_dist=road_length - 1.2)
+                        temp_geoms.append(trimmed_geom)
+                    else:
+                        # 2.4m未満の場合は、最低0.5mを残す
+                        trimmed_geom = substring(geom, start_dist=0.5, end_dist=road_length - 0.5)
+                        temp_geoms.append(trimmed_geom)
+                except Exception as e:
+                    print(f"Error trimming road {road_id}: {e}")
             else:
-                temp_split_geoms.append(geom)
-        split_geoms = temp_split_geoms
-
-    # 該当するped_access=0のポリゴンと交差する場合、両端から1.2m短くする
-    temp_geoms = []
-    for geom in split_geoms:
-        intersecting_roads = no_pedestrian_access_roads[no_pedestrian_access_roads.intersects(geom)]
-        if not intersecting_roads.empty:
-            try:
-                road_length = geom.length
-                if road_length > 2.4:  # 両端1.2mずつ短縮可能か確認
-                    trimmed_geom = substring(geom, start_dist=1.2, end_dist=road_length - 1.2)
-                    temp_geoms.append(trimmed_geom)
-                else:
-                    # 2.4m未満の場合は、最低0.5mを残す
-                    trimmed_geom = substring(geom, start_dist=0.5, end_dist=road_length - 0.5)
-                    temp_geoms.append(trimmed_geom)
-            except Exception as e:
-                print(f"Error trimming road {road_id}: {e}")
-        else:
-            temp_geoms.append(geom)
-    split_geoms = temp_geoms
-
-    # サフィックスを付加してエッジを作成
-    if len(split_geoms) > 1:
-        for i, segment in enumerate(split_geoms, 1):
-            unique_road_id = f"{road_id}_{i:02d}"
+                temp_geoms.append(geom)
+            piece_counter += 1
+        split_geoms = temp_geoms
+
+        # サフィックスを付加してエッジを作成
+        if len(split_geoms) > 1:
+            for i, segment in enumerate(split_geoms, 1):
+                unique_road_id = f"{road_id}_{i:02d}"
+                new_edge = attributes.copy()
+                new_edge["路線ID"] = unique_road_id
+                new_edge["geometry"] = segment
+                new_edges.append(new_edge)
+        elif split_geoms:
             new_edge = attributes.copy()
-            new_edge["路線ID"] = unique_road_id
-            new_edge["geometry"] = segment
+            new_edge["geometry"] = split_geoms[0]
             new_edges.append(new_edge)
-    else:
-        new_edge = attributes.copy()
-        new_edge["geometry"] = split_geoms[0]
-        new_edges.append(new_edge)
-
-# 必要な列を明示的に指定して新しいエッジデータフレームの作成
-columns = list(attributes.keys())
-new_edges_gdf = gpd.GeoDataFrame(new_edges, columns=columns, crs=roads.crs)
-
-# データ型を変換（int64 -> int、ただし NaN がある場合は float）
-for col in new_edges_gdf.columns:
-    # int64 / Int64 系の列か確認
-    if 'int' in str(new_edges_gdf[col].dtype):
-        if new_edges_gdf[col].isna().any():
-            # 欠損値がある場合は float に変換
+
+    # 必要な列を明示的に指定して新しいエッジデータフレームの作成
+    columns = list(attributes.keys())
+    new_edges_gdf = gpd.GeoDataFrame(new_edges, columns=columns, crs=roads.crs)
+
+    # データ型を変換（int64 -> int、ただし NaN がある場合は float）
+    for col in new_edges_gdf.columns:
+        # int64 / Int64 系の列か確認
+        if 'int' in str(new_edges_gdf[col].dtype):
+            if new_edges_gdf[col].isna().any():
+                # 欠損値がある場合は float に変換
+                new_edges_gdf[col] = new_edges_gdf[col].astype(float)
+            else:
+                # 欠損値が無い場合だけ int 変換
+                new_edges_gdf[col] = new_edges_gdf[col].astype(int)
+        elif 'float' in str(new_edges_gdf[col].dtype):
+            # float64 -> float へ(GeoPandas内部では同じfloatだが明示的に書く場合)
             new_edges_gdf[col] = new_edges_gdf[col].astype(float)
-        else:
-            # 欠損値が無い場合だけ int 変換
-            new_edges_gdf[col] = new_edges_gdf[col].astype(int)
-    elif 'float' in str(new_edges_gdf[col].dtype):
-        # float64 -> float へ(GeoPandas内部では同じfloatだが明示的に書く場合)
-        new_edges_gdf[col] = new_edges_gdf[col].astype(float)
 
+    return new_edges_gdf
+
+
+if __name__ == "__main__":
+    # ファイルパスの指定
+    road_path = r"C:\szok\import\szoksrg_road.shp"
+    closed_road_path = r"C:\szok\szoksrg_simulation\szoksrg_road_plateau_area_analysis.geojson"
+    building_path = r"C:\szok\szoksrg_simulation\szoksrg_plateau_destruction.geojson"
+    output_path = r"C:\szok\szoksrg_simulation\szoksrg_road_split_with_all_attributes.geojson"
+
+    # 道路ポリゴンと建物レイヤーの読み込み
+    roads = read_cached(road_path)
+    closed_roads = gpd.read_file(closed_road_path, encoding="utf-8")
+    buildings = gpd.read_file(building_path, encoding="utf-8")
+
+    new_edges_gdf = split_centerlines(roads, closed_roads, buildings)
 
-# 保存
-new_edges_gdf.to_file(output_path, driver="GeoJSON", encoding="utf-8")
-print(f"処理が完了しました。分割された道路中心線が保存されました: {output_path}")
+    # 保存
+    new_edges_gdf.to_file(output_path, driver="GeoJSON", encoding="utf-8")
+    print(f"処理が完了しました。分割された道路中心線が保存されました: {output_path}")
@@ -1,80 +1,301 @@
+import os
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Polygon, LineString, MultiLineString, GeometryCollection
-
-# ファイルパスの指定
-road_path = r"C:\\szok\\import\\szoksrg_road_plateau_id.geojson"
-building_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_plateau_destruction.geojson"
-output_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_road_kosa_with_reductions.geojson"
-
-# 道路と建物レイヤーの読み込み
-roads = gpd.read_file(road_path, encoding="utf-8")
-buildings = gpd.read_file(building_path, encoding="utf-8")
-roads['道路幅'] = pd.to_numeric(roads['道路幅'], errors='coerce')
-
-# 新しい属性列を追加
-roads["int_area"] = 0.0     # 総交差面積
-roads["int_length"] = 0.0   # 総交差長さ
-roads["max_width"] = 0.0    # 最大幅員減少幅
-roads["w_build_id"] = None  # 最大幅員減少を生じさせた建物ID
-roads["is_closed"] = False  # 閉塞状態
-roads["c_build_id"] = None  # 閉塞原因建物ID（複数の場合はセミコロン区切り）
+import numpy as np
+import shapely
+from build_destroy import BUFFER_QUAD_SEGS
+from input_cache import hashed_path, read_cached
 
 # 閉塞判定の幅の閾値
 MIN_WIDTH_THRESHOLD = 0.5              # 閉塞と判定する幅の閾値
 CROSSING_SEGMENT_RATIO_THRESHOLD = 0.4 # 道路をまたぐかどうかを判定する比率（セグメントの長さの比率が0.4以上の場合、またぐと判定）
 
-# 各道路ポリゴンに対して処理
-for idx, road in roads.iterrows():
-    max_reduction = 0.0
-    is_closed = False
-    road_width = road["道路幅"]
-    road_boundary = road.geometry.boundary  # 道路の外周ライン
-    building_ids = []  # 閉塞原因建物ID
-    total_intersection_area = 0.0
-    total_intersection_length = 0.0
-    max_width_building_id = None
-
-    # 各建物ポリゴンについて交差を確認
-    for building_idx, building in buildings.iterrows():
-        if road.geometry.intersects(building.geometry):
-            # 交差面積
-            intersection_area = road.geometry.intersection(building.geometry).area
-            total_intersection_area += intersection_area
-
-            # 境界線の交差長さ
-            boundary_intersection = road_boundary.intersection(building.geometry)
-            if isinstance(boundary_intersection, MultiLineString):
-                boundary_length = max(segment.length for segment in boundary_intersection.geoms)
-            elif isinstance(boundary_intersection, LineString):
-                boundary_length = boundary_intersection.length
-            elif isinstance(boundary_intersection, GeometryCollection):
-                line_segments = [line for line in boundary_intersection.geoms if isinstance(line, LineString)]
-                boundary_length = max((line.length for line in line_segments), default=0)
-            else:
-                boundary_length = 0
-
-            total_intersection_length += boundary_length
-
-            # 幅員減少幅
-            if boundary_length > 0:
-                width_reduction = intersection_area / boundary_length
-                if road_width - width_reduction < MIN_WIDTH_THRESHOLD:
-                    is_closed = True
-                    building_ids.append(building['id'])
-                elif width_reduction > max_reduction:
-                    max_reduction = width_reduction
-                    max_width_building_id = building['id']
-
-    # 属性の更新
-    roads.at[idx, "int_area"] = total_intersection_area
-    roads.at[idx, "int_length"] = total_intersection_length
-    roads.at[idx, "max_width"] = max_reduction
-    roads.at[idx, "w_build_id"] = max_width_building_id
-    roads.at[idx, "is_closed"] = is_closed
-    roads.at[idx, "c_build_id"] = ";".join(map(str, building_ids)) if building_ids else None
-
-# 保存
-roads.to_file(output_path, driver="GeoJSON", encoding="utf-8")
-
-print(f"処理が完了しました。結果は以下に保存されています: {output_path}")
+
+def query_candidate_pairs(roads, buildings):
+    """
+    空間インデックス（STRtree）で交差する道路ポリゴンと建物ポリゴンの組を一括取得します。
+
+    Parameters:
+        roads (GeoDataFrame): 道路ポリゴン
+        buildings (GeoDataFrame): 建物ポリゴン
+
+    Returns:
+        tuple: (道路の行位置の配列, 建物の行位置の配列)。道路順・建物順に並べ替え済み
+    """
+    road_idx, building_idx = buildings.sindex.query(roads.geometry, predicate="intersects")
+    order = np.lexsort((building_idx, road_idx))
+    return road_idx[order], building_idx[order]
+
+
+def compute_pair_metrics(road_geoms, building_geoms):
+    """
+    道路ポリゴンと建物ポリゴンの組ごとに、交差面積と道路外周との最長交差長さを一括計算します。
+
+    Parameters:
+        road_geoms (numpy.ndarray): 組ごとの道路ポリゴン
+        building_geoms (numpy.ndarray): 組ごとの建物ポリゴン
+
+    Returns:
+        tuple: (交差面積の配列, 境界線の最長交差長さの配列)
+    """
+    areas = shapely.area(shapely.intersection(road_geoms, building_geoms))
+
+    # 道路の外周ラインと建物の交差を MultiLineString / GeometryCollection ごと分解し、
+    # LineString 部分の最長の長さを組ごとに取得（LineString を含まない場合は 0）
+    boundary_intersections = shapely.intersection(shapely.boundary(road_geoms), building_geoms)
+    parts, pair_idx = shapely.get_parts(boundary_intersections, return_index=True)
+    is_line = np.isin(shapely.get_type_id(parts), (1, 2))  # LineString, LinearRing
+    part_lengths = np.where(is_line, shapely.length(parts), 0.0)
+    boundary_lengths = np.zeros(len(road_geoms))
+    np.maximum.at(boundary_lengths, pair_idx, part_lengths)
+
+    return areas, boundary_lengths
+
+
+def aggregate_reductions(road_widths, road_idx, building_ids, areas, boundary_lengths):
+    """
+    組ごとの交差面積・交差長さを道路ポリゴンごとに集計し、幅員減少と閉塞を判定します。
+
+    Parameters:
+        road_widths (numpy.ndarray): 道路ポリゴンごとの道路幅
+        road_idx (numpy.ndarray): 組ごとの道路の行位置（道路順・建物順に並べ替え済み）
+        building_ids (numpy.ndarray): 組ごとの建物ID
+        areas (numpy.ndarray): 組ごとの交差面積
+        boundary_lengths (numpy.ndarray): 組ごとの境界線の最長交差長さ
+
+    Returns:
+        DataFrame: int_area, int_length, max_width, w_build_id, is_closed, c_build_id 列（道路ポリゴン順）
+    """
+    n_roads = len(road_widths)
+    road_idx = np.asarray(road_idx, dtype=np.intp)
+
+    # 総交差面積・総交差長さ（bincount は建物順に逐次加算するためループ版と同じ値になる）
+    int_area = np.bincount(road_idx, weights=areas, minlength=n_roads)
+    int_length = np.bincount(road_idx, weights=boundary_lengths, minlength=n_roads)
+
+    # 幅員減少幅（境界線の交差長さが 0 の組は対象外）
+    has_boundary = boundary_lengths > 0
+    width_reduction = np.divide(areas, boundary_lengths, out=np.zeros_like(areas), where=has_boundary)
+    closed = has_boundary & (road_widths[road_idx] - width_reduction < MIN_WIDTH_THRESHOLD)
+    reducing = has_boundary & ~closed & (width_reduction > 0)
+
+    # 最大幅員減少幅とその建物ID（同値の場合は先に現れた建物を採用）
+    max_width = np.zeros(n_roads)
+    w_build_id = np.full(n_roads, None, dtype=object)
+    reductions = pd.DataFrame({
+        "road": road_idx[reducing],
+        "width_reduction": width_reduction[reducing],
+        "building_id": building_ids[reducing],
+    })
+    if not reductions.empty:
+        max_rows = reductions.loc[reductions.groupby("road")["width_reduction"].idxmax()]
+        max_width[max_rows["road"].to_numpy()] = max_rows["width_reduction"].to_numpy()
+        w_build_id[max_rows["road"].to_numpy()] = max_rows["building_id"].to_numpy()
+
+    # 閉塞状態と閉塞原因建物ID（複数の場合はセミコロン区切り）
+    is_closed = np.zeros(n_roads, dtype=bool)
+    c_build_id = np.full(n_roads, None, dtype=object)
+    closures = pd.DataFrame({"road": road_idx[closed], "building_id": building_ids[closed]})
+    if not closures.empty:
+        joined = closures.groupby("road")["building_id"].agg(lambda ids: ";".join(map(str, ids)))
+        is_closed[joined.index.to_numpy()] = True
+        c_build_id[joined.index.to_numpy()] = joined.to_numpy()
+
+    return pd.DataFrame({
+        "int_area": int_area,          # 総交差面積
+        "int_length": int_length,      # 総交差長さ
+        "max_width": max_width,        # 最大幅員減少幅
+        "w_build_id": w_build_id,      # 最大幅員減少を生じさせた建物ID
+        "is_closed": is_closed,        # 閉塞状態
+        "c_build_id": c_build_id,      # 閉塞原因建物ID（複数の場合はセミコロン区切り）
+    })
+
+
+def build_impact_table(roads, buildings):
+    """
+    道路ポリゴンと、各建物の取り得る2状態のポリゴンとの影響表（疎な交差表）を作成します。
+    倒壊しない建物は建物形状のまま、倒壊する建物は geometry.buffer(tokaihani) の倒壊範囲
+    （倒壊影響範囲が欠損・不正な建物は建物形状のまま）となるため、
+    いずれもデータセットごとに固定であり、各反復では倒壊結果に応じた行を抽出して集計するだけでよい。
+
+    Parameters:
+        roads (GeoDataFrame): 道路ポリゴン
+        buildings (GeoDataFrame): 倒壊前の建物ポリゴン（tokaihani 列を含む）
+
+    Returns:
+        DataFrame: road_idx, building_idx, collapsed, area, boundary_len 列（道路順・建物順）
+    """
+    footprints = buildings.geometry.to_numpy()
+    collapse_polygons = shapely.buffer(
+        footprints, buildings["tokaihani"].to_numpy(dtype=float), quad_segs=BUFFER_QUAD_SEGS
+    )
+    # 倒壊影響範囲が不正でバッファを作成できない建物は、倒壊しても建物形状のまま（build_destroy.realize_destruction と同じ）
+    missing = shapely.is_missing(collapse_polygons)
+    collapse_polygons[missing] = footprints[missing]
+    road_geoms = roads.geometry.to_numpy()
+
+    tables = []
+    for collapsed, geoms in ((0, footprints), (1, collapse_polygons)):
+        states = gpd.GeoDataFrame(geometry=geoms, crs=buildings.crs)
+        road_idx, building_idx = query_candidate_pairs(roads, states)
+        areas, boundary_lengths = compute_pair_metrics(road_geoms[road_idx], geoms[building_idx])
+        tables.append(pd.DataFrame({
+            "road_idx": road_idx,          # 道路ポリゴンの行位置
+            "building_idx": building_idx,  # 建物の行位置
+            "collapsed": collapsed,        # 建物の状態（0: 倒壊しない, 1: 倒壊）
+            "area": areas,                 # 交差面積
+            "boundary_len": boundary_lengths,  # 道路外周との最長交差長さ
+        }))
+
+    table = pd.concat(tables, ignore_index=True)
+    return table.sort_values(["road_idx", "building_idx"], kind="stable", ignore_index=True)
+
+
+def load_impact_table(path):
+    """
+    保存済みの影響表を読み込みます（浮動小数点は書き出し時の値をそのまま復元）。
+
+    Parameters:
+        path (str): 影響表CSVのパス
+
+    Returns:
+        DataFrame: 影響表
+    """
+    return pd.read_csv(path, encoding="utf-8", float_precision="round_trip")
+
+
+def impact_table_matches(impact_table, n_roads, n_buildings):
+    """
+    影響表の道路ポリゴン・建物の行位置が、現在の道路ポリゴン・建物の件数の範囲内かを確認します。
+
+    Parameters:
+        impact_table (DataFrame): 影響表
+        n_roads (int): 道路ポリゴンの件数
+        n_buildings (int): 建物の件数
+
+    Returns:
+        bool: すべての行位置が範囲内の場合 True
+    """
+    if len(impact_table) == 0:
+        return True
+    road_idx = impact_table["road_idx"].to_numpy()
+    building_idx = impact_table["building_idx"].to_numpy()
+    return (road_idx.min() >= 0 and road_idx.max() < n_roads
+            and building_idx.min() >= 0 and building_idx.max() < n_buildings)
+
+
+def cached_impact_table(roads, buildings, path, source_paths):
+    """
+    影響表を、建物・道路ポリゴンの入力ファイルの内容のハッシュをファイル名に付けたCSVから読み込みます。
+    入力ファイルが変更された場合（ファイルがない場合）や行位置が件数と一致しない場合は作成して保存します。
+
+    Parameters:
+        roads (GeoDataFrame): 道路ポリゴン
+        buildings (GeoDataFrame): 倒壊前の建物ポリゴン（tokaihani 列を含む）
+        path (str): 影響表CSVのパス（ハッシュを付ける前）
+        source_paths (list): 建物・道路ポリゴンのファイルのパス
+
+    Returns:
+        tuple: (影響表, 読み込み・保存したCSVのパス)
+    """
+    path = hashed_path(path, source_paths)
+    if os.path.exists(path):
+        impact_table = load_impact_table(path)
+        if impact_table_matches(impact_table, len(roads), len(buildings)):
+            return impact_table, path
+        print(f"Impact table does not match the road polygon / building counts; rebuilding: {path}")
+
+    print(f"Building road x building impact table: {path}")
+    impact_table = build_impact_table(roads, buildings)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    impact_table.to_csv(path, index=False, encoding="utf-8")
+    return impact_table, path
+
+
+def select_impacts(impact_table, collapse_results):
+    """
+    影響表から、各建物の倒壊結果に対応する状態の行のみを抽出します。
+
+    Parameters:
+        impact_table (DataFrame): build_impact_table で作成した影響表
+        collapse_results (numpy.ndarray): 建物ごとの倒壊結果（0: 倒壊しない, 1: 倒壊）
+
+    Returns:
+        DataFrame: 今回の反復で道路と交差する建物ポリゴンの行（道路順・建物順）
+    """
+    collapse_results = np.asarray(collapse_results)
+    building_idx = impact_table["building_idx"].to_numpy()
+    if len(building_idx) and building_idx.max() >= len(collapse_results):
+        raise ValueError("影響表と建物レイヤーの件数が一致しません。影響表を再作成してください。")
+    mask = impact_table["collapsed"].to_numpy() == collapse_results[building_idx]
+    return impact_table[mask]
+
+
+def analyze_width_reductions(roads, buildings, impact_table=None):
+    """
+    道路ポリゴンごとに倒壊建物による幅員減少と閉塞を判定します。
+
+    Parameters:
+        roads (GeoDataFrame): 道路ポリゴン（道路幅列を含む）
+        buildings (GeoDataFrame): 倒壊結果を反映した建物データ
+        impact_table (DataFrame): 事前計算した影響表（None の場合は交差をその場で計算）
+
+    Returns:
+        GeoDataFrame: int_area, int_length, max_width, w_build_id, is_closed, c_build_id 列を追加した道路ポリゴン
+                      （attrs["candidate_pairs"] に集計した道路×建物の組の数）
+    """
+    roads = roads.copy()
+    roads['道路幅'] = pd.to_numeric(roads['道路幅'], errors='coerce')
+
+    if impact_table is not None:
+        # 事前計算した影響表から今回の倒壊結果に対応する行を抽出（ジオメトリ演算なし）
+        impacts = select_impacts(impact_table, buildings["倒壊結果"].to_numpy())
+        pair_road_idx = impacts["road_idx"].to_numpy()
+        if len(pair_road_idx) and pair_road_idx.max() >= len(roads):
+            raise ValueError("影響表と道路ポリゴンレイヤーの件数が一致しません。影響表を再作成してください。")
+        pair_building_idx = impacts["building_idx"].to_numpy()
+        pair_areas = impacts["area"].to_numpy()
+        pair_boundary_lengths = impacts["boundary_len"].to_numpy()
+    else:
+        # 交差する道路×建物の組を空間インデックスで取得し、組ごとの交差面積・交差長さを一括計算
+        pair_road_idx, pair_building_idx = query_candidate_pairs(roads, buildings)
+        pair_areas, pair_boundary_lengths = compute_pair_metrics(
+            roads.geometry.to_numpy()[pair_road_idx],
+            buildings.geometry.to_numpy()[pair_building_idx],
+        )
+
+    # 道路ポリゴンごとに集計し、新しい属性列を追加
+    reductions = aggregate_reductions(
+        roads["道路幅"].to_numpy(dtype=float),
+        pair_road_idx,
+        buildings["id"].to_numpy()[pair_building_idx],
+        pair_areas,
+        pair_boundary_lengths,
+    )
+    for col in reductions.columns:
+        roads[col] = reductions[col].to_numpy()
+    roads.attrs["candidate_pairs"] = len(pair_road_idx)
+
+    return roads
+
+
+if __name__ == "__main__":
+    # ファイルパスの指定
+    road_path = r"C:\\szok\\import\\szoksrg_road_plateau_id.geojson"
+    building_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_plateau_destruction.geojson"
+    source_building_path = r"C:\\szok\\import\\szoksrg_plateau_zenkairitsu.geojson"  # 倒壊判定前の建物（影響表のキー）
+    output_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_road_kosa_with_reductions.geojson"
+    impact_table_path = r"C:\\szok\\szoksrg_simulation\\szoksrg_road_building_impacts.csv"  # impact_table.py で事前作成
+
+    # 道路と建物レイヤーの読み込み
+    roads = read_cached(road_path)
+    buildings = gpd.read_file(building_path, encoding="utf-8")
+    impact_table_path = hashed_path(impact_table_path, [source_building_path, road_path])
+    impact_table = load_impact_table(impact_table_path) if os.path.exists(impact_table_path) else None
+
+    roads = analyze_width_reductions(roads, buildings, impact_table)
+
+    # 保存
+    roads.to_file(output_path, driver="GeoJSON", encoding="utf-8")
+
+    print(f"処理が完了しました。結果は以下に保存されています: {output_path}")
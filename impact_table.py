@@ -0,0 +1,26 @@
+# 道路ポリゴン×建物（倒壊しない場合の建物形状・倒壊した場合の倒壊範囲バッファ）の影響表を事前計算する。
+# 倒壊範囲は常に geometry.buffer(tokaihani) のため、交差面積・境界交差長さはデータセットごとに一度だけ計算すればよい。
+# cross_analysis7.py / area_analysis.py は各反復でこの表を倒壊結果で抽出して集計するだけとなる。
+# 出力ファイル名には建物・道路ポリゴンの入力ファイルの内容のハッシュが付くため、入力データを更新すると別のファイルに作成される。
+from build_destroy import load_buildings
+from cross_analysis7 import build_impact_table
+from input_cache import hashed_path, read_cached
+
+# ファイルパスの指定
+building_path = r"C:\szok\import\szoksrg_plateau_zenkairitsu.geojson"
+road_path = r"C:\szok\import\szoksrg_road_plateau_id.geojson"
+output_path = r"C:\szok\szoksrg_simulation\szoksrg_road_building_impacts.csv"
+
+output_path = hashed_path(output_path, [building_path, road_path])
+
+# データの読み込み（build_destroy.py と同じく無効なジオメトリを除外し、建物の行位置を倒壊結果と一致させる）
+buildings = load_buildings(building_path)
+roads = read_cached(road_path)
+
+# 影響表の作成
+impact_table = build_impact_table(roads, buildings)
+
+# 保存
+impact_table.to_csv(output_path, index=False, encoding="utf-8")
+
+print(f"影響表を作成しました（{len(impact_table)} 行）。結果は以下に保存されています: {output_path}")
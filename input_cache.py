@@ -0,0 +1,101 @@
+# 静的な入力データ（GeoJSON / シェープファイル）を初回読み込み時に GeoParquet に変換し、2回目以降はそこから読み込む。
+import hashlib
+import os
+import geopandas as gpd
+
+# 変換した GeoParquet の保存先
+INPUT_CACHE_DIR = r"C:\szok\szoksrg_simulation\cache\inputs"
+
+# シェープファイルの場合にキーに含める付属ファイルの拡張子
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+def cache_key(path):
+    """
+    入力ファイルのパス・更新日時・サイズからキャッシュのキーを作成します（シェープファイルは付属ファイルを含む）。
+
+    Parameters:
+        path (str): 入力ファイルのパス
+
+    Returns:
+        str: キャッシュのキー（16進数16桁）
+    """
+    stem, ext = os.path.splitext(os.path.abspath(path))
+    parts = [stem + part for part in SHAPEFILE_PARTS] if ext.lower() == ".shp" else [stem + ext]
+    digest = hashlib.sha256()
+    for part in parts:
+        if os.path.exists(part):
+            stat = os.stat(part)
+            digest.update(f"{part}|{stat.st_mtime_ns}|{stat.st_size}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def source_hash(paths):
+    """
+    入力ファイルの内容のハッシュを計算します（シェープファイルは付属ファイルを含む）。
+
+    Parameters:
+        paths (list): 入力ファイルのパス
+
+    Returns:
+        str: SHA-256 ハッシュ（16進数）
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        stem, ext = os.path.splitext(path)
+        parts = [stem + part for part in SHAPEFILE_PARTS] if ext.lower() == ".shp" else [path]
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            digest.update(os.path.basename(part).encode("utf-8"))
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashed_path(path, source_paths):
+    """
+    ファイル名に入力ファイルの内容のハッシュを付けたパスを返します（入力ファイルが変更されると別のファイルになる）。
+
+    Parameters:
+        path (str): ハッシュを付ける前のパス
+        source_paths (list): 出力の元になる入力ファイルのパス
+
+    Returns:
+        str: "<ファイル名>_<ハッシュ16桁>.<拡張子>" 形式のパス
+    """
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_{source_hash(source_paths)[:16]}{ext}"
+
+
+def read_cached(path, cache_dir=INPUT_CACHE_DIR, encoding="utf-8"):
+    """
+    入力データを読み込みます。同じパス・更新日時・サイズのファイルを変換済みの場合は GeoParquet から読み込みます。
+
+    Parameters:
+        path (str): 入力ファイルのパス
+        cache_dir (str): GeoParquet の保存先（None の場合はキャッシュを使わない）
+        encoding (str): 入力ファイルの文字コード
+
+    Returns:
+        GeoDataFrame: 入力データ
+    """
+    if cache_dir is None:
+        return gpd.read_file(path, encoding=encoding)
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{stem}_{cache_key(path)}.parquet")
+    if os.path.exists(cache_path):
+        return gpd.read_parquet(cache_path)
+
+    gdf = gpd.read_file(path, encoding=encoding)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書き出してから置き換える
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        gdf.to_parquet(temp_path, index=False)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        print(f"入力キャッシュを作成できませんでした（{path}）: {e}")
+    return gdf
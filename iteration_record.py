@@ -0,0 +1,167 @@
+# 反復ごとの状態（倒壊建物・閉塞道路・通行可否のビット列、道路ポリゴンごとの幅員減少量、建物ごとのルート結果）を
+# 1反復1ファイルの npz に保存する。各段階の成果物（GeoJSON / シェープファイル）は reconstruct_iteration.py で再構築する。
+import os
+import numpy as np
+import pandas as pd
+
+# 反復ごとの状態ファイルの名前
+RECORD_FILE_NAME = "{iteration:04d}_szok_state.npz"
+
+# ビット列で保存する項目（項目名: (成果物, 列)）
+BIT_FIELDS = {
+    "collapsed": ("destruction", "倒壊結果"),
+    "is_closed": ("area_analysis", "is_closed"),
+    "car_access": ("area_analysis", "car_access"),
+    "ped_access": ("area_analysis", "ped_access"),
+}
+
+# 道路ポリゴンごとに実数で保存する列
+ROAD_VALUE_COLUMNS = ["int_area", "int_length", "max_width", "rem_area"]
+
+# 建物ごとに実数で保存するルート結果の列
+ROUTE_VALUE_COLUMNS = ["t_time", "t_dist", "snap_dist"]
+
+
+def record_path(record_dir, iteration):
+    """反復番号に対応する状態ファイルのパス"""
+    return os.path.join(record_dir, RECORD_FILE_NAME.format(iteration=iteration))
+
+
+def _pack(values):
+    """真偽値の配列をビット列に変換（欠損値は False）"""
+    return np.packbits(pd.Series(values).fillna(False).astype(bool).to_numpy())
+
+
+def _unpack(bits, n):
+    return np.unpackbits(bits, count=n).astype(bool)
+
+
+def _ragged(lists):
+    """可変長の整数リストを (区切り位置, 連結した値) に変換"""
+    lengths = np.array([len(values) for values in lists], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = np.fromiter((v for values in lists for v in values), dtype=np.int64, count=int(offsets[-1]))
+    return offsets, values
+
+
+def _split_ids(values):
+    """セミコロン区切りのID（欠損値は空）をリストに変換"""
+    return [[] if pd.isna(value) or value == "" else str(value).split(";") for value in values]
+
+
+def build_record(results, buildings, road_polygons, iteration, settings=None):
+    """
+    1反復分の各段階の成果物から、保存する状態を作成します。
+    建物は入力の建物データの行位置、道路ポリゴンは入力の道路ポリゴンの行位置で表します。
+
+    Parameters:
+        results (dict): batch_simulation8.run_iteration の結果
+        buildings (GeoDataFrame): 入力の建物データ
+        road_polygons (GeoDataFrame): 入力の道路ポリゴン
+        iteration (int): 反復番号
+        settings (dict): 再構築に必要な設定（use_base_topology, routing_backend など）
+
+    Returns:
+        dict: 配列の辞書
+    """
+    n_buildings, n_roads = len(buildings), len(road_polygons)
+    building_index = pd.Index(buildings["id"].astype(str))
+    record = {
+        "iteration": np.int64(iteration),
+        "n_buildings": np.int64(n_buildings),
+        "n_roads": np.int64(n_roads),
+    }
+    for key, value in (settings or {}).items():
+        record[f"setting_{key}"] = np.asarray(value)
+
+    for field, (result_key, column) in BIT_FIELDS.items():
+        record[field] = _pack(results[result_key][column].to_numpy())
+
+    # 道路ポリゴンごとの幅員減少量・残存面積と、原因建物（建物の行位置）
+    area = results["area_analysis"]
+    for column in ROAD_VALUE_COLUMNS:
+        record[column] = area[column].to_numpy(dtype=float)
+    record["w_build"] = building_index.get_indexer(area["w_build_id"].fillna("").astype(str)).astype(np.int64)
+    closures = [building_index.get_indexer(ids) if ids else [] for ids in _split_ids(area["c_build_id"])]
+    record["c_build_offsets"], record["c_build"] = _ragged(closures)
+
+    # 建物ごとのルート結果（r_id は建物の行位置 + 1。ルートの行がない建物は has_route が False）
+    routes = results["routes"]
+    positions = routes["r_id"].to_numpy(dtype=np.int64) - 1
+    has_route = np.zeros(n_buildings, dtype=bool)
+    has_route[positions] = True
+    record["has_route"] = _pack(has_route)
+    for field, column in (("r_found", "r_found"), ("walk_f", "walk_f"), ("snap_far", "snap_far")):
+        values = np.zeros(n_buildings, dtype=bool)
+        values[positions] = routes[column].fillna(False).astype(bool).to_numpy()
+        record[field] = _pack(values)
+
+    start_nodes = np.full(n_buildings, -1, dtype=np.int64)
+    start_nodes[positions] = routes["n_node"].fillna(-1).astype(np.int64).to_numpy()
+    record["n_node"] = start_nodes
+    for column in ROUTE_VALUE_COLUMNS:
+        values = np.full(n_buildings, np.nan)
+        values[positions] = pd.to_numeric(routes[column], errors="coerce").to_numpy(dtype=float)
+        record[column] = values
+
+    # 通過ノード（ルートごとの可変長リスト）
+    paths = [[] for _ in range(n_buildings)]
+    for position, ids in zip(positions, _split_ids(routes["p_nodes"])):
+        paths[position] = [int(node_id) for node_id in ids]
+    record["path_offsets"], record["path_nodes"] = _ragged(paths)
+    return record
+
+
+def save_record(path, record):
+    """状態を圧縮した npz に保存（書き込み途中のファイルを残さないよう、一時ファイルに書き出してから置き換える）"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp.npz"
+    try:
+        np.savez_compressed(temp_path, **record)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load_record(path):
+    """save_record で保存した状態を読み込む"""
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+def collapsed_buildings(record):
+    """
+    状態から倒壊判定（建物ごとの真偽値）を取り出します。
+
+    Parameters:
+        record (dict): load_record の結果
+
+    Returns:
+        numpy.ndarray: 建物ごとの倒壊判定（入力の建物データの行順）
+    """
+    return _unpack(record["collapsed"], int(record["n_buildings"]))
+
+
+def compare_records(expected, actual):
+    """
+    2つの状態を比較し、一致しない項目の名前を返します（欠損値どうしは一致とみなす）。
+
+    Parameters:
+        expected (dict): 保存されていた状態
+        actual (dict): 再構築した成果物から作成した状態
+
+    Returns:
+        list: 一致しない項目の名前
+    """
+    mismatched = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in expected or key not in actual:
+            mismatched.append(key)
+        elif expected[key].dtype.kind == "f":
+            if not np.array_equal(expected[key], actual[key], equal_nan=True):
+                mismatched.append(key)
+        elif not np.array_equal(expected[key], actual[key]):
+            mismatched.append(key)
+    return mismatched
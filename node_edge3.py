@@ -1,148 +1,436 @@
 import geopandas as gpd
+import pandas as pd
+import shapely
 from shapely.geometry import Point, LineString, MultiLineString
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from sklearn.cluster import AgglomerativeClustering
 
-# ファイルパスの指定
-centerline_path = r"C:\szok\szoksrg_simulation\szoksrg_road_split_with_all_attributes.geojson"
-output_node_path = r"C:\szok\szoksrg_simulation\szoksrg_nodes.shp"
-output_edge_path = r"C:\szok\szoksrg_simulation\szoksrg_edges.shp"
-
-# 道路中心線の読み込み
-roads = gpd.read_file(centerline_path, encoding="utf-8")
-if roads.empty:
-    print("道路ラインが読み込めませんでした。パスやファイルを確認してください。")
-    import sys
-    sys.exit()
-
-# ノードとエッジのデータを格納する変数
-temp_coords = []       # 始点・終点の座標を都度追加
-coord_indices = []     # 始点・終点のインデックス
-edge_attributes = []   # エッジの属性
-
-edge_id_counter = 1
-
-for _, row in roads.iterrows():
-    geom = row.geometry
-    car_access_raw = row.get("car_access", False)
-    ped_access_raw = row.get("ped_access", False)
-    route_id_raw = row.get("路線ID", None)
-    road_width_raw = row.get("道路幅", None)
-    max_width_raw = row.get("max_width", None)
-
-    # データ型を適切に変換
-    car_access_val = bool(car_access_raw)
-    ped_access_val = bool(ped_access_raw)
-    route_id_val = str(route_id_raw) if route_id_raw is not None else None
-    road_width_val = float(road_width_raw) if road_width_raw is not None else None
-    max_width_val = float(max_width_raw) if max_width_raw is not None else None
-
-    if isinstance(geom, MultiLineString):
-        lines = geom.geoms
-    elif isinstance(geom, LineString):
-        lines = [geom]
-    else:
-        continue
-
-    for line in lines:
-        if line.is_empty:
-            continue
+# 始点・終点を同一ノードとみなす距離（m）
+MERGE_DISTANCE = 1.0
+
+# 始点・終点のまとめ方
+#   "complete" : 完全連結法（クラスタ内の全ての組が MERGE_DISTANCE 未満）。KD 木で求めた連結成分ごとに計算するため、ほぼ線形時間
+#   "single"   : KD 木で距離 MERGE_DISTANCE 未満の組を求め、連結成分ごとにまとめる（1m 未満の間隔で端点が連なると
+#                "complete" と異なるノードになる）
+ENDPOINT_LINKAGE = "complete"
+ENDPOINT_LINKAGES = ("single", "complete")
+
+
+def cluster_endpoints(coords, distance_threshold=MERGE_DISTANCE, linkage=ENDPOINT_LINKAGE):
+    """
+    始点・終点の座標を distance_threshold 未満の距離でまとめます。
+    "single" は距離 distance_threshold 未満の組を連鎖的にまとめるため、1m 未満の間隔で端点が連なる場合は
+    "complete"（クラスタ内の全ての組が distance_threshold 未満）より大きなクラスタになります。
+    "complete" は "single" の連結成分の間では結合しないため、直径が distance_threshold 以上の連結成分の中でのみ
+    AgglomerativeClustering を実行します（全体に実行した場合と同じ結果）。
+
+    Parameters:
+        coords (numpy.ndarray): 座標の配列（n×2）
+        distance_threshold (float): 同一ノードとみなす距離（m）
+        linkage (str): "single" / "complete"
+
+    Returns:
+        numpy.ndarray: 座標ごとのクラスタ番号
+    """
+    if linkage not in ENDPOINT_LINKAGES:
+        raise ValueError(f"未対応の端点のまとめ方です: {linkage}（{', '.join(ENDPOINT_LINKAGES)} から選択）")
+    if len(coords) < 2:
+        return np.zeros(len(coords), dtype=np.int64)
+
+    # 距離が閾値未満の端点の組（AgglomerativeClustering と同じく閾値ちょうどはまとめない）
+    pairs = cKDTree(coords).query_pairs(distance_threshold, output_type="ndarray")
+    distances = np.hypot(*(coords[pairs[:, 0]] - coords[pairs[:, 1]]).T)
+    pairs = pairs[distances < distance_threshold]
+
+    # 組を辺とするグラフの連結成分（Union-Find と同じ結果）をクラスタとする
+    n = len(coords)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    n_components, labels = connected_components(graph, directed=False)
+    if linkage == "single":
+        return labels
+
+    # 閾値未満の組が全ての組ではない（直径が閾値以上の）連結成分のみを完全連結法で分割
+    # （それ以外の連結成分は全ての組が閾値未満のため1つのクラスタ）
+    sizes = np.bincount(labels, minlength=n_components)
+    close_pairs = np.bincount(labels[pairs[:, 0]], minlength=n_components)
+    order = np.argsort(labels, kind="stable")
+    members = np.split(order, np.cumsum(sizes)[:-1])
+    next_label = n_components
+    for component in np.flatnonzero(close_pairs < sizes * (sizes - 1) // 2):
+        index = members[component]
+        clustering = AgglomerativeClustering(
+            n_clusters=None, distance_threshold=distance_threshold, linkage='complete'
+        ).fit(coords[index])
+        split = clustering.labels_ > 0
+        labels[index[split]] = next_label + clustering.labels_[split] - 1
+        next_label += clustering.labels_.max()
+    return labels
 
-        # --- 修正ポイント: 事前に始点・終点が正しい座標かチェック ---
-        start_xy = line.coords[0]
-        end_xy = line.coords[-1]
 
-        # None や 2次元以外の座標を持つ場合はスキップ
-        if (start_xy is None or len(start_xy) != 2) or (end_xy is None or len(end_xy) != 2):
+def extract_segments(roads):
+    """
+    道路中心線を区間（LineString）ごとのエッジ属性と始点・終点の座標に分解します。
+
+    Parameters:
+        roads (GeoDataFrame): 分割後の道路中心線（closedpoint2 の結果）
+
+    Returns:
+        tuple: (区間ごとのエッジ属性（row: 元の行位置）のリスト, 始点・終点の座標のリスト（区間ごとに始点・終点の順）)
+    """
+    # ノードとエッジのデータを格納する変数
+    temp_coords = []       # 始点・終点の座標を都度追加
+    edge_attributes = []   # エッジの属性
+
+    for pos, (_, row) in enumerate(roads.iterrows()):
+        geom = row.geometry
+        car_access_raw = row.get("car_access", False)
+        ped_access_raw = row.get("ped_access", False)
+        route_id_raw = row.get("路線ID", None)
+        road_width_raw = row.get("道路幅", None)
+        max_width_raw = row.get("max_width", None)
+
+        # データ型を適切に変換
+        car_access_val = bool(car_access_raw)
+        ped_access_val = bool(ped_access_raw)
+        route_id_val = str(route_id_raw) if route_id_raw is not None else None
+        road_width_val = float(road_width_raw) if road_width_raw is not None else None
+        max_width_val = float(max_width_raw) if max_width_raw is not None else None
+
+        if isinstance(geom, MultiLineString):
+            lines = geom.geoms
+        elif isinstance(geom, LineString):
+            lines = [geom]
+        else:
             continue
 
-        start_idx = len(temp_coords)
-        temp_coords.append(start_xy)
-
-        end_idx = len(temp_coords)
-        temp_coords.append(end_xy)
-
-        # エッジ属性を追加
-        edge_attributes.append({
-            "edge_id": edge_id_counter,
-            "路線ID": route_id_val,
-            "道路幅": road_width_val,
-            "max_width": max_width_val,
-            "car_access": car_access_val,
-            "ped_access": ped_access_val,
-            "length": line.length,
-            "geometry": line
+        for line in lines:
+            if line.is_empty:
+                continue
+
+            # --- 修正ポイント: 事前に始点・終点が正しい座標かチェック ---
+            start_xy = line.coords[0]
+            end_xy = line.coords[-1]
+
+            # None や 2次元以外の座標を持つ場合はスキップ
+            if (start_xy is None or len(start_xy) != 2) or (end_xy is None or len(end_xy) != 2):
+                continue
+
+            temp_coords.append(start_xy)
+            temp_coords.append(end_xy)
+
+            # エッジ属性を追加
+            edge_attributes.append({
+                "row": pos,
+                "路線ID": route_id_val,
+                "道路幅": road_width_val,
+                "max_width": max_width_val,
+                "car_access": car_access_val,
+                "ped_access": ped_access_val,
+                "length": line.length,
+                "geometry": line
+            })
+
+    return edge_attributes, temp_coords
+
+
+def cluster_nodes(coords_array, crs):
+    """
+    始点・終点の座標をまとめてノードを作成します（ノードの座標はクラスタ内の座標の平均）。
+
+    Parameters:
+        coords_array (numpy.ndarray): 始点・終点の座標の配列（n×2）
+        crs: 座標参照系
+
+    Returns:
+        tuple: (ノードの GeoDataFrame（node_id は 1 からの連番。最初に現れた順）, 座標ごとのノードの行位置)
+    """
+    # クラスタリング
+    labels = cluster_endpoints(coords_array)
+
+    # ノード作成
+    cluster_dict = {}
+    for i, cluster_id in enumerate(labels):
+        cluster_dict.setdefault(cluster_id, []).append(coords_array[i])
+
+    new_node_records = []
+    cluster_id_to_position = {}
+
+    for position, (cluster_id, group_coords) in enumerate(cluster_dict.items()):
+        arr = np.array(group_coords)
+        cx = arr[:, 0].mean()
+        cy = arr[:, 1].mean()
+
+        new_node_records.append({
+            "node_id": position + 1,
+            "X": cx,
+            "Y": cy,
+            "geometry": Point(cx, cy)
+        })
+        cluster_id_to_position[cluster_id] = position
+
+    node_gdf = gpd.GeoDataFrame(new_node_records, columns=["node_id", "X", "Y", "geometry"], crs=crs)
+    return node_gdf, np.array([cluster_id_to_position[cluster_id] for cluster_id in labels], dtype=np.int64)
+
+
+EDGE_COLUMNS = ["edge_id", "start_node", "end_node", "length", "route_id", "道路幅", "max_width",
+                "car_access", "ped_access", "geometry"]
+
+
+def build_nodes_edges(roads):
+    """
+    道路中心線の始点・終点を 1m 以内でまとめてノードとし、ノード間を結ぶエッジを作成します。
+
+    Parameters:
+        roads (GeoDataFrame): 分割後の道路中心線（closedpoint2 の結果）
+
+    Returns:
+        tuple: (ノードの GeoDataFrame, エッジの GeoDataFrame)
+    """
+    edge_attributes, temp_coords = extract_segments(roads)
+
+    # --- 修正ポイント: 後から temp_coords を再フィルタリングする処理は削除 ---
+    # ここに "temp_coords = [coord for coord in temp_coords if ...]" といったコードは書かない
+
+    # numpy配列に変換してクラスタリング
+    coords_array = np.array(temp_coords)
+    node_gdf, node_positions = cluster_nodes(coords_array, roads.crs)
+    node_ids = node_gdf["node_id"].to_numpy()
+
+    # エッジの作成（区間 i の始点・終点は座標の 2i, 2i+1 番目）
+    edge_records = []
+    for i, edge_attr in enumerate(edge_attributes):
+        edge_records.append({
+            "edge_id": i + 1,
+            "start_node": node_ids[node_positions[2 * i]],
+            "end_node": node_ids[node_positions[2 * i + 1]],
+            "length": edge_attr["length"],
+            "route_id": edge_attr["路線ID"],
+            "道路幅": edge_attr["道路幅"],
+            "max_width": edge_attr["max_width"],
+            "car_access": edge_attr["car_access"],
+            "ped_access": edge_attr["ped_access"],
+            "geometry": edge_attr["geometry"]
         })
-        coord_indices.append((start_idx, end_idx))
-
-        edge_id_counter += 1
-
-# --- 修正ポイント: 後から temp_coords を再フィルタリングする処理は削除 ---
-# ここに "temp_coords = [coord for coord in temp_coords if ...]" といったコードは書かない
-
-# numpy配列に変換
-coords_array = np.array(temp_coords)
-
-# クラスタリング
-clustering = AgglomerativeClustering(n_clusters=None, distance_threshold=1.0, linkage='complete').fit(coords_array)
-labels = clustering.labels_
-
-# ノード作成
-cluster_dict = {}
-for i, cluster_id in enumerate(labels):
-    cluster_dict.setdefault(cluster_id, []).append(coords_array[i])
-
-new_node_records = []
-cluster_id_to_node_id = {}
-new_node_id_counter = 1
-
-for cluster_id, group_coords in cluster_dict.items():
-    arr = np.array(group_coords)
-    cx = arr[:, 0].mean()
-    cy = arr[:, 1].mean()
-
-    new_node_records.append({
-        "node_id": new_node_id_counter,
-        "X": cx,
-        "Y": cy,
-        "geometry": Point(cx, cy)
-    })
-    cluster_id_to_node_id[cluster_id] = new_node_id_counter
-    new_node_id_counter += 1
-
-node_gdf = gpd.GeoDataFrame(new_node_records, crs=roads.crs)
-
-# エッジの作成
-edge_records = []
-for i, edge_attr in enumerate(edge_attributes):
-    edge_id = edge_attr["edge_id"]
-    line_geom = edge_attr["geometry"]
-
-    # coord_indices[i] に対応する始点・終点を取得
-    start_idx, end_idx = coord_indices[i]
-
-    start_cluster = labels[start_idx]
-    end_cluster = labels[end_idx]
-    start_node_id = cluster_id_to_node_id[start_cluster]
-    end_node_id = cluster_id_to_node_id[end_cluster]
-
-    edge_records.append({
-        "edge_id": edge_id,
-        "start_node": start_node_id,
-        "end_node": end_node_id,
-        "length": edge_attr["length"],
-        "route_id": edge_attr["路線ID"],
-        "道路幅": edge_attr["道路幅"],
-        "max_width": edge_attr["max_width"],
-        "car_access": edge_attr["car_access"],
-        "ped_access": edge_attr["ped_access"],
-        "geometry": line_geom
-    })
-
-edge_gdf = gpd.GeoDataFrame(edge_records, crs=roads.crs)
-
-# 保存
-node_gdf.to_file(output_node_path, driver="ESRI Shapefile", encoding="utf-8")
-edge_gdf.to_file(output_edge_path, driver="ESRI Shapefile", encoding="utf-8")
-
-print("ノードとエッジを出力しました。")
+
+    edge_gdf = gpd.GeoDataFrame(edge_records, crs=roads.crs)
+
+    return node_gdf, edge_gdf
+
+
+def same_topology(nodes_a, edges_a, nodes_b, edges_b):
+    """
+    2つのノード・エッジが node_id / edge_id の付け方を除いて一致するか（ノードの座標と順序、エッジの接続・属性と順序）を判定します。
+
+    Returns:
+        bool: 一致する場合 True
+    """
+    if len(nodes_a) != len(nodes_b) or len(edges_a) != len(edges_b):
+        return False
+    if not (np.array_equal(nodes_a["X"].to_numpy(dtype=float), nodes_b["X"].to_numpy(dtype=float))
+            and np.array_equal(nodes_a["Y"].to_numpy(dtype=float), nodes_b["Y"].to_numpy(dtype=float))):
+        return False
+
+    # エッジの始点・終点をノードの行位置に変換して比較
+    for node_column in ("start_node", "end_node"):
+        a = pd.Index(nodes_a["node_id"]).get_indexer(edges_a[node_column])
+        b = pd.Index(nodes_b["node_id"]).get_indexer(edges_b[node_column])
+        if not np.array_equal(a, b):
+            return False
+    for column in ("length", "道路幅", "max_width"):
+        a = pd.to_numeric(edges_a[column], errors="coerce").to_numpy(dtype=float)
+        b = pd.to_numeric(edges_b[column], errors="coerce").to_numpy(dtype=float)
+        if not np.array_equal(a, b, equal_nan=True):
+            return False
+    for column in ("car_access", "ped_access"):
+        if not np.array_equal(edges_a[column].to_numpy(dtype=bool), edges_b[column].to_numpy(dtype=bool)):
+            return False
+    return (
+        np.array_equal(edges_a["route_id"].astype(str).to_numpy(), edges_b["route_id"].astype(str).to_numpy())
+        and bool(shapely.equals_exact(edges_a.geometry.to_numpy(), edges_b.geometry.to_numpy(), tolerance=0).all())
+    )
+
+
+class BaseTopology:
+    """
+    元の道路中心線から一度だけ作成したノード・エッジ（固定の node_id / edge_id）に、
+    反復ごとの変更（閉塞による分割・短縮、幅員減少・通行可否の更新）のみを反映します。
+    始点・終点をまとめ直すのは変更された区間の周辺のみで、それ以外の元のノードは node_id ごとそのまま使います。
+    ノードの座標・接続とエッジの順序は、反復ごとに build_nodes_edges で作り直した場合と同じです。
+    """
+
+    def __init__(self, road_lines, merge_distance=MERGE_DISTANCE):
+        """
+        Parameters:
+            road_lines (GeoDataFrame): 元の道路中心線（路線ID 列を含む）
+            merge_distance (float): 始点・終点を同一ノードとみなす距離（m）
+        """
+        self.merge_distance = merge_distance
+        self.nodes, self.edges = build_nodes_edges(road_lines)
+        self.tree = cKDTree(self.nodes[["X", "Y"]].to_numpy())
+        self.next_node_id = int(self.nodes["node_id"].max()) + 1 if len(self.nodes) else 1
+        self.next_edge_id = int(self.edges["edge_id"].max()) + 1 if len(self.edges) else 1
+
+        # 元のエッジの始点・終点の座標とノードの行位置
+        geoms = self.edges.geometry.to_numpy()
+        self.edge_coords = np.column_stack([
+            shapely.get_x(shapely.get_point(geoms, 0)), shapely.get_y(shapely.get_point(geoms, 0)),
+            shapely.get_x(shapely.get_point(geoms, -1)), shapely.get_y(shapely.get_point(geoms, -1)),
+        ]) if len(geoms) else np.empty((0, 4))
+        node_index = pd.Index(self.nodes["node_id"])
+        self.edge_nodes = np.column_stack([
+            node_index.get_indexer(self.edges["start_node"]), node_index.get_indexer(self.edges["end_node"]),
+        ]) if len(geoms) else np.empty((0, 2), dtype=np.int64)
+
+        # 始点・終点の距離 merge_distance 未満の組の連結成分（この単位でまとめ直す。成分の間ではノードはまとまらない）
+        endpoint_coords = self.edge_coords.reshape(-1, 2)
+        self.endpoint_tree = cKDTree(endpoint_coords)
+        self.endpoint_components = cluster_endpoints(endpoint_coords, merge_distance, linkage="single").reshape(-1, 2)
+        self.n_components = int(self.endpoint_components.max()) + 1 if len(geoms) else 0
+
+        # 路線IDごとの元のジオメトリ（変更の有無の判定用）
+        lines = road_lines[road_lines["路線ID"].notna()]
+        lines = lines.drop_duplicates("路線ID", keep=False)
+        self.line_geoms = pd.Series(lines.geometry.to_numpy(), index=lines["路線ID"].astype(str))
+
+    def apply(self, roads):
+        """
+        反復ごとの分割後の道路中心線を反映したノード・エッジを作成します。
+        変更のない路線は元のエッジを再利用し（属性のみ更新）、分割・短縮された路線の区間のみ新しいエッジとします。
+        始点・終点をまとめ直すのは、元のエッジが除かれた連結成分と、新しい区間の端点から merge_distance 以内の
+        端点を含む連結成分のみです（新しい区間の端点とあわせて build_nodes_edges と同じ順序でまとめる）。
+        それ以外の連結成分は元のノードをそのまま使います。まとめ直したノードは、座標が元のノードと一致する場合は
+        元の node_id を使い、それ以外は座標の順に元のノードの続きの node_id を付けます（行の順序によらない）。
+
+        Parameters:
+            roads (GeoDataFrame): 分割後の道路中心線（closedpoint2 の結果）
+
+        Returns:
+            tuple: (ノードの GeoDataFrame, エッジの GeoDataFrame)。ノードはエッジが接続するもののみ
+        """
+        route_ids = roads["路線ID"].astype(str)
+        base_geoms = self.line_geoms.reindex(route_ids)
+        base_geoms = base_geoms.where(base_geoms.notna(), None).to_numpy()
+        unchanged = (
+            roads["路線ID"].notna().to_numpy()
+            & shapely.equals_exact(roads.geometry.to_numpy(), base_geoms, tolerance=0)
+        )
+
+        # 変更のない路線: 元のエッジの属性を更新（行位置 row で道路中心線の順に並べる）
+        attributes = roads.loc[unchanged, ["道路幅", "max_width", "car_access", "ped_access"]].assign(
+            route_id=route_ids[unchanged].to_numpy(), row=np.flatnonzero(unchanged),
+        )
+        kept = self.edges[["edge_id", "route_id", "length", "geometry"]].assign(
+            base_position=np.arange(len(self.edges))
+        ).merge(attributes.drop_duplicates("route_id"), on="route_id", how="inner")
+        kept["道路幅"] = kept["道路幅"].astype(float)
+        kept["max_width"] = kept["max_width"].astype(float)
+        kept_coords = self.edge_coords[kept["base_position"].to_numpy()]
+
+        # 分割・短縮された路線: 区間ごとのエッジを作成（新しい edge_id）
+        changed_rows = np.flatnonzero(~unchanged)
+        segments, segment_coords = extract_segments(roads.iloc[changed_rows])
+        changed = pd.DataFrame(segments, columns=["row", "路線ID", "道路幅", "max_width", "car_access", "ped_access",
+                                                  "length", "geometry"]).rename(columns={"路線ID": "route_id"})
+        changed["row"] = changed_rows[changed["row"].to_numpy(dtype=np.int64)]
+        changed["edge_id"] = self.next_edge_id + np.arange(len(changed))
+        changed_coords = np.array(segment_coords, dtype=float).reshape(-1, 4)
+
+        # まとめ直す連結成分: 元のエッジが除かれた成分と、新しい区間の端点から merge_distance 以内の端点を含む成分
+        removed = np.ones(len(self.edges), dtype=bool)
+        removed[kept["base_position"].to_numpy()] = False
+        dirty = np.zeros(self.n_components, dtype=bool)
+        dirty[self.endpoint_components[removed].ravel()] = True
+        if len(changed_coords):
+            hits = cKDTree(changed_coords.reshape(-1, 2)).query_ball_tree(self.endpoint_tree, self.merge_distance)
+            near = np.array([i for hit in hits for i in hit], dtype=np.int64)
+            dirty[self.endpoint_components.ravel()[near]] = True
+
+        # 道路中心線の順（同じ行の区間は元の順）に並べる
+        edges = pd.concat([kept, changed], ignore_index=True)
+        coords = np.vstack([kept_coords, changed_coords])
+        order = np.argsort(edges["row"].to_numpy(), kind="stable")
+        edges, coords = edges.iloc[order].reset_index(drop=True), coords[order]
+
+        # 端点ごとの元の端点の位置（新しい区間は -1）と、元のノードをそのまま使う端点
+        base_position = edges["base_position"].to_numpy(dtype=float)
+        is_kept = ~np.isnan(base_position)
+        kept_positions = base_position[is_kept].astype(np.int64)
+        if (np.diff(kept_positions) < 0).any():
+            dirty[:] = True  # 元のエッジの順序が変わった場合は全てまとめ直す（ノードの座標の平均の順序を揃えるため）
+        clean = np.zeros((len(edges), 2), dtype=bool)
+        clean[is_kept] = ~dirty[self.endpoint_components[kept_positions]]
+        clean = clean.ravel()
+        base_nodes = np.full((len(edges), 2), -1, dtype=np.int64)
+        base_nodes[is_kept] = self.edge_nodes[kept_positions]
+        base_nodes = base_nodes.ravel()
+
+        # まとめ直す端点を build_nodes_edges と同じ順序でまとめ、座標が元のノードと一致する場合は元の node_id を使う
+        new_nodes, new_positions = cluster_nodes(coords.reshape(-1, 2)[~clean], self.nodes.crs)
+        new_xy = new_nodes[["X", "Y"]].to_numpy(dtype=float).reshape(-1, 2)
+        new_ids = np.zeros(len(new_nodes), dtype=np.int64)
+        if len(new_nodes) and len(self.nodes):
+            distances, nearest = self.tree.query(new_xy)
+            reused = (distances == 0) & ~np.isin(nearest, base_nodes[clean])
+            reused &= ~pd.Series(np.where(reused, nearest, -1 - np.arange(len(nearest)))).duplicated().to_numpy()
+            new_ids[reused] = self.nodes["node_id"].to_numpy()[nearest[reused]]
+        else:
+            reused = np.zeros(len(new_nodes), dtype=bool)
+        # 新しいノードは座標（mm に丸めた X, Y）の順に node_id を付ける
+        fresh = np.flatnonzero(~reused)
+        fresh_order = np.lexsort((new_xy[fresh, 1], new_xy[fresh, 0],
+                                  np.round(new_xy[fresh, 1], 3), np.round(new_xy[fresh, 0], 3)))
+        new_ids[fresh[fresh_order]] = self.next_node_id + np.arange(len(fresh))
+
+        # 端点ごとのノード（元のノードは行位置、まとめ直したノードは len(self.nodes) + 行位置）を最初に現れた順に並べる
+        endpoint_keys = base_nodes.copy()
+        endpoint_keys[~clean] = len(self.nodes) + new_positions
+        keys = pd.unique(endpoint_keys)
+        from_base = keys < len(self.nodes)
+        node_x = np.empty(len(keys))
+        node_y = np.empty(len(keys))
+        node_ids = np.empty(len(keys), dtype=np.int64)
+        base_keys, new_keys = keys[from_base], keys[~from_base] - len(self.nodes)
+        node_x[from_base] = self.nodes["X"].to_numpy(dtype=float)[base_keys]
+        node_y[from_base] = self.nodes["Y"].to_numpy(dtype=float)[base_keys]
+        node_ids[from_base] = self.nodes["node_id"].to_numpy()[base_keys]
+        node_x[~from_base] = new_xy[new_keys, 0]
+        node_y[~from_base] = new_xy[new_keys, 1]
+        node_ids[~from_base] = new_ids[new_keys]
+        node_gdf = gpd.GeoDataFrame(
+            {"node_id": node_ids, "X": node_x, "Y": node_y},
+            geometry=gpd.points_from_xy(node_x, node_y), crs=self.nodes.crs,
+        )
+
+        endpoint_ids = node_ids[pd.Index(keys).get_indexer(endpoint_keys)]
+        edges["start_node"] = endpoint_ids[0::2]
+        edges["end_node"] = endpoint_ids[1::2]
+
+        edge_gdf = gpd.GeoDataFrame(edges.reindex(columns=EDGE_COLUMNS), geometry="geometry", crs=self.edges.crs)
+        edge_gdf["car_access"] = edge_gdf["car_access"].astype(bool)
+        edge_gdf["ped_access"] = edge_gdf["ped_access"].astype(bool)
+        return node_gdf, edge_gdf
+
+
+if __name__ == "__main__":
+    # ファイルパスの指定
+    centerline_path = r"C:\szok\szoksrg_simulation\szoksrg_road_split_with_all_attributes.geojson"
+    output_node_path = r"C:\szok\szoksrg_simulation\szoksrg_nodes.shp"
+    output_edge_path = r"C:\szok\szoksrg_simulation\szoksrg_edges.shp"
+
+    # 道路中心線の読み込み
+    roads = gpd.read_file(centerline_path, encoding="utf-8")
+    if roads.empty:
+        print("道路ラインが読み込めませんでした。パスやファイルを確認してください。")
+        import sys
+        sys.exit()
+
+    node_gdf, edge_gdf = build_nodes_edges(roads)
+
+    # 保存
+    node_gdf.to_file(output_node_path, driver="ESRI Shapefile", encoding="utf-8")
+    edge_gdf.to_file(output_edge_path, driver="ESRI Shapefile", encoding="utf-8")
+
+    print("ノードとエッジを出力しました。")
@@ -0,0 +1,64 @@
+# batch_simulation8.py が保存した反復ごとの状態（npz）から、指定した反復の各段階の成果物（GeoJSON / シェープファイル）を再構築する。
+# 倒壊判定のビット列から各段階を再実行し、再構築した結果が保存されていた状態と一致するかを確認する。
+import os
+import numpy as np
+import batch_simulation8 as batch
+import build_destroy
+import iteration_record
+
+# 再構築する反復番号
+iteration = 1
+
+# 状態ファイルのフォルダと、再構築した成果物の出力先
+record_dir = batch.simulation_dir
+output_dir = batch.simulation_dir
+
+# 再構築する成果物（batch_simulation8.output_files のキー）
+output_keys = list(batch.output_files)
+
+
+def reconstruct(record):
+    """
+    状態に保存された倒壊判定から各段階を再実行し、各段階の成果物を返します。
+
+    Parameters:
+        record (dict): iteration_record.load_record の結果
+
+    Returns:
+        dict: batch_simulation8.run_iteration と同じ形式の成果物
+    """
+    # 保存時の設定でノード・エッジの作成方法と経路探索のバックエンドを揃える
+    if "setting_use_base_topology" in record:
+        batch.use_base_topology = bool(record["setting_use_base_topology"])
+    if "setting_routing_backend" in record:
+        batch.routing_backend = str(record["setting_routing_backend"])
+
+    inputs = batch.load_inputs()
+    if len(inputs["buildings"]) != int(record["n_buildings"]) or len(inputs["road_polygons"]) != int(record["n_roads"]):
+        raise ValueError("入力データの件数が状態の保存時と一致しません")
+
+    # 保存されていた倒壊判定を1反復分の倒壊判定行列として各段階を実行
+    collapse_matrix = iteration_record.collapsed_buildings(record)[:, np.newaxis]
+    collapse_polygons = build_destroy.buffer_collapse_polygons(inputs["buildings"], collapse_matrix)
+    results = batch.run_iteration(inputs, collapse_matrix, collapse_polygons, 0)
+
+    # 再構築した結果が保存されていた状態と一致するかを確認
+    settings = {key[len("setting_"):]: value for key, value in record.items() if key.startswith("setting_")}
+    rebuilt = iteration_record.build_record(
+        results, inputs["buildings"], inputs["road_polygons"], int(record["iteration"]), settings
+    )
+    mismatched = iteration_record.compare_records(record, rebuilt)
+    if mismatched:
+        print(f"警告: 再構築した結果が保存されていた状態と一致しません: {', '.join(mismatched)}")
+    return results
+
+
+if __name__ == "__main__":
+    record = iteration_record.load_record(iteration_record.record_path(record_dir, iteration))
+    results = reconstruct(record)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for key in output_keys:
+        path = os.path.join(output_dir, f"{str(iteration).zfill(4)}_{batch.output_files[key]}")
+        results[key].to_file(path, encoding="utf-8")
+        print(f"再構築した成果物を保存しました: {path}")
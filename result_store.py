@@ -0,0 +1,102 @@
+# モンテカルロ反復の結果を縦持ち（反復番号, エンティティID, 項目, 値）で SQLite に追記し、最後に項目ごとの横持ちCSVへ変換する。
+import os
+import sqlite3
+
+import pandas as pd
+
+
+class ResultStore:
+    """
+    反復ごとの結果を追記専用の縦持ちテーブルに保存します。
+    値は各反復の結果をCSVに書き出す場合と同じ文字列表現で保存し、欠損値は NULL とします。
+    """
+
+    def __init__(self, path, overwrite=True):
+        """
+        Parameters:
+            path (str): SQLite ファイルのパス
+            overwrite (bool): True の場合、既存のファイルを削除して新しく作成
+        """
+        if overwrite and os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (iteration INTEGER, entity_id TEXT, field TEXT, value TEXT)"
+        )
+        self.conn.commit()
+
+    def append(self, iteration, frames):
+        """
+        1反復分の結果を1回のトランザクションで追記します。
+
+        Parameters:
+            iteration (int): 反復番号
+            frames (list): (DataFrame, キー列, 値列) のリスト。キー列が欠損の行は保存しない
+        """
+        rows = []
+        for df, key_column, value_column in frames:
+            df = df[df[key_column].notna()]
+            values = df[value_column].astype(object)
+            values = values.where(values.notna(), None).map(lambda v: None if v is None else str(v))
+            rows.extend(zip(
+                [iteration] * len(df), df[key_column].astype(str), [value_column] * len(df), values
+            ))
+        with self.conn:
+            self.conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?)", rows)
+
+    def row_count(self):
+        """保存済みの行数（チェックポイントに記録し、再開時に以降の行を削除するための位置）"""
+        return self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM results").fetchone()[0]
+
+    def truncate(self, row_count):
+        """
+        指定した行数より後に追記された行を削除します（チェックポイント後に中断した反復の結果を取り消す）。
+
+        Parameters:
+            row_count (int): 残す行数（row_count の値）
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM results WHERE rowid > ?", (row_count,))
+
+    def to_wide(self, field, key_column):
+        """
+        1項目分の結果を、エンティティごとの行・反復ごとの列の表に変換します。
+        行はエンティティが初めて現れた順（反復番号順、各反復内は成果物の行順）に並び、
+        ある反復に存在しないエンティティは欠損値になります。
+
+        Parameters:
+            field (str): 項目名（値列の名前）
+            key_column (str): 出力する表のキー列の名前
+
+        Returns:
+            DataFrame: キー列と反復番号ごとの列を持つ表
+        """
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_field ON results (field)")
+        long = pd.read_sql_query(
+            "SELECT iteration, entity_id, value FROM results WHERE field = ? ORDER BY rowid",
+            self.conn, params=(field,),
+        )
+        if long.empty:
+            return pd.DataFrame(columns=[key_column])
+
+        # 同じ反復内でキーが重複する場合（同一IDの複数行）も、出現順に別の行として残す
+        long["occurrence"] = long.groupby(["iteration", "entity_id"]).cumcount()
+        rows = pd.MultiIndex.from_frame(long[["entity_id", "occurrence"]].drop_duplicates())
+        wide = long.pivot(index=["entity_id", "occurrence"], columns="iteration", values="value").reindex(rows)
+        wide.columns = [str(col) for col in wide.columns]
+        return wide.reset_index(level="occurrence", drop=True).rename_axis(key_column).reset_index()
+
+    def write_csv(self, field, key_column, output_csv):
+        """
+        1項目分の結果を横持ちのCSVに書き出します。
+
+        Parameters:
+            field (str): 項目名（値列の名前）
+            key_column (str): キー列の名前
+            output_csv (str): 出力CSVのパス
+        """
+        self.to_wide(field, key_column).to_csv(output_csv, index=False, encoding="utf-8")
+
+    def close(self):
+        self.conn.close()
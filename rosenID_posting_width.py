@@ -11,95 +11,102 @@
 # ------------------------------------------------------------
 
 import geopandas as gpd
-from collections import defaultdict
-
-# ---------- ファイルパス ----------
-road_line_path    = r"C:\shizuoka_plateau\szok_road\szoksrg_road_line.shp"              # 道路ライン
-road_polygon_path = r"C:\shizuoka_plateau\szok_road\szoksrg_road_plateau.shp"   # 道路ポリゴン
-
-out_polygon_path  = r"C:\shizuoka_plateau\szok_road\szoksrg_road_plateau_id.shp"
-out_line_path     = r"C:\shizuoka_plateau\szok_road\szok_road_width.shp"
-
-# ---------- 読み込み ----------
-road_lines    = gpd.read_file(road_line_path)
-road_polygons = gpd.read_file(road_polygon_path)
-
-# 距離・面積計算のため、両方とも同じ「メートル単位の投影座標系」に揃えておく
-# すでに平面直角系のはずですが、念のため
-road_lines    = road_lines.to_crs(6676)      # 静岡なら JGD2011 / 平面直角 IX などに合わせる
-road_polygons = road_polygons.to_crs(6676)
-
-# ---------- 出力用列の準備 ----------
-for col in ["路線ID", "道路幅", "交差点ID"]:
-    if col not in road_polygons.columns:
-        road_polygons[col] = None
-
-if "道路幅" not in road_lines.columns:
-    road_lines["道路幅"] = None
-
-# 交差点ID 用カウンタ
-intersection_id_counter = 1
-
-# ライン側に幅を集約するための器（長さ加重平均用）
-sum_len_by_line   = defaultdict(float)   # 各ラインに対応する「ポリゴン内の線分長」の合計
-sum_wlen_by_line  = defaultdict(float)   # 幅×線分長 の合計
-
-# ---------- メインループ：ポリゴンごと ----------
-for idx, poly_row in road_polygons.iterrows():
-    poly_geom = poly_row.geometry
-
-    # このポリゴンと交差する中心線を取得
-    intersecting = road_lines[road_lines.intersects(poly_geom)]
-
-    if len(intersecting) == 0:
-        # 何も交差しない → 幅・路線ID とも付与しない
-        continue
-
-    elif len(intersecting) == 1:
-        # 単一の中心線とだけ交差 → 通常の道路ポリゴン
-        line_row = intersecting.iloc[0]
-        line_idx = line_row.name      # line の index
-        line_geom = line_row.geometry
-
-        # ポリゴン内部にある中心線の長さを計算
-        seg_geom = line_geom.intersection(poly_geom)
-        seg_len = seg_geom.length
-
-        if seg_len <= 0:
-            # ゼロ長なら幅員は計算しない
-            continue
-
-        area = poly_geom.area
-        width = area / seg_len        # 幅員[m] = 面積 / 線分長
-
-        # ポリゴン側に路線IDと幅員を付与
-        road_polygons.at[idx, "路線ID"] = line_row.get("路線ID")
-        road_polygons.at[idx, "道路幅"] = float(width)
-
-        # ライン側の集約用に記録（長さ加重平均）
-        sum_len_by_line[line_idx]  += seg_len
-        sum_wlen_by_line[line_idx] += width * seg_len
-
-    else:
-        # 2 本以上の中心線と交差 → 交差点ポリゴンとみなす
-        road_polygons.at[idx, "交差点ID"] = f"INTERSECTION_{intersection_id_counter:05d}"
-        intersection_id_counter += 1
-        # 幅員は付与しない（None のまま）
-
-# ---------- ライン側に「道路幅」を反映 ----------
-for line_idx, total_len in sum_len_by_line.items():
-    if total_len <= 0:
-        continue
-    width = sum_wlen_by_line[line_idx] / total_len   # 長さ加重平均
-    road_lines.at[line_idx, "道路幅"] = float(width)
-
-# ---------- 保存 ----------
-# ※ shapefile の文字コードは QGIS 側でUTF-8を指定して読むのが無難です
-road_polygons.to_file(out_polygon_path)
-road_lines.to_file(out_line_path)
-
-print("処理完了")
-print(f"  ポリゴン出力: {out_polygon_path}")
-print(f"  ライン出力  : {out_line_path}")
+import numpy as np
+import shapely
+
+
+def assign_route_ids(road_lines, road_polygons):
+    """
+    道路ポリゴンに路線ID・道路幅（交差点ポリゴンは交差点ID）を、道路ラインに道路幅を付与します。
+    道路ポリゴンと交差する中心線の組は STRtree で一括して求め、ポリゴンごと・ラインごとの集計は配列で行います。
+
+    Parameters:
+        road_lines (GeoDataFrame): 道路ライン（路線ID 列を含む）
+        road_polygons (GeoDataFrame): 道路ポリゴン（road_lines と同じ座標系）
+
+    Returns:
+        tuple: (路線ID・道路幅・交差点ID を付与した道路ポリゴン, 道路幅を付与した道路ライン)
+    """
+    road_lines = road_lines.copy()
+    road_polygons = road_polygons.copy()
+
+    # ---------- 出力用列の準備 ----------
+    for col in ["路線ID", "道路幅", "交差点ID"]:
+        if col not in road_polygons.columns:
+            road_polygons[col] = None
+
+    if "道路幅" not in road_lines.columns:
+        road_lines["道路幅"] = None
+
+    # ---------- ポリゴンと交差する中心線の組（ポリゴン順・ライン順） ----------
+    polygon_geoms = road_polygons.geometry.to_numpy()
+    line_geoms = road_lines.geometry.to_numpy()
+    polygon_idx, line_idx = shapely.STRtree(line_geoms).query(polygon_geoms, predicate="intersects")
+    order = np.lexsort((line_idx, polygon_idx))
+    polygon_idx, line_idx = polygon_idx[order], line_idx[order]
+
+    # ポリゴンごとの交差する中心線の本数
+    n_intersecting = np.bincount(polygon_idx, minlength=len(road_polygons))
+
+    # ---------- 単一の中心線とだけ交差 → 通常の道路ポリゴン ----------
+    single = n_intersecting[polygon_idx] == 1
+    single_polygons, single_lines = polygon_idx[single], line_idx[single]
+
+    # ポリゴン内部にある中心線の長さ（ゼロ長なら幅員は計算しない）
+    seg_len = shapely.length(shapely.intersection(line_geoms[single_lines], polygon_geoms[single_polygons]))
+    positive = seg_len > 0
+    single_polygons, single_lines, seg_len = single_polygons[positive], single_lines[positive], seg_len[positive]
+    width = shapely.area(polygon_geoms[single_polygons]) / seg_len   # 幅員[m] = 面積 / 線分長
+
+    # ポリゴン側に路線IDと幅員を付与
+    route_ids = road_lines["路線ID"].to_numpy(dtype=object) if "路線ID" in road_lines.columns \
+        else np.full(len(road_lines), None, dtype=object)
+    road_polygons.iloc[single_polygons, road_polygons.columns.get_loc("路線ID")] = route_ids[single_lines]
+    road_polygons.iloc[single_polygons, road_polygons.columns.get_loc("道路幅")] = width
+
+    # ---------- 2 本以上の中心線と交差 → 交差点ポリゴンとみなす ----------
+    # 交差点ID はポリゴン順に 1 から付与（幅員は付与しない）
+    is_intersection = n_intersecting >= 2
+    numbers = np.cumsum(is_intersection)[is_intersection]
+    road_polygons.iloc[np.flatnonzero(is_intersection), road_polygons.columns.get_loc("交差点ID")] = \
+        [f"INTERSECTION_{number:05d}" for number in numbers]
+
+    # ---------- ライン側に「道路幅」を反映 ----------
+    # ライン内の線分長の合計と 幅×線分長 の合計をポリゴン順に足し上げ、長さ加重平均をとる
+    sum_len_by_line = np.bincount(single_lines, weights=seg_len, minlength=len(road_lines))
+    sum_wlen_by_line = np.bincount(single_lines, weights=width * seg_len, minlength=len(road_lines))
+    lines_with_width = np.flatnonzero(sum_len_by_line > 0)
+    road_lines.iloc[lines_with_width, road_lines.columns.get_loc("道路幅")] = \
+        sum_wlen_by_line[lines_with_width] / sum_len_by_line[lines_with_width]
+
+    return road_polygons, road_lines
+
+
+if __name__ == "__main__":
+    # ---------- ファイルパス ----------
+    road_line_path    = r"C:\shizuoka_plateau\szok_road\szoksrg_road_line.shp"              # 道路ライン
+    road_polygon_path = r"C:\shizuoka_plateau\szok_road\szoksrg_road_plateau.shp"   # 道路ポリゴン
+
+    out_polygon_path  = r"C:\shizuoka_plateau\szok_road\szoksrg_road_plateau_id.shp"
+    out_line_path     = r"C:\shizuoka_plateau\szok_road\szok_road_width.shp"
+
+    # ---------- 読み込み ----------
+    road_lines    = gpd.read_file(road_line_path)
+    road_polygons = gpd.read_file(road_polygon_path)
+
+    # 距離・面積計算のため、両方とも同じ「メートル単位の投影座標系」に揃えておく
+    # すでに平面直角系のはずですが、念のため
+    road_lines    = road_lines.to_crs(6676)      # 静岡なら JGD2011 / 平面直角 IX などに合わせる
+    road_polygons = road_polygons.to_crs(6676)
+
+    road_polygons, road_lines = assign_route_ids(road_lines, road_polygons)
+
+    # ---------- 保存 ----------
+    # ※ shapefile の文字コードは QGIS 側でUTF-8を指定して読むのが無難です
+    road_polygons.to_file(out_polygon_path)
+    road_lines.to_file(out_line_path)
+
+    print("処理完了")
+    print(f"  ポリゴン出力: {out_polygon_path}")
+    print(f"  ライン出力  : {out_line_path}")
 # ------------------------------------------------------------
-
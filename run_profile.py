@@ -0,0 +1,156 @@
+# バッチ実行の段階ごとの実行時間・段階の前後のメモリ使用量・件数（倒壊建物数、閉塞道路数、ノード・エッジ数など）と、
+# 失敗した段階のトレースバックを記録し、乱数・入力データのハッシュとともに実行マニフェスト（JSON / Parquet）として保存する。
+import json
+import os
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:  # psutil がない場合は resource（Windows 以外）で取得
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    プロセスのピークメモリ使用量（MB）を取得します（プロセス開始からの最大値）。
+
+    Returns:
+        float: ピークメモリ使用量（取得できない環境では None）
+    """
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        peak = getattr(info, "peak_wset", None)  # Windows のみ
+        if peak is not None:
+            return peak / 2 ** 20
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # macOS はバイト、Linux は KB
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    return None
+
+
+def current_rss_mb():
+    """
+    プロセスの現在のメモリ使用量（MB）を取得します。
+
+    Returns:
+        float: 現在のメモリ使用量（取得できない環境では None）
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open("/proc/self/statm") as f:  # psutil がない場合は Linux のみ
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageRecorder:
+    """
+    1反復（または反復前の準備処理）の段階ごとに、実行時間・段階の前後のメモリ使用量・件数・失敗時のトレースバックを記録します。
+    peak_rss_mb は段階の終了時点でのプロセス開始からのピークメモリ使用量のため、段階ごとのメモリ使用量の比較には
+    rss_before_mb / rss_after_mb（段階の開始時・終了時のメモリ使用量）を用います。
+
+        with recorder.stage("destruction") as counters:
+            ...
+            counters["collapsed"] = ...
+    """
+
+    def __init__(self, iteration=None):
+        """
+        Parameters:
+            iteration (int): 反復番号（準備処理の場合は None）
+        """
+        self.iteration = iteration
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {"stage": name, "wall_s": None, "rss_before_mb": current_rss_mb(), "rss_after_mb": None,
+                  "peak_rss_mb": None, "counters": {}, "error": None}
+        self.stages.append(record)
+        start = time.perf_counter()
+        try:
+            yield record["counters"]
+        except Exception:
+            record["error"] = traceback.format_exc()
+            raise
+        finally:
+            record["wall_s"] = time.perf_counter() - start
+            record["rss_after_mb"] = current_rss_mb()
+            record["peak_rss_mb"] = peak_rss_mb()
+
+    def as_dict(self):
+        """記録した内容（JSON に変換可能な辞書）"""
+        return {"iteration": self.iteration, "stages": self.stages}
+
+
+def stage_table(records):
+    """
+    StageRecorder.as_dict の結果のリストを、段階ごとに1行の表に変換します（件数は counter_ 付きの列）。
+
+    Parameters:
+        records (list): StageRecorder.as_dict の結果のリスト
+
+    Returns:
+        DataFrame: iteration, stage, wall_s, rss_before_mb, rss_after_mb, peak_rss_mb（プロセス開始からのピーク）,
+                   failed と件数の列を持つ表
+    """
+    rows = []
+    for record in records:
+        for stage in record["stages"]:
+            row = {
+                "iteration": record["iteration"],
+                "stage": stage["stage"],
+                "wall_s": stage["wall_s"],
+                "rss_before_mb": stage.get("rss_before_mb"),
+                "rss_after_mb": stage.get("rss_after_mb"),
+                "peak_rss_mb": stage["peak_rss_mb"],
+                "failed": stage["error"] is not None,
+            }
+            row.update({f"counter_{key}": value for key, value in stage["counters"].items()})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _to_json(value):
+    """numpy の数値など JSON に変換できない値を Python の値に変換"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def write_manifest(path, run_info, records):
+    """
+    実行マニフェストを JSON で保存し、段階ごとの表を同じ名前の Parquet で保存します。
+
+    Parameters:
+        path (str): マニフェスト（JSON）のパス
+        run_info (dict): 実行の設定・乱数・入力データのハッシュ、準備処理（setup）・終了処理（finish）の記録など
+        records (list): 反復ごとの StageRecorder.as_dict の結果
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    manifest = dict(run_info, iterations=records)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, default=_to_json)
+    os.replace(temp_path, path)
+
+    # 準備処理（setup）・終了処理（finish）の記録も段階ごとの表に含める
+    setup = [run_info["setup"]] if "setup" in run_info else []
+    finish = [run_info["finish"]] if "finish" in run_info else []
+    table = stage_table(setup + records + finish)
+    try:
+        table.to_parquet(os.path.splitext(path)[0] + ".parquet", index=False)
+    except Exception as e:
+        print(f"Error writing stage table: {e}")
@@ -0,0 +1,403 @@
+# モンテカルロ反復の結果を逐次集計し、閉塞確率・ルート発見率・平均移動時間の収束判定とエンティティごとの集計を行う。
+import warnings
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+
+class EntityWelford:
+    """
+    エンティティ（道路ポリゴン・建物など）ごとの平均と分散を Welford 法で逐次更新します。
+    各反復でエンティティごとに高々1つの観測値を受け取ります。
+    """
+
+    def __init__(self, keys):
+        """
+        Parameters:
+            keys (array-like): エンティティのキー（重複不可）
+        """
+        self.index = pd.Index(keys)
+        n = len(self.index)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+
+    def update(self, keys, values):
+        """
+        観測値を追加します（未知のキーと欠損値は無視）。
+
+        Parameters:
+            keys (array-like): 観測したエンティティのキー
+            values (array-like): 観測値
+        """
+        pos = self.index.get_indexer(pd.Index(keys))
+        values = np.asarray(values, dtype=float)
+        valid = (pos >= 0) & ~np.isnan(values)
+        pos, values = pos[valid], values[valid]
+
+        self.count[pos] += 1
+        delta = values - self.mean[pos]
+        self.mean[pos] += delta / self.count[pos]
+        self.m2[pos] += delta * (values - self.mean[pos])
+
+    def variance(self):
+        """
+        Returns:
+            numpy.ndarray: エンティティごとの不偏分散（観測が2つ未満の場合は NaN）
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+
+class EntityP2Quantile:
+    """
+    エンティティごとの分位点を P² 法（Jain & Chlamtac）で逐次推定します（観測値を保持しない）。
+    観測が5つ未満のエンティティは、保持している観測値から正確な分位点を返します。
+    マーカーの目標位置は観測数から決まるため保持せず、マーカーの位置は整数で保持します（チェックポイントを小さくするため）。
+    """
+
+    def __init__(self, keys, p):
+        """
+        Parameters:
+            keys (array-like): エンティティのキー（重複不可）
+            p (float): 推定する分位点（0〜1）
+        """
+        self.index = pd.Index(keys)
+        self.p = p
+        n = len(self.index)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.heights = np.zeros((n, 5))                                       # マーカーの高さ
+        self.positions = np.tile(np.arange(1, 6, dtype=np.int32), (n, 1))     # マーカーの位置
+        self.increments = np.array([0.0, p / 2, p, (1 + p) / 2, 1.0])        # 観測1つあたりの目標位置の増分
+
+    def update(self, keys, values):
+        """
+        観測値を追加します（未知のキーと欠損値は無視）。
+
+        Parameters:
+            keys (array-like): 観測したエンティティのキー（1回の呼び出しで重複不可）
+            values (array-like): 観測値
+        """
+        pos = self.index.get_indexer(pd.Index(keys))
+        values = np.asarray(values, dtype=float)
+        valid = (pos >= 0) & ~np.isnan(values)
+        pos, values = pos[valid], values[valid]
+
+        # 観測が5つになるまでは観測値をそのまま保持
+        filling = self.count[pos] < 5
+        fill_pos = pos[filling]
+        self.heights[fill_pos, self.count[fill_pos]] = values[filling]
+        self.count[fill_pos] += 1
+        filled = fill_pos[self.count[fill_pos] == 5]
+        self.heights[filled] = np.sort(self.heights[filled], axis=1)
+
+        pos, x = pos[~filling], values[~filling]
+        if len(pos) == 0:
+            return
+        q = self.heights[pos]
+        n = self.positions[pos].astype(float)
+
+        # 観測値が入る区間を求め、端のマーカーを更新
+        q[:, 0] = np.minimum(q[:, 0], x)
+        q[:, 4] = np.maximum(q[:, 4], x)
+        cell = np.clip((x[:, None] >= q[:, 1:4]).sum(axis=1), 0, 3)
+        n += np.arange(5)[None, :] > cell[:, None]
+        # 観測数 m の目標位置は 1 + (m - 1) × 増分（m = 5 で [1, 1+2p, 1+4p, 3+2p, 5]）
+        desired = 1 + self.count[pos, None] * self.increments
+
+        # 中間マーカーの高さを放物線補間（範囲外の場合は線形補間）で調整
+        for i in (1, 2, 3):
+            d = desired[:, i] - n[:, i]
+            move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+            d = np.sign(d) * move
+            parabolic = q[:, i] + d / (n[:, i + 1] - n[:, i - 1]) * (
+                (n[:, i] - n[:, i - 1] + d) * (q[:, i + 1] - q[:, i]) / (n[:, i + 1] - n[:, i])
+                + (n[:, i + 1] - n[:, i] - d) * (q[:, i] - q[:, i - 1]) / (n[:, i] - n[:, i - 1])
+            )
+            neighbor = np.where(d > 0, i + 1, i - 1)
+            rows = np.arange(len(pos))
+            linear = q[:, i] + d * (q[rows, neighbor] - q[:, i]) / (n[rows, neighbor] - n[:, i])
+            inside = (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1])
+            q[:, i] = np.where(move, np.where(inside, parabolic, linear), q[:, i])
+            n[:, i] += d
+
+        self.heights[pos] = q
+        self.positions[pos] = n
+        self.count[pos] += 1
+
+    def quantile(self):
+        """
+        Returns:
+            numpy.ndarray: エンティティごとの分位点の推定値（観測がない場合は NaN）
+        """
+        result = self.heights[:, 2].copy()
+        small = self.count < 5
+        if small.any():
+            held = np.where(np.arange(5)[None, :] < self.count[small, None], self.heights[small], np.nan)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)  # 観測のないエンティティは NaN
+                result[small] = np.nanquantile(held, self.p, axis=1)
+        return result
+
+
+def wilson_half_width(p, n, z):
+    """
+    割合の Wilson 信頼区間の半幅を計算します（p が 0 や 1 でも幅が 0 にならない）。
+
+    Parameters:
+        p (numpy.ndarray): 標本割合
+        n (numpy.ndarray): 観測数
+        z (float): 標準正規分布の分位点
+
+    Returns:
+        numpy.ndarray: 信頼区間の半幅（観測がない場合は NaN）
+    """
+    p = np.asarray(p, dtype=float)
+    n = np.asarray(n, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        half = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return np.where(n > 0, half, np.nan)
+
+
+class ConvergenceMonitor:
+    """
+    道路ポリゴンごとの閉塞確率（is_closed）、建物ごとのルート発見率（r_found）と平均移動時間（t_time）を逐次推定し、
+    信頼区間の半幅の最大値が許容値を下回ったかを判定します。
+    対称変量法では、反復 2m-1 と 2m の組の平均から is_closed と r_found の推定値の分散も推定します。
+    """
+
+    def __init__(self, road_keys, building_keys, tolerance=0.05, time_tolerance=0.5,
+                 confidence=0.95, min_iterations=10, paired=False):
+        """
+        Parameters:
+            road_keys (array-like): 道路ポリゴンのキー
+            building_keys (array-like): 建物ID
+            tolerance (float): 閉塞確率・ルート発見率の信頼区間半幅の許容値
+            time_tolerance (float): 平均移動時間（分）の信頼区間半幅の許容値
+            confidence (float): 信頼水準
+            min_iterations (int): 最小反復回数
+            paired (bool): 反復 2m-1 と 2m の組の平均を集計するか（対称変量法）
+        """
+        self.is_closed = EntityWelford(road_keys)
+        self.r_found = EntityWelford(building_keys)
+        self.t_time = EntityWelford(building_keys)
+        self.tolerance = tolerance
+        self.time_tolerance = time_tolerance
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.min_iterations = min_iterations
+        # 組の平均の集計と、組の相手を待っている観測値（組番号, 値）
+        self.pairs = None
+        if paired:
+            self.pairs = {
+                "is_closed": (EntityWelford(road_keys), [-1, np.full(len(self.is_closed.index), np.nan)]),
+                "r_found": (EntityWelford(building_keys), [-1, np.full(len(self.r_found.index), np.nan)]),
+            }
+
+    def _update_pair(self, field, keys, values, iteration):
+        """反復番号 iteration（1始まり）の観測値を組の相手と平均し、組の平均の集計に追加"""
+        stats, pending = self.pairs[field]
+        values_by_pos = np.full(len(stats.index), np.nan)
+        pos = stats.index.get_indexer(pd.Index(keys))
+        values_by_pos[pos[pos >= 0]] = values[pos >= 0]
+
+        pair = (iteration - 1) // 2
+        if iteration % 2 == 1:
+            pending[:] = [pair, values_by_pos]
+        elif pending[0] == pair:
+            stats.update(stats.index, (pending[1] + values_by_pos) / 2)
+            pending[:] = [-1, np.full(len(stats.index), np.nan)]
+
+    def update(self, road_keys, is_closed, building_keys, r_found, t_time, iteration=None):
+        """
+        1反復分の結果を追加します。
+
+        Parameters:
+            road_keys (array-like): 道路ポリゴンのキー
+            is_closed (array-like): 閉塞状態
+            building_keys (array-like): ルート結果の建物ID
+            r_found (array-like): ルートの有無
+            t_time (array-like): 総移動時間（分）。ルートがない場合は欠損値
+            iteration (int): 反復番号（1始まり。組の平均を集計する場合に必要）
+        """
+        is_closed = np.asarray(is_closed, dtype=float)
+        r_found = np.asarray(r_found, dtype=float)
+        self.is_closed.update(road_keys, is_closed)
+        self.r_found.update(building_keys, r_found)
+        self.t_time.update(building_keys, pd.to_numeric(pd.Series(t_time), errors="coerce").to_numpy())
+        if self.pairs is not None:
+            self._update_pair("is_closed", road_keys, is_closed, iteration)
+            self._update_pair("r_found", building_keys, r_found, iteration)
+
+    def variance_reduction(self):
+        """
+        is_closed と r_found の推定値について、独立な反復（plain）の二項分散 p(1-p)/n に対する分散低減率を推定します。
+        推定値の分散は組の平均の分散から求めます（組が2つ以上あるエンティティのみ対象）。
+
+        Returns:
+            dict: is_closed, r_found それぞれの分散低減率（二項分散の合計 / 推定値の分散の合計。
+                  1 より大きいほど少ない反復回数で同じ信頼区間幅に到達する。推定できない場合は NaN）
+        """
+        if self.pairs is None:
+            raise ValueError("組の平均を集計していないため分散低減率を推定できません（paired=True で作成してください）")
+
+        reduction = {}
+        for field, (pair_stats, _) in self.pairs.items():
+            stats = getattr(self, field)
+            valid = pair_stats.count > 1
+            if not valid.any():
+                reduction[field] = float("nan")
+                continue
+            binomial_var = np.sum(stats.mean[valid] * (1 - stats.mean[valid]) / stats.count[valid])
+            method_var = np.sum(pair_stats.variance()[valid] / pair_stats.count[valid])
+            if method_var > 0:
+                reduction[field] = float(binomial_var / method_var)
+            else:
+                reduction[field] = float("inf") if binomial_var > 0 else float("nan")
+        return reduction
+
+    def worst_half_widths(self):
+        """
+        観測のないエンティティの半幅は inf とします（収束していないとみなす）。
+        t_time の観測が2つ未満の建物は、ルート発見率の Wilson 信頼区間の上限が tolerance 以下
+        （ルートがほとんど見つからないことが確認できた）場合のみ半幅 0、それ以外は inf とします。
+
+        Returns:
+            dict: is_closed, r_found, t_time それぞれの信頼区間半幅の最大値（対象のエンティティがない場合は inf）
+        """
+        closed_half = wilson_half_width(self.is_closed.mean, self.is_closed.count, self.z)
+        found_half = wilson_half_width(self.r_found.mean, self.r_found.count, self.z)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            time_half = self.z * np.sqrt(self.t_time.variance() / self.t_time.count)
+            n = self.r_found.count
+            found_upper = (self.r_found.mean + self.z ** 2 / (2 * n)) / (1 + self.z ** 2 / n) + found_half
+        rare = found_upper <= self.tolerance
+        time_half = np.where(self.t_time.count < 2, np.where(rare, 0.0, np.inf), time_half)
+
+        def worst(values):
+            values = np.where(np.isnan(values), np.inf, values)
+            return float(values.max()) if len(values) else float("inf")
+
+        return {"is_closed": worst(closed_half), "r_found": worst(found_half), "t_time": worst(time_half)}
+
+    def converged(self, iteration):
+        """
+        Parameters:
+            iteration (int): 完了した反復回数
+
+        Returns:
+            bool: 最小反復回数以上で、すべての信頼区間半幅が許容値を下回った場合 True
+                  （観測が不足しているエンティティがある場合は False）
+        """
+        if iteration < self.min_iterations:
+            return False
+        widths = self.worst_half_widths()
+        return (widths["is_closed"] <= self.tolerance
+                and widths["r_found"] <= self.tolerance
+                and widths["t_time"] <= self.time_tolerance)
+
+
+class SimulationSummary:
+    """
+    反復ごとの結果から、道路ポリゴン・建物・道路中心線ごとの集計値を逐次更新します（各反復の結果は保持しない）。
+      道路ポリゴン: 閉塞確率、車・徒歩の通行可能確率、最大幅員減少幅の平均
+      建物: ルート発見率、総移動時間・総距離の平均・標準偏差・分位点
+      道路中心線: ルートの通過回数
+    """
+
+    ROAD_FIELDS = ("is_closed", "car_access", "ped_access", "max_width")
+    BUILDING_FIELDS = ("r_found", "t_time", "t_dist")
+    QUANTILE_FIELDS = ("t_time", "t_dist")
+
+    def __init__(self, road_keys, building_keys, line_keys, quantiles=(0.5, 0.9)):
+        """
+        Parameters:
+            road_keys (array-like): 道路ポリゴンのキー
+            building_keys (array-like): 建物ID
+            line_keys (array-like): 道路中心線の路線ID（重複は1つにまとめる）
+            quantiles (tuple): 建物ごとに推定する分位点
+        """
+        self.iterations = 0
+        self.roads = {field: EntityWelford(road_keys) for field in self.ROAD_FIELDS}
+        self.buildings = {field: EntityWelford(building_keys) for field in self.BUILDING_FIELDS}
+        self.quantiles = {
+            (field, p): EntityP2Quantile(building_keys, p) for field in self.QUANTILE_FIELDS for p in quantiles
+        }
+        self.line_index = pd.Index(pd.unique(np.asarray(line_keys)))
+        self.usage = np.zeros(len(self.line_index), dtype=np.int64)
+
+    def _line_positions(self, route_ids):
+        """エッジの路線ID（分割後の "路線ID_01" 形式を含む）を道路中心線の位置に変換"""
+        route_ids = pd.Index(route_ids).astype(str)
+        pos = self.line_index.get_indexer(route_ids)
+        split = pos < 0
+        if split.any():
+            pos[split] = self.line_index.get_indexer(route_ids[split].str.rsplit("_", n=1).str[0])
+        return pos
+
+    def update(self, road_keys, road_values, building_keys, building_values, edge_usage):
+        """
+        1反復分の結果を追加します。
+
+        Parameters:
+            road_keys (array-like): 道路ポリゴンのキー
+            road_values (DataFrame): is_closed, car_access, ped_access, max_width 列
+            building_keys (array-like): ルート結果の建物ID
+            building_values (DataFrame): r_found, t_time, t_dist 列（ルートがない場合は欠損値）
+            edge_usage (Series): エッジの路線IDごとの通過ルート数
+        """
+        def as_float(values):
+            return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+
+        self.iterations += 1
+        for field, stats in self.roads.items():
+            stats.update(road_keys, as_float(road_values[field]))
+        for field, stats in self.buildings.items():
+            stats.update(building_keys, as_float(building_values[field]))
+        for (field, _), sketch in self.quantiles.items():
+            sketch.update(building_keys, as_float(building_values[field]))
+
+        pos = self._line_positions(edge_usage.index)
+        np.add.at(self.usage, pos[pos >= 0], edge_usage.to_numpy()[pos >= 0])
+
+    def road_summary(self):
+        """
+        Returns:
+            DataFrame: 道路ポリゴンごとの n_iter, p_closed, p_car, p_ped, max_width_mean 列（キーをインデックスに持つ）
+        """
+        return pd.DataFrame({
+            "n_iter": self.roads["is_closed"].count,                 # 集計した反復回数
+            "p_closed": self.roads["is_closed"].mean,                # 閉塞確率
+            "p_car": self.roads["car_access"].mean,                  # 車の通行可能確率
+            "p_ped": self.roads["ped_access"].mean,                  # 徒歩の通行可能確率
+            "max_width_mean": self.roads["max_width"].mean,          # 最大幅員減少幅の平均
+        }, index=self.roads["is_closed"].index)
+
+    def building_summary(self):
+        """
+        Returns:
+            DataFrame: 建物ごとのルート発見率、総移動時間・総距離の平均・標準偏差・分位点（建物IDをインデックスに持つ）
+        """
+        summary = {
+            "n_iter": self.buildings["r_found"].count,               # 集計した反復回数
+            "r_found_rate": self.buildings["r_found"].mean,          # ルート発見率
+        }
+        for field in self.QUANTILE_FIELDS:
+            stats = self.buildings[field]
+            summary[f"{field}_n"] = stats.count                      # ルートが見つかった反復回数
+            summary[f"{field}_mean"] = np.where(stats.count > 0, stats.mean, np.nan)
+            summary[f"{field}_sd"] = np.sqrt(stats.variance())
+            for (quantile_field, p), sketch in self.quantiles.items():
+                if quantile_field == field:
+                    summary[f"{field}_p{round(p * 100):02d}"] = sketch.quantile()
+        return pd.DataFrame(summary, index=self.buildings["r_found"].index)
+
+    def line_summary(self):
+        """
+        Returns:
+            DataFrame: 道路中心線ごとの usage（ルートの通過回数の合計）, usage_mean（1反復あたり）列（路線IDをインデックスに持つ）
+        """
+        return pd.DataFrame({
+            "usage": self.usage,
+            "usage_mean": self.usage / max(self.iterations, 1),
+        }, index=self.line_index)
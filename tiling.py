@@ -0,0 +1,274 @@
+# 調査範囲を格子状のタイルに分割し、幅員減少（cross_analysis7）・残存面積（area_analysis）・道路中心線の分割（closedpoint2）を
+# タイルごとに（複数プロセスで）実行して、道路ポリゴン・道路中心線の元の順に結合する。
+# 各道路ポリゴン・道路中心線は代表点を含む1つのタイルだけが担当するため、結合結果に重複はない。
+# タイルには担当範囲の周囲（倒壊影響範囲 tokaihani の最大値 + 道路幅の最大値）の建物・道路ポリゴンも含めるため、
+# 結果はタイル分割しない場合と一致する。
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import shapely
+import area_analysis
+import closedpoint2
+import cross_analysis7
+
+# タイルの一辺の長さ（m）
+TILE_SIZE = 2000.0
+
+
+def halo_width(buildings, road_polygons):
+    """
+    タイルの周囲に含める範囲の幅を求めます。
+
+    Parameters:
+        buildings (GeoDataFrame): 建物データ（tokaihani 列を含む）
+        road_polygons (GeoDataFrame): 道路ポリゴン（道路幅列を含む）
+
+    Returns:
+        float: 倒壊影響範囲 tokaihani の最大値 + 道路幅の最大値
+    """
+    tokaihani = pd.to_numeric(buildings["tokaihani"], errors="coerce").to_numpy(dtype=float)
+    road_width = pd.to_numeric(road_polygons["道路幅"], errors="coerce").to_numpy(dtype=float)
+    max_tokaihani = np.nanmax(np.append(tokaihani, 0.0))
+    max_road_width = np.nanmax(np.append(road_width, 0.0))
+    return float(max_tokaihani + max_road_width)
+
+
+def _tile_keys(points, origin, tile_size):
+    """代表点を含むタイルの番号（列, 行）。代表点がない（空のジオメトリ）場合は (0, 0)"""
+    cols = np.floor((shapely.get_x(points) - origin[0]) / tile_size)
+    rows = np.floor((shapely.get_y(points) - origin[1]) / tile_size)
+    keys = np.column_stack([cols, rows])
+    keys[np.isnan(keys).any(axis=1)] = 0
+    return keys.astype(np.int64)
+
+
+def _bounds_union(bounds):
+    """複数の範囲 (minx, miny, maxx, maxy) を含む範囲（空のジオメトリの範囲 NaN は無視）"""
+    return np.array([
+        np.nanmin(bounds[:, 0]), np.nanmin(bounds[:, 1]), np.nanmax(bounds[:, 2]), np.nanmax(bounds[:, 3])
+    ])
+
+
+def build_tiles(road_polygons, road_lines, buildings, tile_size=TILE_SIZE, halo=None, impact_table=None):
+    """
+    道路ポリゴン・道路中心線を代表点でタイルに割り当て、タイルごとに必要な建物・道路ポリゴンを求めます。
+    担当する道路ポリゴン・道路中心線の範囲（とタイル自体の範囲）を halo だけ広げた範囲と交差する建物・道路ポリゴンを含めます。
+
+    Parameters:
+        road_polygons (GeoDataFrame): 道路ポリゴン
+        road_lines (GeoDataFrame): 道路中心線
+        buildings (GeoDataFrame): 建物データ（倒壊前）
+        tile_size (float): タイルの一辺の長さ（m）
+        halo (float): タイルの周囲に含める範囲の幅（None の場合は halo_width の値）
+        impact_table (DataFrame): 事前計算した影響表（None の場合は交差を各タイルでその場で計算）
+
+    Returns:
+        list: タイルごとの辞書
+            polygons: 担当する道路ポリゴンの行位置
+            lines: 担当する道路中心線の行位置
+            buildings: 周囲を含む建物の行位置
+            context: 道路中心線の分割で参照する道路ポリゴンの行位置
+            impact_table: 担当する道路ポリゴンの影響表（行位置はタイル内の位置に変換済み。impact_table が None の場合は None）
+    """
+    if halo is None:
+        halo = halo_width(buildings, road_polygons)
+
+    polygon_geoms = road_polygons.geometry.to_numpy()
+    line_geoms = road_lines.geometry.to_numpy()
+    polygon_bounds = shapely.bounds(polygon_geoms)
+    line_bounds = shapely.bounds(line_geoms)
+    origin = _bounds_union(np.vstack([polygon_bounds, line_bounds]))[:2]
+
+    # 代表点（道路ポリゴンは内部の点、道路中心線は中点）を含むタイルに割り当て
+    polygon_keys = _tile_keys(shapely.point_on_surface(polygon_geoms), origin, tile_size)
+    line_keys = _tile_keys(shapely.line_interpolate_point(line_geoms, 0.5, normalized=True), origin, tile_size)
+    keys = np.unique(np.vstack([polygon_keys, line_keys]), axis=0)
+
+    # 路線IDごとの先頭の道路ポリゴン（closedpoint2 が道路中心線に転記する行）
+    polygon_ids = road_polygons["路線ID"]
+    has_id = polygon_ids.notna().to_numpy()
+    first_polygon = pd.Series(np.flatnonzero(has_id), index=polygon_ids[has_id].to_numpy())
+    first_polygon = first_polygon[~first_polygon.index.duplicated()]
+
+    if impact_table is not None:
+        impact_road_idx = impact_table["road_idx"].to_numpy()
+        impact_building_idx = impact_table["building_idx"].to_numpy()
+
+    tiles = []
+    for col, row in keys:
+        polygons = np.flatnonzero((polygon_keys[:, 0] == col) & (polygon_keys[:, 1] == row))
+        lines = np.flatnonzero((line_keys[:, 0] == col) & (line_keys[:, 1] == row))
+
+        # タイルと担当する道路ポリゴン・道路中心線を含む範囲を halo だけ広げる
+        tile_box = origin[0] + col * tile_size, origin[1] + row * tile_size
+        bounds = np.vstack([
+            [tile_box[0], tile_box[1], tile_box[0] + tile_size, tile_box[1] + tile_size],
+            polygon_bounds[polygons], line_bounds[lines],
+        ])
+        minx, miny, maxx, maxy = _bounds_union(bounds)
+        region = shapely.box(minx - halo, miny - halo, maxx + halo, maxy + halo)
+
+        tile_buildings = np.sort(buildings.sindex.query(region, predicate="intersects"))
+        context = road_polygons.sindex.query(region, predicate="intersects")
+        line_ids = road_lines["路線ID"].to_numpy()[lines]
+        context = np.union1d(context, first_polygon.reindex(line_ids).dropna().to_numpy(dtype=np.int64))
+
+        tile_impacts = None
+        if impact_table is not None:
+            # 担当する道路ポリゴンの行を抽出し、道路・建物の行位置をタイル内の位置に変換（順序は変わらない）
+            selected = np.isin(impact_road_idx, polygons)
+            tile_buildings = np.union1d(tile_buildings, impact_building_idx[selected])
+            tile_impacts = impact_table[selected].copy()
+            tile_impacts["road_idx"] = np.searchsorted(polygons, impact_road_idx[selected])
+            tile_impacts["building_idx"] = np.searchsorted(tile_buildings, impact_building_idx[selected])
+            tile_impacts = tile_impacts.reset_index(drop=True)
+
+        tiles.append({
+            "polygons": polygons,
+            "lines": lines,
+            "buildings": tile_buildings,
+            "context": context,
+            "impact_table": tile_impacts,
+        })
+    return tiles
+
+
+def _analyze_tile(road_polygons, buildings, impact_table, static):
+    """1タイル分の幅員減少と残存面積を計算（別プロセスで実行）"""
+    reductions = cross_analysis7.analyze_width_reductions(road_polygons, buildings, impact_table)
+    areas = area_analysis.analyze_remaining_area(reductions, None, buildings, impact_table, static)
+    return reductions, areas
+
+
+def _split_tile(road_lines, closed_roads, buildings, closure_ids):
+    """1タイル分の道路中心線を分割（別プロセスで実行）"""
+    return closedpoint2.split_centerlines(road_lines, closed_roads, buildings, closure_ids)
+
+
+def _run_task(task):
+    func, args = task
+    return func(*args)
+
+
+def _stitch(parts, positions):
+    """
+    タイルごとの結果を元の行位置の順に結合します。
+    タイルによって列の型が異なる場合（値がすべて欠損のタイルなど）は、結合した値から型を推定し直して一括計算した場合と揃えます。
+    """
+    order = np.argsort(np.concatenate(positions), kind="stable")
+    stitched = pd.concat(parts).iloc[order]
+    for col in stitched.columns:
+        if len({str(part[col].dtype) for part in parts}) > 1:
+            stitched[col] = pd.Series(stitched[col].to_numpy(dtype=object).tolist(), index=stitched.index)
+    return stitched
+
+
+class TiledAnalysis:
+    """
+    タイル分割した幅員減少・残存面積・道路中心線の分割を実行します。
+    タイルの割り当てと影響表の分割は最初に一度だけ行い、反復ごとには倒壊結果を反映した建物だけをタイルに渡します。
+
+        tiles = TiledAnalysis(road_polygons, road_lines, buildings, static, impact_table, n_workers=4)
+        reductions, areas = tiles.analyze(destruction)
+        split_roads = tiles.split(areas, destruction)
+    """
+
+    def __init__(self, road_polygons, road_lines, buildings, static, impact_table=None,
+                 tile_size=TILE_SIZE, halo=None, n_workers=1):
+        """
+        Parameters:
+            road_polygons (GeoDataFrame): 道路ポリゴン
+            road_lines (GeoDataFrame): 道路中心線（インデックスが一意であること）
+            buildings (GeoDataFrame): 建物データ（倒壊前）
+            static (DataFrame): area_analysis.compute_static_quantities の結果
+            impact_table (DataFrame): 事前計算した影響表（None の場合は交差を各タイルでその場で計算）
+            tile_size (float): タイルの一辺の長さ（m）
+            halo (float): タイルの周囲に含める範囲の幅（None の場合は halo_width の値）
+            n_workers (int): タイルを並列実行するプロセス数（1 の場合は逐次実行）
+        """
+        if not road_lines.index.is_unique:
+            raise ValueError("道路中心線のインデックスが一意ではありません")
+        self.road_polygons = road_polygons
+        self.road_lines = road_lines
+        self.static = static.reset_index(drop=True)
+        self.n_workers = n_workers
+        self.tiles = build_tiles(road_polygons, road_lines, buildings, tile_size, halo, impact_table)
+        self._executor = None
+
+    def __getstate__(self):
+        # プロセスプールは別プロセスに渡さない
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def _map(self, tasks):
+        """タスクを実行し、結果をタスクの順に返す"""
+        if self.n_workers <= 1:
+            return [_run_task(task) for task in tasks]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+        return list(self._executor.map(_run_task, tasks))
+
+    def analyze(self, destruction):
+        """
+        タイルごとに幅員減少と残存面積を計算し、道路ポリゴンの順に結合します。
+
+        Parameters:
+            destruction (GeoDataFrame): 倒壊結果を反映した建物データ
+
+        Returns:
+            tuple: (cross_analysis7.analyze_width_reductions の結果, area_analysis.analyze_remaining_area の結果)
+                   （幅員減少の attrs["candidate_pairs"] は全タイルの合計）
+        """
+        tiles = [tile for tile in self.tiles if len(tile["polygons"])]
+        if not tiles:
+            return _analyze_tile(self.road_polygons, destruction, None, self.static)
+        tasks = [(_analyze_tile, (
+            self.road_polygons.iloc[tile["polygons"]],
+            destruction.iloc[tile["buildings"]],
+            tile["impact_table"],
+            self.static.iloc[tile["polygons"]].reset_index(drop=True),
+        )) for tile in tiles]
+        results = self._map(tasks)
+
+        positions = [tile["polygons"] for tile in tiles]
+        reductions = _stitch([reductions for reductions, _ in results], positions)
+        reductions.attrs["candidate_pairs"] = sum(part.attrs.get("candidate_pairs", 0) for part, _ in results)
+        areas = _stitch([areas for _, areas in results], positions)
+        return reductions, areas
+
+    def split(self, closed_roads, destruction):
+        """
+        タイルごとに道路中心線を分割し、元の道路中心線の順（同じ道路中心線の区間は分割順）に結合します。
+
+        Parameters:
+            closed_roads (GeoDataFrame): 閉塞判定済みの道路ポリゴン（analyze の結果）
+            destruction (GeoDataFrame): 倒壊結果を反映した建物データ
+
+        Returns:
+            GeoDataFrame: closedpoint2.split_centerlines の結果
+        """
+        # 閉塞原因建物は調査範囲全体で求める（隣のタイルの道路ポリゴンを閉塞させた建物でも道路中心線を分割する）
+        closed_edges = closed_roads[closed_roads["is_closed"] == 1]
+        closure_ids = closed_edges["c_build_id"].str.split(closedpoint2.CLOSURE_ID_SEPARATOR).explode().dropna().unique()
+
+        tiles = [tile for tile in self.tiles if len(tile["lines"])]
+        tasks = [(_split_tile, (
+            self.road_lines.iloc[tile["lines"]],
+            closed_roads.iloc[tile["context"]],
+            destruction.iloc[tile["buildings"]],
+            closure_ids,
+        )) for tile in tiles]
+        parts = [part for part in self._map(tasks) if len(part)]
+        if not parts:
+            return closedpoint2.split_centerlines(self.road_lines, closed_roads, destruction, closure_ids)
+
+        # 分割後の区間を元の道路中心線の行位置の順に並べる
+        positions = [self.road_lines.index.get_indexer(part["Index"]) for part in parts]
+        return _stitch(parts, positions).reset_index(drop=True)
+
+    def close(self):
+        """プロセスプールを終了します。"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -1,6 +0,0 @@
-import time
-
-# 2秒待つ
-time.sleep(2)
-
-print("Waited for 2 second.")